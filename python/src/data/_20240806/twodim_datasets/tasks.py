@@ -8,6 +8,7 @@ from torch.distributions import MultivariateNormal, MixtureSameFamily, Categoric
 
 from data._20240806.twodim_datasets.constants import DATA_20240806_TWODIM_DATASETS_PREFIX
 from pytasuku import Workspace
+from shion.base.dataset.mmap_tensor_dataset import convert_torch_file_to_mmap_tensor_file
 from shion.core.load_save import torch_save, torch_load
 
 
@@ -92,6 +93,12 @@ class TwoDimDatasetArgs:
     def dataset_file_name(self):
         return f"{self.prefix}/dataset.pt"
 
+    def mmap_dataset_file_name(self):
+        return f"{self.prefix}/dataset.mmt"
+
+    def create_mmap_dataset(self):
+        convert_torch_file_to_mmap_tensor_file(self.dataset_file_name(), self.mmap_dataset_file_name())
+
     def scatter_plot_file_name(self):
         return f"{self.prefix}/scatter_plot.png"
 
@@ -124,6 +131,10 @@ class TwoDimDatasetArgs:
         workspace.create_file_task(self.dataset_file_name(), [], self.create_dataset)
         all_tasks.append(self.dataset_file_name())
 
+        workspace.create_file_task(
+            self.mmap_dataset_file_name(), [self.dataset_file_name()], self.create_mmap_dataset)
+        all_tasks.append(self.mmap_dataset_file_name())
+
         workspace.create_file_task(self.scatter_plot_file_name(), [self.dataset_file_name()], self.create_scatter_plot)
         all_tasks.append(self.scatter_plot_file_name())
 
@@ -74,13 +74,17 @@ class FileTask(Task):
     def __init__(self, workspace, name, dependencies):
         super().__init__(workspace, name, dependencies)
 
+    @property
+    def exists(self) -> bool:
+        return os.path.isfile(self.name)
+
     @property
     def timestamp(self):
         return os.path.getmtime(self.name)
 
     @property
     def needs_to_be_run(self):
-        if not os.path.isfile(self.name):
+        if not self.exists:
             logging.info("Task %s will be run because the corresponding file does not exist." % self.name)
             return True
         for dep in self.dependencies:
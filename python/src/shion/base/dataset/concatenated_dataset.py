@@ -1,16 +1,107 @@
+import bisect
+import itertools
+from typing import List, Optional, Dict
+
+import torch
 from torch.utils.data import Dataset
 
+from shion.base.dataset.util import get_dataset_batch, merge_batches
+from shion.core.training.util import needs_batch_xform
+
 
 class ConcatenatedDataset(Dataset):
-    def __init__(self, dataset_0: Dataset, dataset_1: Dataset):
-        self.dataset_0 = dataset_0
-        self.dataset_1 = dataset_1
+    """
+    The examples of any number of datasets, one after another.
+
+    An example is found by binary search over the cumulative sizes of the datasets, which are computed the first time
+    they are needed. If the datasets open files lazily, passing their lengths as well keeps every one of them closed
+    until one of its examples is read.
+    """
+
+    def __init__(self, *datasets: Dataset, lengths: Optional[List[int]] = None):
+        assert len(datasets) > 0
+        if lengths is not None:
+            assert len(lengths) == len(datasets)
+        self.lengths = lengths
+        self.datasets = list(datasets)
+        self.cumulative_lengths = None
+
+    @property
+    def dataset_0(self) -> Dataset:
+        return self.datasets[0]
+
+    @property
+    def dataset_1(self) -> Dataset:
+        return self.datasets[1]
+
+    def get_cumulative_lengths(self) -> List[int]:
+        if self.cumulative_lengths is None:
+            if self.lengths is None:
+                self.lengths = [len(dataset) for dataset in self.datasets]
+            self.cumulative_lengths = list(itertools.accumulate(self.lengths))
+        return self.cumulative_lengths
+
+    def get_dataset_index(self, item: int) -> int:
+        return bisect.bisect_right(self.get_cumulative_lengths(), item)
+
+    def get_dataset_start(self, dataset_index: int) -> int:
+        if dataset_index == 0:
+            return 0
+        return self.get_cumulative_lengths()[dataset_index - 1]
 
     def __len__(self):
-        return len(self.dataset_0) + len(self.dataset_1)
+        return self.get_cumulative_lengths()[-1]
 
     def __getitem__(self, item):
-        if item < len(self.dataset_0):
-            return self.dataset_0[item]
-        else:
-            return self.dataset_1[item - len(self.dataset_0)]
+        if item < 0:
+            item += len(self)
+        dataset_index = self.get_dataset_index(item)
+        return self.datasets[dataset_index][item - self.get_dataset_start(dataset_index)]
+
+    def group_indices(self, example_indices: List[int]) -> Dict[int, List[int]]:
+        # Positions in example_indices of the examples of each dataset.
+        groups = {}
+        for position, item in enumerate(example_indices):
+            groups.setdefault(self.get_dataset_index(item), []).append(position)
+        return groups
+
+    def __getitems__(self, example_indices: List[int]) -> list:
+        example_indices = [item + len(self) if item < 0 else item for item in example_indices]
+        examples = [None] * len(example_indices)
+        for dataset_index, positions in self.group_indices(example_indices).items():
+            dataset = self.datasets[dataset_index]
+            start = self.get_dataset_start(dataset_index)
+            local_indices = [example_indices[position] - start for position in positions]
+            if hasattr(dataset, "__getitems__"):
+                dataset_examples = dataset.__getitems__(local_indices)
+            else:
+                dataset_examples = [dataset[local_index] for local_index in local_indices]
+            for position, example in zip(positions, dataset_examples):
+                examples[position] = example
+        return examples
+
+    def get_batch(self, example_indices: torch.Tensor):
+        groups = self.group_indices(example_indices.tolist())
+        positions = []
+        batches = []
+        for dataset_index, dataset_positions in groups.items():
+            dataset_positions = torch.tensor(dataset_positions, dtype=torch.long)
+            local_indices = example_indices[dataset_positions] - self.get_dataset_start(dataset_index)
+            batch = get_dataset_batch(self.datasets[dataset_index], local_indices)
+            if batch is None:
+                return None
+            positions.append(dataset_positions)
+            batches.append(batch)
+        return merge_batches(positions, batches)
+
+    def needs_batch_xform(self) -> bool:
+        return any(needs_batch_xform(dataset) for dataset in self.datasets)
+
+    def xform_batch(self, batch: List[torch.Tensor], epoch: int) -> List[torch.Tensor]:
+        # A batch mixes the examples of the datasets, so their own batch transforms cannot be applied to it.
+        if self.needs_batch_xform():
+            raise RuntimeError(
+                "ConcatenatedDataset: Some of the datasets transform whole batches on the training device, which "
+                "cannot be done on a batch that mixes their examples. Concatenate their sources and transform the "
+                "result instead.")
+        return batch
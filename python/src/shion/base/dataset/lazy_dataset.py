@@ -1,7 +1,11 @@
-from typing import Callable
+from typing import Callable, List
 
+import torch
 from torch.utils.data import Dataset
 
+from shion.base.dataset.util import get_dataset_batch
+from shion.core.training.util import apply_batch_xform, needs_batch_xform
+
 
 class LazyDataset(Dataset):
     def __init__(self, source_func: Callable[[], Dataset]):
@@ -18,3 +22,12 @@ class LazyDataset(Dataset):
 
     def __getitem__(self, item):
         return self.get_source()[item]
+
+    def get_batch(self, example_indices: torch.Tensor):
+        return get_dataset_batch(self.get_source(), example_indices)
+
+    def needs_batch_xform(self) -> bool:
+        return needs_batch_xform(self.get_source())
+
+    def xform_batch(self, batch: List[torch.Tensor], epoch: int) -> List[torch.Tensor]:
+        return apply_batch_xform(self.get_source(), batch, epoch)
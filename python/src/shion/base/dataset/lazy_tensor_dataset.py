@@ -1,6 +1,7 @@
 import torch
 from torch.utils.data import Dataset, TensorDataset
 
+from shion.base.dataset.util import get_dataset_batch
 from shion.core.load_save import torch_load
 
 
@@ -30,4 +31,7 @@ class LazyTensorDataset(Dataset):
         dataset = self.get_dataset()
         return dataset.__getitem__(item)
 
+    def get_batch(self, example_indices: torch.Tensor):
+        return get_dataset_batch(self.get_dataset(), example_indices)
+
 
@@ -0,0 +1,236 @@
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import struct
+import time
+from typing import List, Optional, Sequence, Callable
+
+import numpy
+import torch
+from torch.utils.data import Dataset
+
+from shion.core.load_save import torch_load
+
+MMAP_TENSOR_FILE_MAGIC = b"SHIONMMT"
+MMAP_TENSOR_FILE_ALIGNMENT = 64
+
+TORCH_DTYPE_TO_STORAGE_DTYPE_NAME = {
+    torch.float64: "float64",
+    torch.float32: "float32",
+    torch.float16: "float16",
+    torch.bfloat16: "int16",
+    torch.int64: "int64",
+    torch.int32: "int32",
+    torch.int16: "int16",
+    torch.int8: "int8",
+    torch.uint8: "uint8",
+    torch.bool: "bool",
+}
+
+TORCH_DTYPE_NAME_TO_TORCH_DTYPE = {
+    str(dtype): dtype for dtype in TORCH_DTYPE_TO_STORAGE_DTYPE_NAME.keys()
+}
+
+
+def get_aligned_offset(offset: int, alignment: int = MMAP_TENSOR_FILE_ALIGNMENT) -> int:
+    return ((offset + alignment - 1) // alignment) * alignment
+
+
+def save_mmap_tensors(tensors: Sequence[torch.Tensor], file_name: str):
+    entries = []
+    arrays = []
+    for tensor in tensors:
+        if tensor.dtype not in TORCH_DTYPE_TO_STORAGE_DTYPE_NAME:
+            raise RuntimeError(f"save_mmap_tensors: Tensors of type {tensor.dtype} are not supported.")
+        tensor = tensor.detach().cpu().contiguous()
+        if tensor.dtype == torch.bfloat16:
+            array = tensor.view(torch.int16).numpy()
+        else:
+            array = tensor.numpy()
+        entries.append({
+            "dtype": str(tensor.dtype),
+            "shape": list(tensor.shape),
+            "nbytes": int(array.nbytes),
+        })
+        arrays.append(array)
+
+    # The header size depends on the offsets, so lay out the data after a header of a fixed upper bound.
+    header_capacity = get_aligned_offset(len(json.dumps({"tensors": entries})) + 64 * (len(entries) + 1))
+    offset = get_aligned_offset(len(MMAP_TENSOR_FILE_MAGIC) + 8 + header_capacity)
+    for entry in entries:
+        entry["offset"] = offset
+        offset = get_aligned_offset(offset + entry["nbytes"])
+    header = json.dumps({"tensors": entries}).encode("utf-8")
+    assert len(header) <= header_capacity
+
+    dirname = os.path.dirname(file_name)
+    if dirname != "":
+        os.makedirs(dirname, exist_ok=True)
+    temp_file_name = f"{file_name}.tmp.{os.getpid()}"
+    with open(temp_file_name, "wb") as fout:
+        fout.write(MMAP_TENSOR_FILE_MAGIC)
+        fout.write(struct.pack("<Q", len(header)))
+        fout.write(header)
+        for entry, array in zip(entries, arrays):
+            fout.seek(entry["offset"])
+            fout.write(memoryview(array.reshape(-1)).cast("B"))
+        fout.truncate(offset)
+    os.replace(temp_file_name, file_name)
+
+
+def load_mmap_tensor_header(file_name: str) -> List[dict]:
+    with open(file_name, "rb") as fin:
+        magic = fin.read(len(MMAP_TENSOR_FILE_MAGIC))
+        if magic != MMAP_TENSOR_FILE_MAGIC:
+            raise RuntimeError(f"{file_name} is not a memory-mapped tensor file.")
+        header_length = struct.unpack("<Q", fin.read(8))[0]
+        header = json.loads(fin.read(header_length).decode("utf-8"))
+    return header["tensors"]
+
+
+def load_mmap_tensors(file_name: str) -> List[torch.Tensor]:
+    entries = load_mmap_tensor_header(file_name)
+    # Copy-on-write mapping: pages are shared with the page cache (and so with every other process that maps the
+    # same file) until somebody writes to them.
+    mapped = numpy.memmap(file_name, dtype=numpy.uint8, mode='c')
+    tensors = []
+    for entry in entries:
+        dtype = TORCH_DTYPE_NAME_TO_TORCH_DTYPE[entry["dtype"]]
+        storage_dtype = numpy.dtype(TORCH_DTYPE_TO_STORAGE_DTYPE_NAME[dtype])
+        begin = entry["offset"]
+        end = begin + entry["nbytes"]
+        array = mapped[begin:end].view(storage_dtype).reshape(entry["shape"])
+        tensor = torch.from_numpy(array)
+        if dtype == torch.bfloat16:
+            tensor = tensor.view(torch.bfloat16)
+        tensors.append(tensor)
+    return tensors
+
+
+def convert_torch_file_to_mmap_tensor_file(source_file_name: str, target_file_name: str):
+    data = torch_load(source_file_name)
+    if isinstance(data, torch.Tensor):
+        tensors = [data]
+    elif isinstance(data, tuple) or isinstance(data, list):
+        tensors = list(data)
+    else:
+        raise RuntimeError("Unsupported data type: " + str(type(data)))
+    save_mmap_tensors(tensors, target_file_name)
+    logging.info(f"Converted {source_file_name} to {target_file_name}")
+
+
+def get_digest(key: str) -> str:
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def get_shared_memory_file_prefix(file_name: str, shm_dir: str) -> str:
+    # Every copy of the same source file starts with this prefix, whatever version of the file it holds.
+    return os.path.join(shm_dir, f"shion_{get_digest(os.path.abspath(file_name))}_")
+
+
+def get_shared_memory_file_name(file_name: str, shm_dir: str) -> str:
+    # The name changes with the size and modification time of the source, so a changed file gets a new copy.
+    stat = os.stat(file_name)
+    version = get_digest("%d:%d" % (stat.st_size, stat.st_mtime_ns))
+    return get_shared_memory_file_prefix(file_name, shm_dir) + f"{version}_{os.path.basename(file_name)}"
+
+
+def remove_shared_memory_files(file_name: str, shm_dir: str = "/dev/shm", keep: Optional[str] = None):
+    # Removes the copies of file_name in shm_dir, except keep. Processes that have a copy mapped keep their mapping,
+    # and the memory is freed when the last of them unmaps it.
+    for shm_file_name in glob.glob(glob.escape(get_shared_memory_file_prefix(file_name, shm_dir)) + "*"):
+        if shm_file_name == keep or shm_file_name == f"{keep}.lock":
+            continue
+        try:
+            os.remove(shm_file_name)
+            logging.info(f"Removed {shm_file_name}")
+        except FileNotFoundError:
+            pass
+
+
+def create_file_once(file_name: str, create_func: Callable[[], None], poll_interval: float = 0.1):
+    # Only one process per node runs create_func. Everybody else waits for the lock and then finds the file.
+    if os.path.isfile(file_name):
+        return
+    dirname = os.path.dirname(file_name)
+    if dirname != "":
+        os.makedirs(dirname, exist_ok=True)
+    lock_file_name = file_name + ".lock"
+    with open(lock_file_name, "a") as lock_file:
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(poll_interval)
+        try:
+            if not os.path.isfile(file_name):
+                create_func()
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def populate_shared_memory_file(file_name: str, shm_dir: str = "/dev/shm", poll_interval: float = 0.1) -> str:
+    shm_file_name = get_shared_memory_file_name(file_name, shm_dir)
+
+    def copy_file():
+        # Copies of older versions of the file would otherwise hold on to RAM until reboot.
+        remove_shared_memory_files(file_name, shm_dir, keep=shm_file_name)
+        temp_file_name = f"{shm_file_name}.tmp.{os.getpid()}"
+        shutil.copyfile(file_name, temp_file_name)
+        os.replace(temp_file_name, shm_file_name)
+        logging.info(f"Copied {file_name} to {shm_file_name}")
+
+    create_file_once(shm_file_name, copy_file, poll_interval)
+    if os.path.getsize(shm_file_name) != os.path.getsize(file_name):
+        raise RuntimeError(f"{shm_file_name} does not have the same size as {file_name}. Remove it and try again.")
+    return shm_file_name
+
+
+class MmapTensorDataset(Dataset):
+    def __init__(self, file_name: str, shm_dir: Optional[str] = None):
+        self.shm_dir = shm_dir
+        self.file_name = file_name
+        self.tensors = None
+        self.length = None
+
+    def get_mapped_file_name(self) -> str:
+        if self.shm_dir is None:
+            return self.file_name
+        else:
+            return populate_shared_memory_file(self.file_name, self.shm_dir)
+
+    def remove_shared_memory_files(self):
+        if self.shm_dir is not None:
+            remove_shared_memory_files(self.file_name, self.shm_dir)
+
+    def get_tensors(self) -> List[torch.Tensor]:
+        if self.tensors is None:
+            self.tensors = load_mmap_tensors(self.get_mapped_file_name())
+            assert len(self.tensors) > 0
+            assert all(tensor.shape[0] == self.tensors[0].shape[0] for tensor in self.tensors)
+        return self.tensors
+
+    def __len__(self):
+        if self.length is None:
+            if self.tensors is not None:
+                self.length = self.tensors[0].shape[0]
+            else:
+                self.length = load_mmap_tensor_header(self.file_name)[0]["shape"][0]
+        return self.length
+
+    def __getitem__(self, item):
+        return tuple(tensor[item] for tensor in self.get_tensors())
+
+    def get_batch(self, example_indices: torch.Tensor):
+        return [tensor.index_select(0, example_indices) for tensor in self.get_tensors()]
+
+    def __getstate__(self):
+        # Each DataLoader worker maps the file by itself instead of receiving a pickled copy of the data.
+        state = self.__dict__.copy()
+        state["tensors"] = None
+        return state
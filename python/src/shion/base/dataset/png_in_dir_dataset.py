@@ -1,22 +1,68 @@
+import hashlib
+import json
+import logging
 import os
+from typing import Optional, Dict, List
 
+import torch
+from torch import Tensor
 from torch.nn import functional
 from torch.utils.data import Dataset
 from os import listdir
 from os.path import isfile
 
-from shion.base.image_util import extract_pytorch_image_from_filelike
+from shion.base.dataset.mmap_tensor_dataset import save_mmap_tensors, load_mmap_tensors, create_file_once
+from shion.base.image_util import extract_pytorch_image_from_filelike, extract_uint8_pytorch_image_from_filelike, \
+    torch_srgb_uint8_to_linear, extract_pytorch_images_from_files, torch_linear_to_srgb
+
+PNG_IN_DIR_CACHE_VERSION = 2
 
 
 class PngInDirDataset(Dataset):
-    def __init__(self, dir: str, downscale_kernel_size: int = 1, has_alpha=False, scale=2.0, offset=-1.0):
+    """
+    The PNG files in a directory, as images in linear color space with premultiplied alpha.
+
+    If cache_dir is given, decoded images are stored in memory-mapped shards of cache_shard_size images under a
+    directory named after the file names, sizes and modification times and the decoding parameters. A shard is made
+    the first time one of its images is read, or by build_cache(), and later reads are views into the mapping. With
+    cache_dtype float16, a shard holds the linearized, premultiplied and downscaled images. With uint8, it holds sRGB
+    pixels with straight alpha, which takes less space but leaves the conversion to linear color to be done at read
+    time. The images are downscaled in linear color before they are quantized, so the shards are no larger than the
+    images that are read. All images must then have the same size and number of channels.
+
+    With defer_conversion, items are returned as stored in the cache, and convert_batch() turns a batch of them into
+    final images. The trainers do this through xform_batch() once the batch is on the training device. LazyDataset
+    and XformedDataset pass the call on to their sources, and ConcatenatedDataset raises instead of skipping it.
+    """
+
+    def __init__(self,
+                 dir: str,
+                 downscale_kernel_size: int = 1,
+                 has_alpha=False,
+                 scale=2.0,
+                 offset=-1.0,
+                 cache_dir: Optional[str] = None,
+                 cache_dtype: torch.dtype = torch.float16,
+                 cache_shard_size: int = 256,
+                 defer_conversion: bool = False):
         super().__init__()
+        if cache_dtype not in [torch.float16, torch.uint8]:
+            raise RuntimeError(f"PngInDirDataset: cache_dtype must be torch.float16 or torch.uint8, not {cache_dtype}")
+        if defer_conversion and cache_dir is None:
+            raise RuntimeError("PngInDirDataset: defer_conversion requires cache_dir.")
+        self.defer_conversion = defer_conversion
+        self.cache_shard_size = cache_shard_size
+        self.cache_dtype = cache_dtype
+        self.cache_dir = cache_dir
         self.offset = offset
         self.scale = scale
         self.has_alpha = has_alpha
         self.downscale_kernel_size = downscale_kernel_size
         self.dir = dir
         self.file_names = None
+        self.cache_key = None
+        self.uint8_image_shape = None
+        self.cache_shards: Dict[int, Tensor] = {}
 
     def get_file_names(self):
         if self.file_names is None:
@@ -28,15 +74,128 @@ class PngInDirDataset(Dataset):
         file_names = self.get_file_names()
         return len(file_names)
 
-    def __getitem__(self, item):
-        file_names = self.get_file_names()
-        file_name = file_names[item]
+    def decode_image(self, file_name: str) -> Tensor:
         image = extract_pytorch_image_from_filelike(
             file_name,
             scale=self.scale,
             offset=self.offset)
         if self.downscale_kernel_size == 1:
-            return [image]
+            return image
         else:
-            image = functional.avg_pool2d(image.unsqueeze(0), kernel_size=self.downscale_kernel_size).squeeze(0)
+            return functional.avg_pool2d(image.unsqueeze(0), kernel_size=self.downscale_kernel_size).squeeze(0)
+
+    @staticmethod
+    def uint8_to_linear_premultiplied(batch: Tensor) -> Tensor:
+        rgb = torch_srgb_uint8_to_linear(batch[:, 0:3])
+        if batch.shape[1] == 4:
+            alpha = batch[:, 3:4].float() / 255.0
+            return torch.cat([rgb * alpha, alpha], dim=1)
+        else:
+            return rgb
+
+    @staticmethod
+    def linear_premultiplied_to_uint8(images: Tensor) -> Tensor:
+        rgb = images[:, 0:3]
+        if images.shape[1] == 4:
+            alpha = images[:, 3:4]
+            rgb = torch.where(alpha > 0, rgb / alpha.clamp(min=1e-8), torch.zeros_like(rgb))
+            channels = [torch_linear_to_srgb(rgb), alpha.clamp(0.0, 1.0)]
+        else:
+            channels = [torch_linear_to_srgb(rgb)]
+        return torch.round(torch.cat(channels, dim=1) * 255.0).to(torch.uint8)
+
+    def convert_batch(self, batch: Tensor) -> Tensor:
+        if self.cache_dtype == torch.float16:
+            return batch.float() * self.scale + self.offset
+        return PngInDirDataset.uint8_to_linear_premultiplied(batch) * self.scale + self.offset
+
+    def needs_batch_xform(self) -> bool:
+        return self.defer_conversion
+
+    def xform_batch(self, batch: List[Tensor], epoch: int) -> List[Tensor]:
+        if not self.defer_conversion:
+            return batch
+        return [self.convert_batch(batch[0])]
+
+    def get_cache_key(self) -> str:
+        if self.cache_key is None:
+            files = []
+            for file_name in self.get_file_names():
+                stat = os.stat(file_name)
+                files.append([os.path.basename(file_name), stat.st_size, stat.st_mtime_ns])
+            key = json.dumps({
+                "version": PNG_IN_DIR_CACHE_VERSION,
+                "dir": os.path.abspath(self.dir),
+                "files": files,
+                "downscale_kernel_size": self.downscale_kernel_size,
+                "cache_dtype": str(self.cache_dtype),
+                "cache_shard_size": self.cache_shard_size,
+            })
+            self.cache_key = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        return self.cache_key
+
+    def get_uint8_image_shape(self) -> torch.Size:
+        if self.uint8_image_shape is None:
+            self.uint8_image_shape = extract_uint8_pytorch_image_from_filelike(self.get_file_names()[0]).shape
+        return self.uint8_image_shape
+
+    def get_num_cache_shards(self) -> int:
+        return (len(self) + self.cache_shard_size - 1) // self.cache_shard_size
+
+    def get_cache_shard_file_name(self, shard_index: int) -> str:
+        return os.path.join(self.cache_dir, self.get_cache_key(), "shard_%06d.mmt" % shard_index)
+
+    def build_cache_shard(self, shard_index: int):
+        file_names = self.get_file_names()
+        begin = shard_index * self.cache_shard_size
+        end = min(begin + self.cache_shard_size, len(file_names))
+        if self.cache_dtype == torch.uint8:
+            images = [extract_uint8_pytorch_image_from_filelike(file_names[i]) for i in range(begin, end)]
+            # Compared with the first image of the whole dataset, so that all shards agree.
+            expected_shape = self.get_uint8_image_shape()
+            if any(image.shape != expected_shape for image in images):
+                raise RuntimeError(
+                    f"PngInDirDataset: The images in {self.dir} do not all have the same size and number of channels, "
+                    f"so they cannot be cached.")
+            images = torch.stack(images)
+            if self.downscale_kernel_size != 1:
+                images = functional.avg_pool2d(
+                    PngInDirDataset.uint8_to_linear_premultiplied(images), kernel_size=self.downscale_kernel_size)
+                images = PngInDirDataset.linear_premultiplied_to_uint8(images)
+        else:
+            images = extract_pytorch_images_from_files(file_names[begin:end], scale=1.0, offset=0.0)
+            if self.downscale_kernel_size != 1:
+                images = functional.avg_pool2d(images, kernel_size=self.downscale_kernel_size)
+            images = images.to(torch.float16)
+        shard_file_name = self.get_cache_shard_file_name(shard_index)
+        save_mmap_tensors([images], shard_file_name)
+        logging.info(f"Cached {end - begin} images of {self.dir} in {shard_file_name}")
+
+    def get_cache_shard(self, shard_index: int) -> Tensor:
+        if shard_index not in self.cache_shards:
+            shard_file_name = self.get_cache_shard_file_name(shard_index)
+            create_file_once(shard_file_name, lambda: self.build_cache_shard(shard_index))
+            self.cache_shards[shard_index] = load_mmap_tensors(shard_file_name)[0]
+        return self.cache_shards[shard_index]
+
+    def build_cache(self):
+        for shard_index in range(self.get_num_cache_shards()):
+            self.get_cache_shard(shard_index)
+
+    def __getitem__(self, item):
+        if self.cache_dir is None:
+            return [self.decode_image(self.get_file_names()[item])]
+        if item < 0:
+            item += len(self)
+        shard = self.get_cache_shard(item // self.cache_shard_size)
+        image = shard[item % self.cache_shard_size]
+        if self.defer_conversion:
             return [image]
+        else:
+            return [self.convert_batch(image.unsqueeze(0)).squeeze(0)]
+
+    def __getstate__(self):
+        # Each DataLoader worker maps the shards by itself.
+        state = self.__dict__.copy()
+        state["cache_shards"] = {}
+        return state
@@ -1,12 +1,44 @@
-from typing import List
+from typing import List, Optional
 
 import torch
-from torch.utils.data import Dataset
+from torch import Tensor
+from torch.utils.data import Dataset, TensorDataset
+
+from shion.core.training.util import apply_batch_xform
+
+
+def get_dataset_batch(dataset: Dataset, example_indices: Tensor) -> Optional[List[Tensor]]:
+    # Datasets backed by tensors gather all the examples at once: a TensorDataset directly, and other datasets through
+    # a get_batch(example_indices) method that returns None when they cannot. example_indices must not be negative.
+    if isinstance(dataset, TensorDataset):
+        return [tensor.index_select(0, example_indices.to(tensor.device)) for tensor in dataset.tensors]
+    get_batch = getattr(dataset, "get_batch", None)
+    if get_batch is None:
+        return None
+    return get_batch(example_indices)
+
+
+def merge_batches(positions: List[Tensor], batches: List[List[Tensor]]) -> List[Tensor]:
+    # Puts example j of batches[i] at position positions[i][j] of the merged batch.
+    merged_positions = torch.cat(positions)
+    merged = []
+    for field_index in range(len(batches[0])):
+        values = torch.cat([batch[field_index] for batch in batches])
+        field = torch.empty_like(values)
+        field[merged_positions.to(values.device)] = values
+        merged.append(field)
+    return merged
 
 
 def get_indexed_batch(dataset: Dataset, example_indices: List[int], device: torch.device):
     if len(example_indices) == 0:
         return []
+    indices = torch.tensor(example_indices, dtype=torch.long)
+    indices = torch.where(indices < 0, indices + len(dataset), indices)
+    batch = get_dataset_batch(dataset, indices)
+    if batch is not None:
+        return apply_batch_xform(dataset, [x.to(device) for x in batch], 0)
+
     examples = []
     for index in range(len(example_indices)):
         example_index = example_indices[index]
@@ -26,4 +58,4 @@ def get_indexed_batch(dataset: Dataset, example_indices: List[int], device: torc
     for example in examples:
         for i in range(k):
             transposed[i].append(example[i])
-    return [torch.cat(x, dim=0) for x in transposed]
+    return apply_batch_xform(dataset, [torch.cat(x, dim=0) for x in transposed], 0)
@@ -1,10 +1,84 @@
-from typing import Any, Callable
+import math
+from typing import Any, Callable, Optional, List
 
+import torch
 from torch.utils.data import Dataset
 
+from shion.base.dataset.util import get_dataset_batch
+from shion.core.training.util import apply_batch_xform, needs_batch_xform
+
+
+UINT32_MASK = 0xFFFFFFFF
+
+
+def hash_uint32(x: torch.Tensor) -> torch.Tensor:
+    # The PCG output permutation on int64 tensors holding 32-bit values. No intermediate result reaches 2^63.
+    x = (x * 747796405 + 2891336453) & UINT32_MASK
+    word = (((x >> ((x >> 28) + 4)) ^ x) * 277803737) & UINT32_MASK
+    return (word >> 22) ^ word
+
+
+class PerExampleRandom:
+    """
+    Random numbers for a batch of examples, where the numbers an example gets depend only on the seed, the epoch, the
+    index of the example and how many draws came before, and not on the batch it is in or the device. The numbers are
+    hashes of these values, so they are computed for the whole batch at once on the device of example_indices.
+    """
+
+    def __init__(self, seed: int, epoch: int, example_indices: torch.Tensor):
+        key = hash_uint32(torch.full_like(example_indices, seed & UINT32_MASK))
+        key = hash_uint32(key ^ (epoch & UINT32_MASK))
+        self.keys = hash_uint32(key ^ (example_indices.long() & UINT32_MASK))
+        self.num_draws = 0
+
+    def draw_uint32(self, num_values: int) -> torch.Tensor:
+        key = hash_uint32(self.keys ^ self.num_draws)
+        self.num_draws += 1
+        counter = torch.arange(num_values, dtype=torch.long, device=key.device)
+        return hash_uint32(key.unsqueeze(1) ^ counter.unsqueeze(0))
+
+    def rand(self, *shape: int) -> torch.Tensor:
+        # Uniform in [0, 1) with 24 random bits, shape (batch_size, *shape).
+        num_values = 1
+        for size in shape:
+            num_values *= size
+        values = (self.draw_uint32(num_values) >> 8).float() * (1.0 / (1 << 24))
+        return values.view(self.keys.shape[0], *shape)
+
+    def randn(self, *shape: int) -> torch.Tensor:
+        # Box-Muller transform.
+        u0 = self.rand(*shape)
+        u1 = self.rand(*shape)
+        return torch.sqrt(-2.0 * torch.log1p(-u0)) * torch.cos(2.0 * math.pi * u1)
+
 
 class XformedDataset(Dataset):
-    def __init__(self, source: Dataset, xform_func: Callable[[Any], Any]):
+    """
+    The examples of source, transformed.
+
+    xform_func, if given, transforms each example inside the DataLoader workers. batch_xform_func, if given, does to a
+    batch of examples what xform_func does to each of them, so that batches can be gathered at once from sources backed
+    by tensors. Without it, batches are fetched one example at a time.
+
+    device_xform_func, if given, is a second stage that runs on whole batches after they are collated and moved to the
+    training device. Examples then carry their index as an extra last field, and the trainers call xform_batch() on
+    each batch they fetch, which drops the index and calls device_xform_func(batch, random). An example that is not a
+    list or a tuple becomes a list of one field. If the source transforms its own batches on the device, that is done
+    first. Draws from random, a
+    PerExampleRandom, give every example the same numbers no matter which batch or device it ends up in, so results do
+    not depend on the batch size or the number of replicas.
+    """
+
+    def __init__(self,
+                 source: Dataset,
+                 xform_func: Optional[Callable[[Any], Any]] = None,
+                 batch_xform_func: Optional[Callable[[List[torch.Tensor]], List[torch.Tensor]]] = None,
+                 device_xform_func: Optional[
+                     Callable[[List[torch.Tensor], PerExampleRandom], List[torch.Tensor]]] = None,
+                 seed: int = 0):
+        self.seed = seed
+        self.device_xform_func = device_xform_func
+        self.batch_xform_func = batch_xform_func
         self.xform_func = xform_func
         self.source = source
 
@@ -12,4 +86,47 @@ class XformedDataset(Dataset):
         return len(self.source)
 
     def __getitem__(self, item):
-        return self.xform_func(self.source[item])
+        example = self.source[item]
+        if self.xform_func is not None:
+            example = self.xform_func(example)
+        if self.device_xform_func is None:
+            return example
+        if item < 0:
+            item += len(self)
+        if isinstance(example, (list, tuple)):
+            example = list(example)
+        else:
+            example = [example]
+        example.append(torch.tensor(item, dtype=torch.long))
+        return example
+
+    def get_batch(self, example_indices: torch.Tensor):
+        if self.xform_func is not None and self.batch_xform_func is None:
+            return None
+        batch = get_dataset_batch(self.source, example_indices)
+        if batch is None:
+            return None
+        if self.batch_xform_func is not None:
+            batch = self.batch_xform_func(batch)
+        if self.device_xform_func is not None:
+            batch = batch + [example_indices]
+        return batch
+
+    def needs_batch_xform(self) -> bool:
+        return self.device_xform_func is not None or needs_batch_xform(self.source)
+
+    def xform_source_batch(self, batch: List[torch.Tensor], epoch: int) -> List[torch.Tensor]:
+        if not needs_batch_xform(self.source):
+            return batch
+        if self.xform_func is not None or self.batch_xform_func is not None:
+            # The source's batch transform would run after ours, on examples it does not expect.
+            raise RuntimeError(
+                "XformedDataset: The source transforms whole batches on the training device, so it cannot be combined "
+                "with xform_func or batch_xform_func. Use device_xform_func instead.")
+        return apply_batch_xform(self.source, batch, epoch)
+
+    def xform_batch(self, batch: List[torch.Tensor], epoch: int) -> List[torch.Tensor]:
+        if self.device_xform_func is None:
+            return self.xform_source_batch(batch, epoch)
+        random = PerExampleRandom(self.seed, epoch, batch[-1])
+        return self.device_xform_func(self.xform_source_batch(batch[:-1], epoch), random)
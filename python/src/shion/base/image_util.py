@@ -1,4 +1,6 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 import PIL.Image
 import numpy
@@ -16,6 +18,20 @@ def numpy_linear_to_srgb(x):
     return numpy.where(x <= 0.003130804953560372, x * 12.92, 1.055 * (x ** (1.0 / 2.4)) - 0.055)
 
 
+# Pixel values of 8-bit images have only 256 possible values, so their conversions are looked up instead of computed.
+# The tables are made with the functions above, so the results are bit-identical to converting the float images.
+NUMPY_UINT8_TO_UNIT_FLOAT_LUT = numpy.arange(256, dtype=numpy.float32) / 255.0
+NUMPY_SRGB_UINT8_TO_LINEAR_LUT = numpy_srgb_to_linear(NUMPY_UINT8_TO_UNIT_FLOAT_LUT)
+
+
+def numpy_uint8_to_unit_float(x):
+    return NUMPY_UINT8_TO_UNIT_FLOAT_LUT[x]
+
+
+def numpy_srgb_uint8_to_linear(x):
+    return NUMPY_SRGB_UINT8_TO_LINEAR_LUT[x]
+
+
 def numpy_alpha_devide(rgb, a, epsilon=1e-5):
     aaa = numpy.repeat(a, 3, axis=2)
     aaa_prime = aaa + numpy.where(numpy.abs(aaa) < epsilon, epsilon, 0.0)
@@ -32,6 +48,25 @@ def torch_linear_to_srgb(x):
     return torch.where(torch.le(x, 0.003130804953560372), x * 12.92, 1.055 * (x ** (1.0 / 2.4)) - 0.055)
 
 
+TORCH_SRGB_UINT8_TO_LINEAR_LUTS = {}
+
+
+def get_torch_srgb_uint8_to_linear_lut(device: torch.device) -> torch.Tensor:
+    # Built on the device it is used on, so that it matches torch_srgb_to_linear there.
+    if device not in TORCH_SRGB_UINT8_TO_LINEAR_LUTS:
+        x = torch.arange(256, dtype=torch.float32, device=device) / 255.0
+        TORCH_SRGB_UINT8_TO_LINEAR_LUTS[device] = torch_srgb_to_linear(x)
+    return TORCH_SRGB_UINT8_TO_LINEAR_LUTS[device]
+
+
+def torch_srgb_uint8_to_linear(x: torch.Tensor) -> torch.Tensor:
+    # Same as torch_srgb_to_linear(x.float() / 255.0) for a uint8 tensor of any shape, e.g. a batch of images.
+    assert x.dtype == torch.uint8
+    # index_select takes int32 indices, which avoids the int64 copy of the whole input that lut[x.long()] makes.
+    lut = get_torch_srgb_uint8_to_linear_lut(x.device)
+    return lut.index_select(0, x.reshape(-1).int()).reshape(x.shape)
+
+
 def numpy_image_linear_to_srgb(image):
     assert image.shape[2] == 3 or image.shape[2] == 4
     if image.shape[2] == 3:
@@ -123,14 +158,37 @@ def pil_image_has_transparency(pil_image):
     return False
 
 
-def extract_numpy_image_from_PIL_image(pil_image, scale=2.0, offset=-1.0,
-                                       premultiply_alpha=True,
-                                       perform_srgb_to_linear=True):
+def convert_PIL_image_to_RGB_or_RGBA(pil_image):
     has_alpha = pil_image_has_transparency(pil_image)
     if has_alpha and pil_image.mode != 'RGBA':
         pil_image = pil_image.convert("RGBA")
     if not has_alpha and pil_image.mode != 'RGB':
         pil_image = pil_image.convert("RGB")
+    return pil_image
+
+
+def read_uint8_numpy_image(file) -> numpy.ndarray:
+    # The pixels as stored, with shape (height, width, num_channel). The file is closed before returning.
+    try:
+        pil_image = PIL.Image.open(file)
+    except Exception as e:
+        raise RuntimeError(file)
+    with pil_image:
+        pil_image = convert_PIL_image_to_RGB_or_RGBA(pil_image)
+        return numpy.array(pil_image, dtype=numpy.uint8).reshape(pil_image.height, pil_image.width, -1)
+
+
+def extract_uint8_pytorch_image_from_filelike(file):
+    # The pixels as stored, in sRGB and with straight alpha, with shape (num_channel, height, width).
+    raw_image = read_uint8_numpy_image(file)
+    return torch.from_numpy(raw_image).permute(2, 0, 1).contiguous()
+
+
+def extract_numpy_image_from_PIL_image(pil_image, scale=2.0, offset=-1.0,
+                                       premultiply_alpha=True,
+                                       perform_srgb_to_linear=True):
+    pil_image = convert_PIL_image_to_RGB_or_RGBA(pil_image)
+    has_alpha = pil_image.mode == 'RGBA'
     if has_alpha:
         num_channel = 4
     else:
@@ -138,10 +196,10 @@ def extract_numpy_image_from_PIL_image(pil_image, scale=2.0, offset=-1.0,
     image_width = pil_image.width
     image_height = pil_image.height
 
-    raw_image = numpy.asarray(pil_image, dtype=numpy.float32)
-    image = (raw_image / 255.0).reshape(image_height, image_width, num_channel)
+    raw_image = numpy.asarray(pil_image, dtype=numpy.uint8).reshape(image_height, image_width, num_channel)
+    image = numpy_uint8_to_unit_float(raw_image)
     if perform_srgb_to_linear:
-        image[:, :, 0:3] = numpy_srgb_to_linear(image[:, :, 0:3])
+        image[:, :, 0:3] = numpy_srgb_uint8_to_linear(raw_image[:, :, 0:3])
     # Premultiply alpha
     if has_alpha and premultiply_alpha:
         image[:, :, 0:3] = image[:, :, 0:3] * image[:, :, 3:4]
@@ -190,6 +248,62 @@ def extract_pytorch_image_from_filelike(file, scale=2.0, offset=-1.0, premultipl
     return torch.from_numpy(image).float()
 
 
+def extract_image_into_pytorch_layout_array(file, out, scale=2.0, offset=-1.0, premultiply_alpha=True,
+                                            perform_srgb_to_linear=True):
+    # Writes what extract_numpy_image_from_PIL_image_with_pytorch_layout would return into out, a float32 array of
+    # shape (num_channel, height, width), without allocating any float image along the way.
+    raw_image = read_uint8_numpy_image(file)
+    if (raw_image.shape[2],) + raw_image.shape[0:2] != out.shape:
+        raise RuntimeError(
+            f"{file}: An image of shape {tuple(raw_image.shape)} (height, width, channel) does not fit in an array of "
+            f"shape {tuple(out.shape)} (channel, height, width).")
+    raw_image = raw_image.transpose(2, 0, 1)
+    if perform_srgb_to_linear:
+        NUMPY_SRGB_UINT8_TO_LINEAR_LUT.take(raw_image[0:3], out=out[0:3], mode='clip')
+    else:
+        NUMPY_UINT8_TO_UNIT_FLOAT_LUT.take(raw_image[0:3], out=out[0:3], mode='clip')
+    if out.shape[0] == 4:
+        NUMPY_UINT8_TO_UNIT_FLOAT_LUT.take(raw_image[3], out=out[3], mode='clip')
+        if premultiply_alpha:
+            out[0:3] *= out[3:4]
+    out *= scale
+    out += offset
+
+
+def extract_pytorch_images_from_files(file_names, scale=2.0, offset=-1.0, premultiply_alpha=True,
+                                      perform_srgb_to_linear=True, out: Optional[torch.Tensor] = None,
+                                      num_threads: Optional[int] = None) -> torch.Tensor:
+    """
+    Decode the files into a float32 tensor of shape (len(file_names), num_channel, height, width) with the same values
+    as extract_pytorch_image_from_filelike, using a thread pool. PIL releases the GIL while decoding.
+
+    The images must all have the same size and number of channels. If out is given, it must be a contiguous float32
+    CPU tensor of that shape, and the images are written into it.
+    """
+    if out is None:
+        if len(file_names) == 0:
+            raise RuntimeError("extract_pytorch_images_from_files: With no files, out must be given to know the shape.")
+        with PIL.Image.open(file_names[0]) as pil_image:
+            pil_image = convert_PIL_image_to_RGB_or_RGBA(pil_image)
+            num_channel = 4 if pil_image.mode == 'RGBA' else 3
+            out = torch.empty(len(file_names), num_channel, pil_image.height, pil_image.width, dtype=torch.float32)
+    if out.dtype != torch.float32 or out.device.type != "cpu" or not out.is_contiguous():
+        raise RuntimeError("extract_pytorch_images_from_files: out must be a contiguous float32 CPU tensor.")
+    if out.shape[0] != len(file_names):
+        raise RuntimeError(f"extract_pytorch_images_from_files: out has room for {out.shape[0]} images, "
+                           f"but there are {len(file_names)} files.")
+    out_array = out.numpy()
+
+    def extract(index: int):
+        extract_image_into_pytorch_layout_array(
+            file_names[index], out_array[index], scale, offset, premultiply_alpha, perform_srgb_to_linear)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        # list() so that exceptions raised in the threads are raised here.
+        list(executor.map(extract, range(len(file_names))))
+    return out
+
+
 def extract_pytorch_image_from_PIL_image(pil_image, scale=2.0, offset=-1.0, premultiply_alpha=True,
                                          perform_srgb_to_linear=True):
     image = extract_numpy_image_from_PIL_image_with_pytorch_layout(
@@ -1,6 +1,6 @@
-from typing import Optional, Callable
+from typing import Optional, Callable, List
 
-from shion.core.cached_computation import TensorCachedComputationFunc, ComputationState
+from shion.core.cached_computation import TensorCachedComputationFunc, ComputationState, get_funcs_read_keys
 from shion.core.loss import Loss
 
 
@@ -13,10 +13,17 @@ class ComputedScaleLoss(Loss):
         self.loss = loss
         self.scale_func = scale_func
 
+    def get_read_keys(self) -> Optional[List[str]]:
+        loss_read_keys = self.loss.get_read_keys()
+        scale_read_keys = get_funcs_read_keys([self.scale_func])
+        if loss_read_keys is None or scale_read_keys is None:
+            return None
+        return loss_read_keys + scale_read_keys
+
     def compute(self, state: ComputationState, log_func: Optional[Callable[[str, float], None]] = None):
         loss = self.loss.compute(state)
         scale = self.scale_func(state)
         loss = self.weight * scale * loss
         if log_func is not None:
-            log_func("loss", loss.item())
+            log_func("loss", loss.detach())
         return loss
@@ -1,8 +1,9 @@
-from typing import Callable, Optional
+from typing import Callable, Optional, List
 
 import torch
+from torch import Tensor
 
-from shion.core.cached_computation import TensorCachedComputationFunc, ComputationState
+from shion.core.cached_computation import TensorCachedComputationFunc, ComputationState, get_funcs_read_keys
 from shion.core.loss import Loss
 
 
@@ -15,15 +16,30 @@ class L1Loss(Loss):
         self.expected_func = expected_func
         self.weight = weight
 
+    def get_read_keys(self) -> Optional[List[str]]:
+        return get_funcs_read_keys([self.expected_func, self.actual_func])
+
     def compute(self, state: ComputationState, log_func: Optional[Callable[[str, float], None]] = None):
         expected = self.expected_func(state)
         actual = self.actual_func(state)
         loss = self.weight * (expected - actual).abs().mean()
         if log_func is not None:
-            log_func("loss", loss.item())
+            log_func("loss", loss.detach())
         return loss
 
 
+def sum_mean_abs_differences(expected: List[Tensor], actual: List[Tensor]) -> Tensor:
+    requires_grad = any(x.requires_grad for x in expected) or any(x.requires_grad for x in actual)
+    if hasattr(torch, "_foreach_sub") and not (torch.is_grad_enabled() and requires_grad):
+        # The _foreach ops launch one kernel per op for the whole list, but they are not differentiable in every
+        # PyTorch version this code runs on, so they are only used when no gradient is needed.
+        differences = torch._foreach_sub(expected, actual)
+        torch._foreach_abs_(differences)
+    else:
+        differences = [(x - y).abs() for (x, y) in zip(expected, actual)]
+    return torch.stack([difference.mean() for difference in differences]).sum()
+
+
 class ListL1Loss(Loss):
     def __init__(self,
                  expected_func: TensorCachedComputationFunc,
@@ -33,16 +49,16 @@ class ListL1Loss(Loss):
         self.expected_func = expected_func
         self.weight = weight
 
+    def get_read_keys(self) -> Optional[List[str]]:
+        return get_funcs_read_keys([self.expected_func, self.actual_func])
+
     def compute(self, state: ComputationState, log_func: Optional[Callable[[str, float], None]] = None):
         expected = self.expected_func(state)
         actual = self.actual_func(state)
         assert len(expected) == len(actual)
-        loss = torch.zeros(1, device=expected[0].device)
-        for i in range(len(expected)):
-            loss += (expected[i] - actual[i]).abs().mean()
-        loss = self.weight * loss
+        loss = self.weight * sum_mean_abs_differences(list(expected), list(actual)).reshape(1)
         if log_func is not None:
-            log_func("loss", loss.item())
+            log_func("loss", loss.detach())
         return loss
 
 
@@ -57,11 +73,14 @@ class MaskedL1Loss(Loss):
         self.expected_func = expected_func
         self.weight = weight
 
+    def get_read_keys(self) -> Optional[List[str]]:
+        return get_funcs_read_keys([self.mask_func, self.expected_func, self.actual_func])
+
     def compute(self, state: ComputationState, log_func: Optional[Callable[[str, float], None]] = None):
         mask = self.mask_func(state)
         expected = self.expected_func(state)
         actual = self.actual_func(state)
         loss = self.weight * ((expected - actual) * mask).abs().mean()
         if log_func is not None:
-            log_func("loss", loss.item())
+            log_func("loss", loss.detach())
         return loss
\ No newline at end of file
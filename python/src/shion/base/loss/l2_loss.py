@@ -1,6 +1,6 @@
-from typing import Callable, Optional
+from typing import Callable, Optional, List
 
-from shion.core.cached_computation import TensorCachedComputationFunc, ComputationState
+from shion.core.cached_computation import TensorCachedComputationFunc, ComputationState, get_funcs_read_keys
 from shion.core.loss import Loss
 
 
@@ -13,6 +13,9 @@ class L2Loss(Loss):
         self.expected_func = expected_func
         self.weight = weight
 
+    def get_read_keys(self) -> Optional[List[str]]:
+        return get_funcs_read_keys([self.expected_func, self.actual_func])
+
     def compute(
             self,
             state: ComputationState,
@@ -21,5 +24,5 @@ class L2Loss(Loss):
         actual = self.actual_func(state)
         loss = self.weight * ((expected - actual) ** 2).mean()
         if log_func is not None:
-            log_func("loss", loss.item())
+            log_func("loss", loss.detach())
         return loss
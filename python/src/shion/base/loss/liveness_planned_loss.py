@@ -0,0 +1,58 @@
+import logging
+from typing import Callable, Optional, List, Dict
+
+from torch import Tensor
+
+from shion.core.cached_computation import ComputationState, CachedComputationProtocol
+from shion.core.loss import Loss
+
+
+class LivenessPlannedLoss(Loss):
+    """
+    Computes a loss while dropping each protocol output from the cache right after its last read.
+
+    The plan comes from the reads declared by the loss and by the computation steps. If any of them is not declared,
+    the loss is computed with every output cached, as before. Outputs that are already cached when the loss is
+    computed are never dropped.
+
+    Dropping an output only frees its memory if nothing else references it. Outputs that take part in the autograd
+    graph stay alive until the backward pass, so the savings come from outputs computed without gradients, such as
+    teacher outputs and targets. A dropped output that is still alive can be read again, e.g. by another loss on the
+    same state. Reading one that has been freed raises.
+    """
+
+    def __init__(self, loss: Loss, protocol: CachedComputationProtocol):
+        self.protocol = protocol
+        self.loss = loss
+        self.liveness_plan: Optional[Dict[str, int]] = None
+        self.liveness_plan_created = False
+
+    def get_liveness_plan(self) -> Optional[Dict[str, int]]:
+        if not self.liveness_plan_created:
+            read_keys = self.loss.get_read_keys()
+            if read_keys is not None:
+                self.liveness_plan = self.protocol.create_liveness_plan(read_keys)
+            if self.liveness_plan is None:
+                logging.info("The loss or the protocol does not declare all of its reads. The loss is computed "
+                             "without a liveness plan, and every output stays cached.")
+            self.liveness_plan_created = True
+        return self.liveness_plan
+
+    def get_read_keys(self) -> Optional[List[str]]:
+        return self.loss.get_read_keys()
+
+    def compute(self,
+                state: ComputationState,
+                log_func: Optional[Callable[[str, float], None]] = None) -> Tensor:
+        liveness_plan = self.get_liveness_plan()
+        if liveness_plan is None:
+            return self.loss.compute(state, log_func)
+        if state.remaining_reads is not None:
+            raise RuntimeError(
+                "The state is already being computed under a liveness plan. Put the losses under a single "
+                "LivenessPlannedLoss instead of nesting them.")
+        state.remaining_reads = {key: count for key, count in liveness_plan.items() if key not in state.outputs}
+        try:
+            return self.loss.compute(state, log_func)
+        finally:
+            state.remaining_reads = None
@@ -11,22 +11,45 @@ class SumLoss(Loss):
     def __init__(self, losses: List[Tuple[str, Loss]]):
         self.losses = losses
 
+    def get_read_keys(self) -> Optional[List[str]]:
+        # The terms are computed one after another, so with a liveness plan an output that only early terms read is
+        # freed before the later terms run.
+        read_keys = []
+        for _, loss in self.losses:
+            loss_read_keys = loss.get_read_keys()
+            if loss_read_keys is None:
+                return None
+            read_keys += loss_read_keys
+        return read_keys
+
+    def compute_with_terms(self, state: ComputationState) -> Tuple[Tensor, List[str], Tensor]:
+        if len(self.losses) == 0:
+            loss_value = torch.zeros(1, device=state.batch[0].device)
+            return loss_value, ["loss"], loss_value.detach()
+
+        term_values = []
+        names = []
+        component_values = []
+        for loss_name, loss in self.losses:
+            term_value, term_names, term_component_values = loss.compute_with_terms(state)
+            if term_value.numel() != 1:
+                raise RuntimeError(
+                    f"The {loss_name} term has shape {list(term_value.shape)}. Each term of a SumLoss must have a "
+                    f"single element.")
+            term_values.append(term_value.reshape(()))
+            names += [loss_name + "_" + name for name in term_names]
+            component_values.append(term_component_values)
+        # One stack and one reduction instead of a chain of additions, one per term.
+        loss_value = torch.stack(term_values).sum().reshape(1)
+        names.append("loss")
+        component_values.append(loss_value.detach())
+        return loss_value, names, torch.cat(component_values)
+
     def compute(self,
                 state: ComputationState,
                 log_func: Optional[Callable[[str, float], None]] = None) -> Tensor:
-        device = state.batch[0].device
-        loss_value = torch.zeros(1, device=device)
-        for loss_spec in self.losses:
-            loss_name = loss_spec[0]
-            loss = loss_spec[1]
-            if log_func is not None:
-                def loss_log_func(name, value):
-                    log_func(loss_name + "_" + name, value)
-            else:
-                loss_log_func = None
-            loss_value = loss_value + loss.compute(state, loss_log_func)
-
+        loss_value, names, component_values = self.compute_with_terms(state)
         if log_func is not None:
-            log_func("loss", loss_value.item())
-
+            for name, value in zip(names, component_values.unbind()):
+                log_func(name, value)
         return loss_value
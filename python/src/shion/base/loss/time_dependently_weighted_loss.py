@@ -1,8 +1,8 @@
-from typing import Callable, Optional
+from typing import Callable, Optional, List
 
 from torch import Tensor
 
-from shion.core.cached_computation import ComputationState, CachedComputationFunc
+from shion.core.cached_computation import ComputationState, CachedComputationFunc, get_funcs_read_keys
 from shion.core.loss import Loss
 
 
@@ -15,6 +15,13 @@ class TimeDependentlyWeightedLoss(Loss):
         self.examples_seen_so_far_func = examples_seen_so_far_func
         self.base_loss = base_loss
 
+    def get_read_keys(self) -> Optional[List[str]]:
+        base_read_keys = self.base_loss.get_read_keys()
+        examples_seen_so_far_read_keys = get_funcs_read_keys([self.examples_seen_so_far_func])
+        if base_read_keys is None or examples_seen_so_far_read_keys is None:
+            return None
+        return base_read_keys + examples_seen_so_far_read_keys
+
     def compute(self,
                 state: ComputationState,
                 log_func: Optional[Callable[[str, float], None]] = None) -> Tensor:
@@ -24,6 +31,6 @@ class TimeDependentlyWeightedLoss(Loss):
         loss_value = base_value * weight
 
         if log_func is not None:
-            log_func("loss", loss_value.item())
+            log_func("loss", loss_value.detach())
 
         return loss_value
@@ -27,3 +27,9 @@ class SingleNetworkBatchInputComputationProtocol(CachedComputationProtocol):
             return network.forward(*inputs)
         else:
             raise RuntimeError("Computing output for key " + key + " is not supported!")
+
+    def get_output_read_keys(self, key: str) -> Optional[List[str]]:
+        if key == self.key_network_output:
+            return []
+        else:
+            return None
@@ -9,7 +9,9 @@ from torch.optim.optimizer import Optimizer
 from shion.core.cached_computation import ComputationState
 from shion.core.loss import Loss
 from shion.core.optimizer_factory import OptimizerFactory
+from shion.core.training.precision_policy import PrecisionPolicy
 from shion.core.training.training_protocol import TrainingProtocol
+from shion.core.training.util import create_gradient_sync_context
 from shion.core.training.validation_protocol import ValidationProtocol
 
 KEY_NETWORK = "network"
@@ -23,8 +25,17 @@ class SingleNetworkTrainingProtocol(TrainingProtocol):
                  optimizer_factories: Dict[str, OptimizerFactory],
                  module_key: str = KEY_NETWORK,
                  random_seed: int = 39549059840,
-                 max_grad_norm: Optional[float] = None):
+                 max_grad_norm: Optional[float] = None,
+                 precision_policy: Optional[PrecisionPolicy] = None,
+                 minibatch_size: Optional[int] = None):
         super().__init__()
+        if minibatch_size is None:
+            minibatch_size = batch_size
+        assert batch_size % minibatch_size == 0
+        self.minibatch_size = minibatch_size
+        if precision_policy is None:
+            precision_policy = PrecisionPolicy()
+        self.precision_policy = precision_policy
         self.max_grad_norm = max_grad_norm
         self.module_key = module_key
         self.optimizer_factories = optimizer_factories
@@ -48,6 +59,13 @@ class SingleNetworkTrainingProtocol(TrainingProtocol):
     def get_learning_rate(self, examples_seen_so_far: int) -> Dict[str, float]:
         return self.learning_rate(examples_seen_so_far)
 
+    def state_dict(self) -> Dict[str, Any]:
+        return {"precision_policy": self.precision_policy.state_dict()}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]):
+        if "precision_policy" in state_dict:
+            self.precision_policy.load_state_dict(state_dict["precision_policy"])
+
     def run_training_iteration(
             self,
             batch: Any,
@@ -65,12 +83,32 @@ class SingleNetworkTrainingProtocol(TrainingProtocol):
             log_func = create_log_func("training_" + self.module_key, examples_seen_so_far)
         else:
             log_func = None
-        losses[self.module_key].compute(
-            ComputationState(modules, accumulated_modules, batch),
-            log_func).backward()
+        grad_scaler = self.precision_policy.get_grad_scaler(device)
+        num_minibatch = self.batch_size // self.minibatch_size
+        if num_minibatch == 1:
+            with self.precision_policy.autocast(device):
+                loss = losses[self.module_key].compute(
+                    ComputationState(modules, accumulated_modules, batch),
+                    log_func)
+            grad_scaler.scale(loss).backward()
+        else:
+            for minibatch_index in range(num_minibatch):
+                minibatch = []
+                for item in batch:
+                    minibatch.append(
+                        item[minibatch_index * self.minibatch_size:(minibatch_index + 1) * self.minibatch_size])
+                with create_gradient_sync_context([module], minibatch_index == num_minibatch - 1):
+                    with self.precision_policy.autocast(device):
+                        loss = losses[self.module_key].compute(
+                            ComputationState(modules, accumulated_modules, minibatch),
+                            log_func if minibatch_index == 0 else None)
+                        loss = loss / num_minibatch
+                    grad_scaler.scale(loss).backward()
         if self.max_grad_norm is not None:
+            grad_scaler.unscale_(optimizers[self.module_key])
             clip_grad_norm_(module.parameters(), self.max_grad_norm)
-        optimizers[self.module_key].step()
+        grad_scaler.step(optimizers[self.module_key])
+        grad_scaler.update()
 
 
 class SingleNetworkValidationProtocol(ValidationProtocol):
@@ -9,7 +9,9 @@ from torch.optim.optimizer import Optimizer
 from shion.core.cached_computation import ComputationState
 from shion.core.loss import Loss
 from shion.core.optimizer_factory import OptimizerFactory
+from shion.core.training.precision_policy import PrecisionPolicy
 from shion.core.training.training_protocol import TrainingProtocol
+from shion.core.training.util import create_gradient_sync_context
 from shion.core.training.validation_protocol import ValidationProtocol
 
 KEY_NETWORK = "network"
@@ -24,9 +26,13 @@ class SingleNetworkWithMinibatchTrainingProtocol(TrainingProtocol):
                  optimizer_factories: Dict[str, OptimizerFactory],
                  module_key: str = KEY_NETWORK,
                  random_seed: int = 39549059840,
-                 max_grad_norm: Optional[float] = None):
+                 max_grad_norm: Optional[float] = None,
+                 precision_policy: Optional[PrecisionPolicy] = None):
         super().__init__()
         assert batch_size % minibatch_size == 0
+        if precision_policy is None:
+            precision_policy = PrecisionPolicy()
+        self.precision_policy = precision_policy
         self.minibatch_size = minibatch_size
         self.max_grad_norm = max_grad_norm
         self.module_key = module_key
@@ -51,6 +57,13 @@ class SingleNetworkWithMinibatchTrainingProtocol(TrainingProtocol):
     def get_learning_rate(self, examples_seen_so_far: int) -> Dict[str, float]:
         return self.learning_rate(examples_seen_so_far)
 
+    def state_dict(self) -> Dict[str, Any]:
+        return {"precision_policy": self.precision_policy.state_dict()}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]):
+        if "precision_policy" in state_dict:
+            self.precision_policy.load_state_dict(state_dict["precision_policy"])
+
     def run_training_iteration(
             self,
             batch: Any,
@@ -69,19 +82,24 @@ class SingleNetworkWithMinibatchTrainingProtocol(TrainingProtocol):
         else:
             log_func = None
 
+        grad_scaler = self.precision_policy.get_grad_scaler(device)
         num_minibatch = self.batch_size // self.minibatch_size
         for minibatch_index in range(num_minibatch):
             minibatch = []
             for item in batch:
                 minibatch.append(
                     item[minibatch_index * self.minibatch_size:(minibatch_index + 1) * self.minibatch_size])
-            loss = losses[self.module_key].compute(
-                ComputationState(modules, accumulated_modules, minibatch),
-                log_func if minibatch_index == 0 else None)
-            loss = loss / num_minibatch
-            loss.backward()
+            with create_gradient_sync_context([module], minibatch_index == num_minibatch - 1):
+                with self.precision_policy.autocast(device):
+                    loss = losses[self.module_key].compute(
+                        ComputationState(modules, accumulated_modules, minibatch),
+                        log_func if minibatch_index == 0 else None)
+                    loss = loss / num_minibatch
+                grad_scaler.scale(loss).backward()
 
         if self.max_grad_norm is not None:
+            grad_scaler.unscale_(optimizers[self.module_key])
             clip_grad_norm_(module.parameters(), self.max_grad_norm)
 
-        optimizers[self.module_key].step()
+        grad_scaler.step(optimizers[self.module_key])
+        grad_scaler.update()
@@ -8,7 +8,9 @@ from torch.optim.optimizer import Optimizer
 from shion.core.cached_computation import ComputationState
 from shion.core.loss import Loss
 from shion.core.optimizer_factory import OptimizerFactory
+from shion.core.training.precision_policy import PrecisionPolicy
 from shion.core.training.training_protocol import TrainingProtocol
+from shion.core.training.util import create_gradient_sync_context
 
 
 class TwoNetworksWithMinibatchTrainingProtocol(TrainingProtocol):
@@ -22,11 +24,15 @@ class TwoNetworksWithMinibatchTrainingProtocol(TrainingProtocol):
                  train_network_0: bool = False,
                  random_seed: int = 39549059840,
                  max_grad_norm: Optional[float] = None,
-                 minibatch_size: Optional[int] = None):
+                 minibatch_size: Optional[int] = None,
+                 precision_policy: Optional[PrecisionPolicy] = None):
         super().__init__()
         if minibatch_size is None:
             minibatch_size = batch_size
         assert batch_size % minibatch_size == 0
+        if precision_policy is None:
+            precision_policy = PrecisionPolicy()
+        self.precision_policy = precision_policy
         self.train_network_0 = train_network_0
         self.key_network_1 = key_network_1
         self.key_network_0 = key_network_0
@@ -53,6 +59,13 @@ class TwoNetworksWithMinibatchTrainingProtocol(TrainingProtocol):
     def get_learning_rate(self, examples_seen_so_far: int) -> Dict[str, float]:
         return self.learning_rate(examples_seen_so_far)
 
+    def state_dict(self) -> Dict[str, Any]:
+        return {"precision_policy": self.precision_policy.state_dict()}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]):
+        if "precision_policy" in state_dict:
+            self.precision_policy.load_state_dict(state_dict["precision_policy"])
+
     def run_training_iteration(
             self,
             batch: Any,
@@ -80,27 +93,37 @@ class TwoNetworksWithMinibatchTrainingProtocol(TrainingProtocol):
             network_0_log_func = None
             network_1_log_func = None
 
+        grad_scaler = self.precision_policy.get_grad_scaler(device)
+        if self.train_network_0:
+            trained_networks = [network_0, network_1]
+        else:
+            trained_networks = [network_1]
         num_minibatch = self.batch_size // self.minibatch_size
         for minibatch_index in range(num_minibatch):
             minibatch = []
             for item in batch:
                 minibatch.append(
                     item[minibatch_index * self.minibatch_size:(minibatch_index + 1) * self.minibatch_size])
-            loss = losses[self.key_network_1].compute(
-                ComputationState(modules, accumulated_modules, minibatch),
-                network_1_log_func if minibatch_index == 0 else None)
-            if self.train_network_0 and self.key_network_0 in losses:
-                loss = loss + losses[self.key_network_0].compute(
-                    ComputationState(modules, accumulated_modules, minibatch),
-                    network_0_log_func if minibatch_index == 0 else None)
-            loss = loss / num_minibatch
-            loss.backward()
+            with create_gradient_sync_context(trained_networks, minibatch_index == num_minibatch - 1):
+                with self.precision_policy.autocast(device):
+                    loss = losses[self.key_network_1].compute(
+                        ComputationState(modules, accumulated_modules, minibatch),
+                        network_1_log_func if minibatch_index == 0 else None)
+                    if self.train_network_0 and self.key_network_0 in losses:
+                        loss = loss + losses[self.key_network_0].compute(
+                            ComputationState(modules, accumulated_modules, minibatch),
+                            network_0_log_func if minibatch_index == 0 else None)
+                    loss = loss / num_minibatch
+                grad_scaler.scale(loss).backward()
 
         if self.max_grad_norm is not None:
+            grad_scaler.unscale_(optimizers[self.key_network_1])
             clip_grad_norm_(network_1.parameters(), self.max_grad_norm)
             if self.train_network_0:
+                grad_scaler.unscale_(optimizers[self.key_network_0])
                 clip_grad_norm_(network_0.parameters(), self.max_grad_norm)
 
-        optimizers[self.key_network_1].step()
+        grad_scaler.step(optimizers[self.key_network_1])
         if self.train_network_0:
-            optimizers[self.key_network_0].step()
+            grad_scaler.step(optimizers[self.key_network_0])
+        grad_scaler.update()
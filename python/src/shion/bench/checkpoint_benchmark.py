@@ -0,0 +1,193 @@
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Dict, Any, List, Optional
+
+import torch
+import torch.distributed
+import torch.multiprocessing
+
+from shion.base.module_accumulators import DecayAccumulator
+from shion.base.optimizer_factories import AdamOptimizerFactory
+from shion.bench.trainer_throughput_benchmark import MlpFactory
+from shion.core.training.distrib.distributed_training_states import DistributedTrainingState
+from shion.core.training.distrib.sharded_checkpoint import load_files_round_robin, load_files_on_every_rank
+
+
+def create_checkpoint_benchmark_state(
+        num_modules: int,
+        num_features: int,
+        num_hidden_features: int,
+        num_layers: int,
+        rank: int,
+        device: torch.device) -> DistributedTrainingState:
+    module_factories = {
+        f"module_{i}": MlpFactory(num_features, num_hidden_features, num_layers) for i in range(num_modules)
+    }
+    state = DistributedTrainingState.new(
+        module_factories=module_factories,
+        accumulators={module_name: DecayAccumulator() for module_name in module_factories},
+        optimizer_factories={module_name: AdamOptimizerFactory() for module_name in module_factories},
+        random_seed=0,
+        rank=rank,
+        local_rank=rank,
+        device=device)
+    # Take one optimizer step so that the optimizer files carry the Adam moments as they would in a real run.
+    for module_name in module_factories:
+        module = state.modules[module_name]
+        module(torch.zeros(1, num_features, device=device)).sum().backward()
+        state.optimizers[module_name].step()
+        state.optimizers[module_name].zero_grad()
+    return state
+
+
+def run_checkpoint_benchmark_worker(
+        rank: int,
+        world_size: int,
+        args: Dict[str, Any],
+        prefix: str,
+        master_port: int,
+        result_file_name: str):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(master_port)
+    torch.set_num_threads(max(1, torch.get_num_threads() // world_size))
+    torch.distributed.init_process_group("gloo", rank=rank, world_size=world_size)
+    device = torch.device("cpu")
+
+    state = create_checkpoint_benchmark_state(
+        args["num_modules"], args["num_features"], args["num_hidden_features"], args["num_layers"], rank, device)
+    module_factories = {
+        module_name: MlpFactory(args["num_features"], args["num_hidden_features"], args["num_layers"])
+        for module_name in state.modules
+    }
+
+    save_seconds = []
+    load_seconds = []
+    round_robin_file_load_seconds = []
+    every_rank_file_load_seconds = []
+    for _ in range(args["num_repeats"]):
+        torch.distributed.barrier()
+        start_time = time.perf_counter()
+        state.save(prefix, rank, torch.distributed.barrier, world_size)
+        save_seconds.append(time.perf_counter() - start_time)
+
+        torch.distributed.barrier()
+        start_time = time.perf_counter()
+        DistributedTrainingState.load(
+            prefix,
+            module_factories,
+            {module_name: DecayAccumulator() for module_name in module_factories},
+            {module_name: AdamOptimizerFactory() for module_name in module_factories},
+            rank,
+            rank,
+            device)
+        torch.distributed.barrier()
+        load_seconds.append(time.perf_counter() - start_time)
+
+        # The files that DistributedTrainingState.load reads with load_files_round_robin, read both ways.
+        file_names = [
+            get_file_name(prefix, module_name)
+            for get_file_name in [
+                DistributedTrainingState.get_module_file_name,
+                DistributedTrainingState.get_accumulated_module_file_name,
+                DistributedTrainingState.get_optimizer_file_name,
+            ]
+            for module_name in module_factories
+        ]
+        torch.distributed.barrier()
+        start_time = time.perf_counter()
+        load_files_round_robin(file_names, rank, world_size, device)
+        torch.distributed.barrier()
+        round_robin_file_load_seconds.append(time.perf_counter() - start_time)
+
+        torch.distributed.barrier()
+        start_time = time.perf_counter()
+        load_files_on_every_rank(file_names, rank)
+        torch.distributed.barrier()
+        every_rank_file_load_seconds.append(time.perf_counter() - start_time)
+
+    if rank == 0:
+        num_bytes = sum(
+            os.path.getsize(os.path.join(prefix, file_name))
+            for file_name in os.listdir(prefix) if file_name.endswith(".pt"))
+        with open(result_file_name, "wt") as fout:
+            json.dump({
+                "world_size": world_size,
+                "checkpoint_bytes": num_bytes,
+                "save_seconds": min(save_seconds),
+                "load_seconds": min(load_seconds),
+                "round_robin_file_load_seconds": min(round_robin_file_load_seconds),
+                "every_rank_file_load_seconds": min(every_rank_file_load_seconds),
+            }, fout)
+    torch.distributed.destroy_process_group()
+
+
+def run_checkpoint_benchmark(
+        world_sizes: List[int],
+        num_modules: int = 4,
+        num_features: int = 256,
+        num_hidden_features: int = 1024,
+        num_layers: int = 4,
+        num_repeats: int = 3,
+        master_port: int = 29518,
+        work_dir: Optional[str] = None) -> Dict[str, Any]:
+    args = {
+        "num_modules": num_modules,
+        "num_features": num_features,
+        "num_hidden_features": num_hidden_features,
+        "num_layers": num_layers,
+        "num_repeats": num_repeats,
+    }
+    results = []
+    with tempfile.TemporaryDirectory(dir=work_dir) as temp_dir:
+        for world_size in world_sizes:
+            prefix = f"{temp_dir}/world_size_{world_size}"
+            result_file_name = f"{temp_dir}/result_{world_size}.json"
+            torch.multiprocessing.spawn(
+                run_checkpoint_benchmark_worker,
+                args=(world_size, args, prefix, master_port, result_file_name),
+                nprocs=world_size,
+                join=True)
+            with open(result_file_name, "rt") as fin:
+                result = json.load(fin)
+            logging.info(f"world_size={world_size}: save = {result['save_seconds']:.3f}s, "
+                         f"load = {result['load_seconds']:.3f}s, "
+                         f"files read round robin = {result['round_robin_file_load_seconds']:.3f}s, "
+                         f"files read by every rank = {result['every_rank_file_load_seconds']:.3f}s")
+            results.append(result)
+    return {
+        "config": args,
+        "torch_version": torch.__version__,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure how long saving and loading a distributed checkpoint takes.")
+    parser.add_argument("--world_sizes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--num_modules", type=int, default=4)
+    parser.add_argument("--num_features", type=int, default=256)
+    parser.add_argument("--num_hidden_features", type=int, default=1024)
+    parser.add_argument("--num_layers", type=int, default=4)
+    parser.add_argument("--num_repeats", type=int, default=3)
+    parser.add_argument("--master_port", type=int, default=29518)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    benchmark_result = run_checkpoint_benchmark(
+        args.world_sizes,
+        num_modules=args.num_modules,
+        num_features=args.num_features,
+        num_hidden_features=args.num_hidden_features,
+        num_layers=args.num_layers,
+        num_repeats=args.num_repeats,
+        master_port=args.master_port)
+    if args.output is None:
+        print(json.dumps(benchmark_result, indent=2))
+    else:
+        with open(args.output, "wt") as fout:
+            json.dump(benchmark_result, fout, indent=2)
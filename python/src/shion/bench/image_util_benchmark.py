@@ -0,0 +1,140 @@
+import argparse
+import json
+import logging
+import time
+from typing import Dict, Any, Callable, Optional
+
+import PIL.Image
+import numpy
+import torch
+
+from shion.base.image_util import numpy_srgb_to_linear, numpy_srgb_uint8_to_linear, torch_srgb_to_linear, \
+    torch_srgb_uint8_to_linear, convert_PIL_image_to_RGB_or_RGBA, extract_pytorch_image_from_filelike, \
+    extract_pytorch_images_from_files
+
+
+def time_func(func: Callable[[], Any], num_iterations: int, device: Optional[torch.device] = None) -> float:
+    func()
+    if device is not None and device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start_time = time.perf_counter()
+    for _ in range(num_iterations):
+        func()
+    if device is not None and device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start_time) / num_iterations
+
+
+def benchmark_numpy_conversion(raw_image: numpy.ndarray, num_iterations: int) -> Dict[str, Any]:
+    def compute():
+        return numpy_srgb_to_linear(raw_image.astype(numpy.float32) / 255.0)
+
+    def look_up():
+        return numpy_srgb_uint8_to_linear(raw_image)
+
+    if not numpy.array_equal(compute(), look_up()):
+        raise RuntimeError("The lookup table does not match numpy_srgb_to_linear.")
+    compute_seconds = time_func(compute, num_iterations)
+    look_up_seconds = time_func(look_up, num_iterations)
+    return {
+        "shape": list(raw_image.shape),
+        "compute_seconds": compute_seconds,
+        "lookup_seconds": look_up_seconds,
+        "speedup": compute_seconds / look_up_seconds,
+    }
+
+
+def benchmark_torch_conversion(batch: torch.Tensor, num_iterations: int) -> Dict[str, Any]:
+    def compute():
+        return torch_srgb_to_linear(batch.float() / 255.0)
+
+    def look_up():
+        return torch_srgb_uint8_to_linear(batch)
+
+    if not torch.equal(compute(), look_up()):
+        raise RuntimeError("The lookup table does not match torch_srgb_to_linear.")
+    compute_seconds = time_func(compute, num_iterations, batch.device)
+    look_up_seconds = time_func(look_up, num_iterations, batch.device)
+    return {
+        "shape": list(batch.shape),
+        "device": str(batch.device),
+        "compute_seconds": compute_seconds,
+        "lookup_seconds": look_up_seconds,
+        "speedup": compute_seconds / look_up_seconds,
+    }
+
+
+def benchmark_batch_decode(image_file_name: str, num_images: int, num_threads: Optional[int]) -> Dict[str, Any]:
+    file_names = [image_file_name] * num_images
+
+    start_time = time.perf_counter()
+    serial_images = torch.stack([extract_pytorch_image_from_filelike(file_name) for file_name in file_names])
+    serial_seconds = time.perf_counter() - start_time
+
+    out = torch.empty_like(serial_images)
+    start_time = time.perf_counter()
+    extract_pytorch_images_from_files(file_names, out=out, num_threads=num_threads)
+    batch_seconds = time.perf_counter() - start_time
+
+    if not torch.equal(serial_images, out):
+        raise RuntimeError("extract_pytorch_images_from_files does not match extract_pytorch_image_from_filelike.")
+    return {
+        "num_images": num_images,
+        "num_threads": num_threads,
+        "serial_images_per_second": num_images / serial_seconds,
+        "batch_images_per_second": num_images / batch_seconds,
+    }
+
+
+def run_image_util_benchmark(
+        image_file_name: str,
+        batch_size: int = 64,
+        num_iterations: int = 20,
+        num_decoded_images: int = 256,
+        num_decode_threads: Optional[int] = None,
+        device: Optional[torch.device] = None) -> Dict[str, Any]:
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    pil_image = convert_PIL_image_to_RGB_or_RGBA(PIL.Image.open(image_file_name))
+    raw_image = numpy.asarray(pil_image, dtype=numpy.uint8).reshape(pil_image.height, pil_image.width, -1)
+    image_result = benchmark_numpy_conversion(raw_image[:, :, 0:3], num_iterations)
+    logging.info(f"{image_file_name}: {image_result['speedup']:.2f}x faster with the lookup table")
+
+    batch = torch.from_numpy(raw_image.copy()).permute(2, 0, 1)[0:3].unsqueeze(0)
+    batch = batch.repeat(batch_size, 1, 1, 1).to(device)
+    batch_result = benchmark_torch_conversion(batch, num_iterations)
+    logging.info(f"Batch of {batch_size} on {device}: {batch_result['speedup']:.2f}x faster with the lookup table")
+
+    decode_result = benchmark_batch_decode(image_file_name, num_decoded_images, num_decode_threads)
+    logging.info(f"Decoding: {decode_result['serial_images_per_second']:.1f} images/sec one by one, "
+                 f"{decode_result['batch_images_per_second']:.1f} images/sec in a batch")
+
+    return {
+        "image_file_name": image_file_name,
+        "image": image_result,
+        "batch": batch_result,
+        "decode": decode_result,
+    }
+
+
+if __name__ == "__main__":
+    from data._20240729.constants import HOSHIHINA_600_FILE_NAME
+
+    parser = argparse.ArgumentParser(description="Measure sRGB to linear conversion and batch image decoding.")
+    parser.add_argument("--image_file_name", type=str, default=HOSHIHINA_600_FILE_NAME)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--num_iterations", type=int, default=20)
+    parser.add_argument("--num_decoded_images", type=int, default=256)
+    parser.add_argument("--num_decode_threads", type=int, default=None)
+    parser.add_argument("--device", type=str, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    benchmark_result = run_image_util_benchmark(
+        image_file_name=args.image_file_name,
+        batch_size=args.batch_size,
+        num_iterations=args.num_iterations,
+        num_decoded_images=args.num_decoded_images,
+        num_decode_threads=args.num_decode_threads,
+        device=None if args.device is None else torch.device(args.device))
+    print(json.dumps(benchmark_result, indent=2))
@@ -0,0 +1,171 @@
+import argparse
+import json
+import logging
+from typing import Dict, Any, Optional
+
+import torch
+from torch import Tensor
+
+from shion.base.loss.l1_loss import L1Loss
+from shion.base.loss.l2_loss import L2Loss
+from shion.base.loss.liveness_planned_loss import LivenessPlannedLoss
+from shion.base.loss.sum_loss import SumLoss
+from shion.bench.trainer_throughput_benchmark import MlpFactory
+from shion.core.cached_computation import ComposableCachedComputationProtocol, ComputationState, add_step, \
+    batch_indexing_func, zeros_like_func
+from shion.core.loss import Loss
+
+KEY_NETWORK = "network"
+KEY_TEACHER = "teacher"
+
+KEY_INPUT = "input"
+KEY_TARGET = "target"
+KEY_NOISE = "noise"
+KEY_NOISY_INPUT = "noisy_input"
+KEY_NETWORK_OUTPUT = "network_output"
+KEY_TEACHER_OUTPUT = "teacher_output"
+KEY_ZERO_NOISE = "zero_noise"
+
+
+class CacheSizeTrackingProtocol(ComposableCachedComputationProtocol):
+    """
+    Records the largest number of tensor bytes held in ComputationState.outputs at any point, which is the memory that
+    the liveness plan is able to release.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.peak_cached_bytes = 0
+
+    def get_output(self, key: str, state: ComputationState) -> Any:
+        output = super().get_output(key, state)
+        cached_bytes = sum(
+            value.numel() * value.element_size() for value in state.outputs.values() if isinstance(value, Tensor))
+        self.peak_cached_bytes = max(self.peak_cached_bytes, cached_bytes)
+        return output
+
+
+def create_protocol() -> CacheSizeTrackingProtocol:
+    protocol = CacheSizeTrackingProtocol()
+    steps = protocol.computation_steps
+    steps[KEY_INPUT] = batch_indexing_func(0)
+    steps[KEY_TARGET] = batch_indexing_func(1)
+    steps[KEY_ZERO_NOISE] = zeros_like_func(KEY_NOISE)
+
+    @add_step(steps, KEY_NOISE, reads=[KEY_INPUT])
+    def get_noise(protocol, state: ComputationState):
+        return torch.randn_like(protocol.get_output(KEY_INPUT, state))
+
+    @add_step(steps, KEY_NOISY_INPUT, reads=[KEY_INPUT, KEY_NOISE])
+    def get_noisy_input(protocol, state: ComputationState):
+        return protocol.get_output(KEY_INPUT, state) + protocol.get_output(KEY_NOISE, state)
+
+    @add_step(steps, KEY_NETWORK_OUTPUT, reads=[KEY_NOISY_INPUT])
+    def get_network_output(protocol, state: ComputationState):
+        return state.modules[KEY_NETWORK](protocol.get_output(KEY_NOISY_INPUT, state))
+
+    @add_step(steps, KEY_TEACHER_OUTPUT, reads=[KEY_INPUT])
+    def get_teacher_output(protocol, state: ComputationState):
+        with torch.no_grad():
+            return state.modules[KEY_TEACHER](protocol.get_output(KEY_INPUT, state))
+
+    return protocol
+
+
+def create_loss(protocol: CacheSizeTrackingProtocol) -> Loss:
+    return SumLoss([
+        ("distill", L1Loss(
+            protocol.get_output_func(KEY_TEACHER_OUTPUT),
+            protocol.get_output_func(KEY_NETWORK_OUTPUT))),
+        ("reconstruction", L2Loss(
+            protocol.get_output_func(KEY_TARGET),
+            protocol.get_output_func(KEY_NETWORK_OUTPUT))),
+        ("noise", L2Loss(
+            protocol.get_output_func(KEY_ZERO_NOISE),
+            protocol.get_output_func(KEY_NOISE))),
+    ])
+
+
+def measure_loss_memory(
+        use_liveness_plan: bool,
+        batch_size: int,
+        num_features: int,
+        num_hidden_features: int,
+        num_layers: int,
+        device: torch.device) -> Dict[str, Any]:
+    torch.manual_seed(0)
+    module_factory = MlpFactory(num_features, num_hidden_features, num_layers)
+    modules = {
+        KEY_NETWORK: module_factory.create().to(device),
+        KEY_TEACHER: module_factory.create().to(device),
+    }
+    protocol = create_protocol()
+    loss = create_loss(protocol)
+    if use_liveness_plan:
+        loss = LivenessPlannedLoss(loss, protocol)
+    batch = [
+        torch.randn(batch_size, num_features, device=device),
+        torch.randn(batch_size, num_features, device=device),
+    ]
+
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base_allocated_bytes = torch.cuda.memory_allocated(device)
+    loss_value = loss.compute(ComputationState(modules, {}, batch))
+    loss_value.backward()
+
+    result = {
+        "use_liveness_plan": use_liveness_plan,
+        "peak_cached_bytes": protocol.peak_cached_bytes,
+        "loss": loss_value.item(),
+    }
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        result["peak_allocated_bytes"] = torch.cuda.max_memory_allocated(device) - base_allocated_bytes
+    return result
+
+
+def run_liveness_benchmark(
+        batch_size: int = 256,
+        num_features: int = 1024,
+        num_hidden_features: int = 4096,
+        num_layers: int = 4,
+        device: Optional[torch.device] = None) -> Dict[str, Any]:
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    results = []
+    for use_liveness_plan in [False, True]:
+        result = measure_loss_memory(
+            use_liveness_plan, batch_size, num_features, num_hidden_features, num_layers, device)
+        logging.info(f"use_liveness_plan={use_liveness_plan}: "
+                     f"peak cached = {result['peak_cached_bytes'] / 1e6:.1f}MB")
+        results.append(result)
+    return {
+        "batch_size": batch_size,
+        "num_features": num_features,
+        "num_hidden_features": num_hidden_features,
+        "num_layers": num_layers,
+        "device": str(device),
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the memory held by cached intermediate outputs with and without a liveness plan.")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--num_features", type=int, default=1024)
+    parser.add_argument("--num_hidden_features", type=int, default=4096)
+    parser.add_argument("--num_layers", type=int, default=4)
+    parser.add_argument("--device", type=str, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    benchmark_result = run_liveness_benchmark(
+        batch_size=args.batch_size,
+        num_features=args.num_features,
+        num_hidden_features=args.num_hidden_features,
+        num_layers=args.num_layers,
+        device=None if args.device is None else torch.device(args.device))
+    print(json.dumps(benchmark_result, indent=2))
@@ -0,0 +1,162 @@
+import argparse
+import logging
+import tempfile
+from typing import Dict, Any
+
+import torch
+from torch.nn import Module, Sequential, Linear, ReLU, Dropout
+from torch.utils.data import TensorDataset
+
+from pytasuku import Workspace
+from shion.base.loss.l2_loss import L2Loss
+from shion.base.module_accumulators import DecayAccumulator
+from shion.base.optimizer_factories import AdamOptimizerFactory
+from shion.base.protocol.single_network_from_batch_input_computation_protocol import \
+    SingleNetworkBatchInputComputationProtocol, KEY_NETWORK, KEY_NETWORK_OUTPUT
+from shion.base.training.single_network import SingleNetworkTrainingProtocol, SingleNetworkValidationProtocol
+from shion.core.cached_computation import create_batch_element_func
+from shion.core.module_factory import ModuleFactory
+from shion.core.training.data_loader_options import DataLoaderOptions
+from shion.core.training.single.training_states import TrainingState
+from shion.core.training.single.training_tasks import TrainingTasks
+
+
+class DropoutMlpFactory(ModuleFactory):
+    # Dropout draws from the global RNG at every training step, so the check also covers restoring it.
+    def __init__(self, num_features: int, num_hidden_features: int):
+        self.num_hidden_features = num_hidden_features
+        self.num_features = num_features
+
+    def create(self) -> Module:
+        return Sequential(
+            Linear(self.num_features, self.num_hidden_features),
+            ReLU(),
+            Dropout(0.25),
+            Linear(self.num_hidden_features, self.num_features))
+
+
+class ResumeCheckConfig:
+    def __init__(self,
+                 batch_size: int = 16,
+                 validation_batch_size: int = 8,
+                 num_steps_before_resume: int = 7,
+                 num_steps_after_resume: int = 9,
+                 num_examples: int = 256,
+                 num_validation_examples: int = 40,
+                 num_features: int = 16,
+                 num_hidden_features: int = 64,
+                 num_data_loader_workers: int = 0,
+                 random_seed: int = 2980402938):
+        self.random_seed = random_seed
+        self.num_data_loader_workers = num_data_loader_workers
+        self.num_hidden_features = num_hidden_features
+        self.num_features = num_features
+        self.num_validation_examples = num_validation_examples
+        self.num_examples = num_examples
+        self.num_steps_after_resume = num_steps_after_resume
+        self.num_steps_before_resume = num_steps_before_resume
+        self.validation_batch_size = validation_batch_size
+        self.batch_size = batch_size
+
+    def create_dataset(self, num_examples: int, seed: int) -> TensorDataset:
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        shape = [num_examples, self.num_features]
+        return TensorDataset(torch.randn(shape, generator=generator), torch.randn(shape, generator=generator))
+
+    def create_trainer(self, prefix: str) -> TrainingTasks:
+        protocol = SingleNetworkBatchInputComputationProtocol()
+        checkpoint_examples = [
+            self.num_steps_before_resume * self.batch_size,
+            (self.num_steps_before_resume + self.num_steps_after_resume) * self.batch_size,
+        ]
+        return TrainingTasks(
+            workspace=Workspace(),
+            prefix=prefix,
+            module_factories={KEY_NETWORK: DropoutMlpFactory(self.num_features, self.num_hidden_features)},
+            accumulators={KEY_NETWORK: DecayAccumulator()},
+            losses={
+                KEY_NETWORK: L2Loss(
+                    expected_func=create_batch_element_func(1),
+                    actual_func=protocol.get_output_func(KEY_NETWORK_OUTPUT)),
+            },
+            training_dataset=self.create_dataset(self.num_examples, self.random_seed),
+            validation_dataset=self.create_dataset(self.num_validation_examples, self.random_seed + 1),
+            training_protocol=SingleNetworkTrainingProtocol(
+                check_point_examples=checkpoint_examples,
+                batch_size=self.batch_size,
+                learning_rate=lambda examples_seen_so_far: {KEY_NETWORK: 1e-3},
+                optimizer_factories={KEY_NETWORK: AdamOptimizerFactory()},
+                random_seed=self.random_seed),
+            # Validate at every step, so that the validation data wraps around several times.
+            validation_protocol=SingleNetworkValidationProtocol(
+                example_per_validation_iteration=self.batch_size,
+                batch_size=self.validation_batch_size),
+            sample_output_protocol=None,
+            pretrained_module_file_names={},
+            example_per_snapshot=checkpoint_examples[-1] * 2,
+            device=torch.device("cpu"),
+            num_data_loader_workers=self.num_data_loader_workers,
+            data_loader_options=DataLoaderOptions(persistent_workers=False))
+
+
+def load_final_training_state(trainer: TrainingTasks) -> TrainingState:
+    return TrainingState.load(
+        trainer.get_checkpoint_prefix(len(trainer.checkpoint_examples) - 1),
+        trainer.module_factories,
+        trainer.accumulators,
+        trainer.training_protocol.get_optimizer_factories(),
+        torch.device("cpu"))
+
+
+def compare_state_dicts(name: str, state_dict_0: Dict[str, Any], state_dict_1: Dict[str, Any]):
+    if state_dict_0.keys() != state_dict_1.keys():
+        raise RuntimeError(f"{name}: The state dicts have different keys.")
+    for key in state_dict_0.keys():
+        if not torch.equal(state_dict_0[key], state_dict_1[key]):
+            raise RuntimeError(f"{name}: {key} differs between the straight-through and the resumed run.")
+
+
+def run_resume_reproducibility_check(config: ResumeCheckConfig):
+    """
+    Trains the same model twice with validation enabled: once straight through, and once stopped at the first
+    checkpoint and resumed by a new trainer, as a new process would. Raises if the final parameters differ in any bit.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        straight_trainer = config.create_trainer(temp_dir + "/straight")
+        straight_trainer.save_sample_output_data()
+        straight_trainer.train(straight_trainer.checkpoint_examples[-1])
+
+        first_trainer = config.create_trainer(temp_dir + "/resumed")
+        first_trainer.save_sample_output_data()
+        first_trainer.train(first_trainer.checkpoint_examples[1])
+        # A new process starts with a different global RNG state. Resuming must not depend on it.
+        torch.manual_seed(config.random_seed + 12345)
+        resumed_trainer = config.create_trainer(temp_dir + "/resumed")
+        resumed_trainer.train(resumed_trainer.checkpoint_examples[-1])
+
+        straight_state = load_final_training_state(straight_trainer)
+        resumed_state = load_final_training_state(resumed_trainer)
+        if straight_state.examples_seen_so_far != resumed_state.examples_seen_so_far:
+            raise RuntimeError("The runs stopped after different numbers of examples.")
+        if straight_state.data_sampler_state != resumed_state.data_sampler_state:
+            raise RuntimeError("The runs stopped at different positions in the training or validation data.")
+        compare_state_dicts(
+            "module",
+            straight_state.modules[KEY_NETWORK].state_dict(),
+            resumed_state.modules[KEY_NETWORK].state_dict())
+        compare_state_dicts(
+            "accumulated module",
+            straight_state.accumulated_modules[KEY_NETWORK].state_dict(),
+            resumed_state.accumulated_modules[KEY_NETWORK].state_dict())
+    logging.info("The resumed run is bitwise identical to the straight-through run.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that resuming TrainingTasks with validation enabled reproduces a straight-through run.")
+    parser.add_argument("--num_data_loader_workers", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    run_resume_reproducibility_check(ResumeCheckConfig(num_data_loader_workers=args.num_data_loader_workers))
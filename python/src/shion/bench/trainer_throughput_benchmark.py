@@ -0,0 +1,377 @@
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Iterable, Type, Dict, Any, List, Optional, Tuple
+
+import torch
+import torch.distributed
+import torch.multiprocessing
+from torch.nn import Module, Sequential, Linear, ReLU, Parameter
+from torch.optim import Optimizer
+from torch.utils.data import TensorDataset
+
+from pytasuku import Workspace
+from shion.base.loss.l2_loss import L2Loss
+from shion.base.module_accumulators import DecayAccumulator
+from shion.base.optimizer_factories import AdamOptimizerFactory
+from shion.base.protocol.single_network_from_batch_input_computation_protocol import \
+    SingleNetworkBatchInputComputationProtocol, KEY_NETWORK, KEY_NETWORK_OUTPUT
+from shion.base.training.single_network import SingleNetworkTrainingProtocol
+from shion.core.cached_computation import create_batch_element_func
+from shion.core.module_factory import ModuleFactory
+from shion.core.optimizer_factory import OptimizerFactory
+from shion.core.training.distrib.device_mapper import CpuDeviceMapper
+from shion.core.training.distrib.distributed_trainer import DistributedTrainer
+from shion.core.training.single.training_tasks import TrainingTasks
+from shion.core.training.step_timer import StepTimer, STEP_SECTION_OPTIMIZER, STEP_SECTION_TRAINING_ITERATION
+from shion.core.training.swarm.swarm_unit_trainer import SwarmUnitTrainer
+from shion.nn00.resnet_block import ResnetBlock
+
+MODEL_MLP = "mlp"
+MODEL_RESNET_BLOCK = "resnet_block"
+
+TRAINER_TRAINING_TASKS = "training_tasks"
+TRAINER_SWARM_UNIT_TRAINER = "swarm_unit_trainer"
+TRAINER_DISTRIBUTED_TRAINER = "distributed_trainer"
+
+
+class MlpFactory(ModuleFactory):
+    def __init__(self, num_features: int, num_hidden_features: int, num_layers: int):
+        self.num_layers = num_layers
+        self.num_hidden_features = num_hidden_features
+        self.num_features = num_features
+
+    def create(self) -> Module:
+        layers = []
+        in_features = self.num_features
+        for i in range(self.num_layers - 1):
+            layers.append(Linear(in_features, self.num_hidden_features))
+            layers.append(ReLU())
+            in_features = self.num_hidden_features
+        layers.append(Linear(in_features, self.num_features))
+        return Sequential(*layers)
+
+
+class ResnetBlockStackFactory(ModuleFactory):
+    def __init__(self, num_channels: int, num_blocks: int):
+        self.num_blocks = num_blocks
+        self.num_channels = num_channels
+
+    def create(self) -> Module:
+        return Sequential(*[ResnetBlock(self.num_channels) for _ in range(self.num_blocks)])
+
+
+class TimedOptimizerFactory(OptimizerFactory):
+    """
+    Wraps the step() of the optimizers it creates, so that the optimizer time can be told apart from the forward and
+    backward passes inside the training iteration.
+    """
+
+    def __init__(self, optimizer_factory: OptimizerFactory, step_timer: StepTimer):
+        self.step_timer = step_timer
+        self.optimizer_factory = optimizer_factory
+
+    def create(self, parameters: Iterable[Parameter]) -> Optimizer:
+        optimizer = self.optimizer_factory.create(parameters)
+        original_step = optimizer.step
+        step_timer = self.step_timer
+
+        def step(*args, **kwargs):
+            with step_timer.section(STEP_SECTION_OPTIMIZER):
+                return original_step(*args, **kwargs)
+
+        optimizer.step = step
+        return optimizer
+
+    def get_optimizer_class(self) -> Type[Optimizer]:
+        return self.optimizer_factory.get_optimizer_class()
+
+    def get_optimizer_hyperparameters(self) -> Dict[str, Any]:
+        return self.optimizer_factory.get_optimizer_hyperparameters()
+
+
+class TrainerBenchmarkConfig:
+    def __init__(self,
+                 model: str = MODEL_MLP,
+                 batch_size: int = 64,
+                 num_warmup_steps: int = 5,
+                 num_steps: int = 50,
+                 num_examples: int = 4096,
+                 num_features: int = 256,
+                 num_hidden_features: int = 1024,
+                 num_layers: int = 4,
+                 num_channels: int = 32,
+                 image_size: int = 32,
+                 num_blocks: int = 2,
+                 num_data_loader_workers: int = 0,
+                 metric_flush_interval_steps: int = 0,
+                 random_seed: int = 2980402938):
+        assert model in [MODEL_MLP, MODEL_RESNET_BLOCK]
+        self.random_seed = random_seed
+        self.metric_flush_interval_steps = metric_flush_interval_steps
+        self.num_data_loader_workers = num_data_loader_workers
+        self.num_blocks = num_blocks
+        self.image_size = image_size
+        self.num_channels = num_channels
+        self.num_layers = num_layers
+        self.num_hidden_features = num_hidden_features
+        self.num_features = num_features
+        self.num_examples = num_examples
+        self.num_steps = num_steps
+        self.num_warmup_steps = num_warmup_steps
+        self.batch_size = batch_size
+        self.model = model
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(vars(self))
+
+    def get_module_factory(self) -> ModuleFactory:
+        if self.model == MODEL_MLP:
+            return MlpFactory(self.num_features, self.num_hidden_features, self.num_layers)
+        else:
+            return ResnetBlockStackFactory(self.num_channels, self.num_blocks)
+
+    def get_example_shape(self) -> List[int]:
+        if self.model == MODEL_MLP:
+            return [self.num_features]
+        else:
+            return [self.num_channels, self.image_size, self.image_size]
+
+    def create_dataset(self) -> TensorDataset:
+        generator = torch.Generator()
+        generator.manual_seed(self.random_seed)
+        shape = [self.num_examples] + self.get_example_shape()
+        return TensorDataset(torch.randn(shape, generator=generator), torch.randn(shape, generator=generator))
+
+    def get_checkpoint_examples(self, world_size: int) -> List[int]:
+        global_batch_size = self.batch_size * world_size
+        return [
+            self.num_warmup_steps * global_batch_size,
+            (self.num_warmup_steps + self.num_steps) * global_batch_size,
+        ]
+
+    def get_metric_flush_interval_steps(self):
+        if self.metric_flush_interval_steps <= 0:
+            return None
+        else:
+            return self.metric_flush_interval_steps
+
+    def create_trainer_args(self, world_size: int, step_timer: StepTimer) -> Dict[str, Any]:
+        protocol = SingleNetworkBatchInputComputationProtocol()
+        checkpoint_examples = self.get_checkpoint_examples(world_size)
+        return {
+            "module_factories": {KEY_NETWORK: self.get_module_factory()},
+            "accumulators": {KEY_NETWORK: DecayAccumulator()},
+            "losses": {
+                KEY_NETWORK: L2Loss(
+                    expected_func=create_batch_element_func(1),
+                    actual_func=protocol.get_output_func(KEY_NETWORK_OUTPUT)),
+            },
+            "training_dataset": self.create_dataset(),
+            "validation_dataset": None,
+            "training_protocol": SingleNetworkTrainingProtocol(
+                check_point_examples=checkpoint_examples,
+                batch_size=self.batch_size,
+                learning_rate=lambda examples_seen_so_far: {KEY_NETWORK: 1e-4},
+                optimizer_factories={KEY_NETWORK: TimedOptimizerFactory(AdamOptimizerFactory(), step_timer)},
+                random_seed=self.random_seed),
+            "validation_protocol": None,
+            "sample_output_protocol": None,
+            "pretrained_module_file_names": {},
+            "example_per_snapshot": checkpoint_examples[-1] * 2,
+            "num_data_loader_workers": self.num_data_loader_workers,
+            "metric_flush_interval_steps": self.get_metric_flush_interval_steps(),
+            "step_timer": step_timer,
+        }
+
+
+def summarize_step_timer(
+        trainer_name: str,
+        config: TrainerBenchmarkConfig,
+        step_timer: StepTimer,
+        world_size: int,
+        wall_seconds: float,
+        training_loop_seconds: float) -> Dict[str, Any]:
+    seconds_per_step = dict(step_timer.get_seconds_per_step())
+    optimizer_seconds = seconds_per_step.pop(STEP_SECTION_OPTIMIZER, 0.0)
+    training_iteration_seconds = seconds_per_step.pop(STEP_SECTION_TRAINING_ITERATION, 0.0)
+    seconds_per_step["forward_backward"] = training_iteration_seconds - optimizer_seconds
+    seconds_per_step["optimizer"] = optimizer_seconds
+    # Throughput comes from the wall-clock time of the training loop, which includes the work that no section covers.
+    # The sections only break that time down.
+    wall_seconds_per_step = training_loop_seconds / step_timer.num_steps if step_timer.num_steps > 0 else 0.0
+    sections_seconds_per_step = sum(seconds_per_step.values())
+    examples_per_step = config.batch_size * world_size
+    return {
+        "trainer": trainer_name,
+        "world_size": world_size,
+        "num_steps": step_timer.num_steps,
+        "wall_seconds": wall_seconds,
+        "training_loop_seconds": training_loop_seconds,
+        "seconds_per_step": wall_seconds_per_step,
+        "examples_per_second": examples_per_step / wall_seconds_per_step if wall_seconds_per_step > 0 else 0.0,
+        "sections_seconds_per_step": sections_seconds_per_step,
+        "untimed_seconds_per_step": wall_seconds_per_step - sections_seconds_per_step,
+        "seconds_per_step_by_section": seconds_per_step,
+    }
+
+
+def run_warmup_and_timed_training(
+        trainer,
+        train_func,
+        config: TrainerBenchmarkConfig,
+        step_timer: StepTimer,
+        world_size: int) -> Tuple[float, float]:
+    # Returns the wall-clock time of the timed train() call, and that of its training loop, which leaves out resuming
+    # from the warmup checkpoint.
+    warmup_examples, target_examples = config.get_checkpoint_examples(world_size)
+    train_func(warmup_examples)
+    step_timer.reset()
+    start_time = time.time()
+    train_func(target_examples)
+    end_time = time.time()
+    return end_time - start_time, end_time - trainer.training_loop_start_time
+
+
+def benchmark_training_tasks(config: TrainerBenchmarkConfig, prefix: str) -> Dict[str, Any]:
+    step_timer = StepTimer()
+    trainer = TrainingTasks(
+        workspace=Workspace(),
+        prefix=prefix,
+        device=torch.device("cpu"),
+        **config.create_trainer_args(1, step_timer))
+    trainer.save_sample_output_data()
+    wall_seconds, training_loop_seconds = run_warmup_and_timed_training(trainer, trainer.train, config, step_timer, 1)
+    return summarize_step_timer(TRAINER_TRAINING_TASKS, config, step_timer, 1, wall_seconds, training_loop_seconds)
+
+
+def benchmark_swarm_unit_trainer(config: TrainerBenchmarkConfig, prefix: str) -> Dict[str, Any]:
+    step_timer = StepTimer()
+    trainer = SwarmUnitTrainer(prefix=prefix, **config.create_trainer_args(1, step_timer))
+    wall_seconds, training_loop_seconds = run_warmup_and_timed_training(
+        trainer,
+        lambda target_examples: trainer.train(0, 0, target_examples, CpuDeviceMapper()),
+        config,
+        step_timer,
+        1)
+    return summarize_step_timer(
+        TRAINER_SWARM_UNIT_TRAINER, config, step_timer, 1, wall_seconds, training_loop_seconds)
+
+
+def run_distributed_trainer_benchmark_worker(
+        rank: int,
+        world_size: int,
+        config: TrainerBenchmarkConfig,
+        prefix: str,
+        master_port: int,
+        result_file_name: str):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(master_port)
+    torch.set_num_threads(max(1, torch.get_num_threads() // world_size))
+    torch.distributed.init_process_group("gloo", rank=rank, world_size=world_size)
+
+    step_timer = StepTimer()
+    trainer = DistributedTrainer(
+        prefix=prefix,
+        distrib_backend="gloo",
+        **config.create_trainer_args(world_size, step_timer))
+    wall_seconds, training_loop_seconds = run_warmup_and_timed_training(
+        trainer,
+        lambda target_examples: trainer.train(world_size, rank, rank, target_examples, CpuDeviceMapper()),
+        config,
+        step_timer,
+        world_size)
+    result = summarize_step_timer(
+        TRAINER_DISTRIBUTED_TRAINER, config, step_timer, world_size, wall_seconds, training_loop_seconds)
+
+    results = [None for _ in range(world_size)]
+    torch.distributed.all_gather_object(results, result)
+    if rank == 0:
+        # The slowest rank determines the throughput of the whole group.
+        slowest = max(results, key=lambda x: x["seconds_per_step"])
+        slowest = dict(slowest)
+        slowest["rank_seconds_per_step"] = [x["seconds_per_step"] for x in results]
+        with open(result_file_name, "wt") as fout:
+            json.dump(slowest, fout)
+    torch.distributed.destroy_process_group()
+
+
+def benchmark_distributed_trainer(
+        config: TrainerBenchmarkConfig,
+        prefix: str,
+        world_size: int,
+        master_port: int) -> Dict[str, Any]:
+    os.makedirs(prefix, exist_ok=True)
+    result_file_name = prefix + "/result.json"
+    torch.multiprocessing.spawn(
+        run_distributed_trainer_benchmark_worker,
+        args=(world_size, config, prefix, master_port, result_file_name),
+        nprocs=world_size,
+        join=True)
+    with open(result_file_name, "rt") as fin:
+        return json.load(fin)
+
+
+def run_trainer_throughput_benchmark(
+        config: TrainerBenchmarkConfig,
+        trainer_names: List[str],
+        world_size: int = 2,
+        master_port: int = 29517,
+        work_dir: Optional[str] = None) -> Dict[str, Any]:
+    results = []
+    with tempfile.TemporaryDirectory(dir=work_dir) as temp_dir:
+        for trainer_name in trainer_names:
+            prefix = f"{temp_dir}/{trainer_name}"
+            if trainer_name == TRAINER_TRAINING_TASKS:
+                result = benchmark_training_tasks(config, prefix)
+            elif trainer_name == TRAINER_SWARM_UNIT_TRAINER:
+                result = benchmark_swarm_unit_trainer(config, prefix)
+            elif trainer_name == TRAINER_DISTRIBUTED_TRAINER:
+                result = benchmark_distributed_trainer(config, prefix, world_size, master_port)
+            else:
+                raise RuntimeError(f"Unknown trainer: {trainer_name}")
+            logging.info(f"{trainer_name}: {result['examples_per_second']:.1f} examples/sec")
+            results.append(result)
+    return {
+        "config": config.to_dict(),
+        "torch_version": torch.__version__,
+        "num_threads": torch.get_num_threads(),
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the throughput of the shion trainers on synthetic data.")
+    parser.add_argument("--model", type=str, default=MODEL_MLP, choices=[MODEL_MLP, MODEL_RESNET_BLOCK])
+    parser.add_argument("--trainers", type=str, nargs="+",
+                        default=[TRAINER_TRAINING_TASKS, TRAINER_SWARM_UNIT_TRAINER, TRAINER_DISTRIBUTED_TRAINER])
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--num_warmup_steps", type=int, default=5)
+    parser.add_argument("--num_steps", type=int, default=50)
+    parser.add_argument("--num_data_loader_workers", type=int, default=0)
+    parser.add_argument("--metric_flush_interval_steps", type=int, default=0)
+    parser.add_argument("--world_size", type=int, default=2)
+    parser.add_argument("--master_port", type=int, default=29517)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    benchmark_result = run_trainer_throughput_benchmark(
+        TrainerBenchmarkConfig(
+            model=args.model,
+            batch_size=args.batch_size,
+            num_warmup_steps=args.num_warmup_steps,
+            num_steps=args.num_steps,
+            num_data_loader_workers=args.num_data_loader_workers,
+            metric_flush_interval_steps=args.metric_flush_interval_steps),
+        args.trainers,
+        world_size=args.world_size,
+        master_port=args.master_port)
+    if args.output is None:
+        print(json.dumps(benchmark_result, indent=2))
+    else:
+        with open(args.output, "wt") as fout:
+            json.dump(benchmark_result, fout, indent=2)
@@ -1,5 +1,6 @@
+import weakref
 from abc import ABC, abstractmethod
-from typing import Callable, Dict, Any, Optional
+from typing import Callable, Dict, Any, Optional, List
 
 import torch
 from torch import Tensor
@@ -11,9 +12,14 @@ class ComputationState:
                  modules: Dict[str, Module],
                  accumulated_modules: Dict[str, Module],
                  batch: Any,
-                 outputs: Optional[Dict[str, Any]] = None):
+                 outputs: Optional[Dict[str, Any]] = None,
+                 remaining_reads: Optional[Dict[str, int]] = None):
         if outputs is None:
             outputs = {}
+        # Outputs dropped by a liveness plan. They are only weakly referenced, so they can still be read while
+        # something else, e.g. the autograd graph, keeps them alive.
+        self.evicted_outputs: Dict[str, weakref.ref] = {}
+        self.remaining_reads = remaining_reads
         self.outputs = outputs
         self.batch = batch
         self.accumulated_modules = accumulated_modules
@@ -24,11 +30,35 @@ CachedComputationFunc = Callable[[ComputationState], Any]
 TensorCachedComputationFunc = Callable[[ComputationState], Tensor]
 
 
+def declare_reads(func: Callable, reads: List[str]) -> Callable:
+    # reads lists the key of every get_output call that func makes, with repetition. It lets the protocol work out
+    # when an output has been read for the last time.
+    func.reads = list(reads)
+    return func
+
+
+def get_read_keys(func: Callable) -> Optional[List[str]]:
+    return getattr(func, "reads", None)
+
+
+def get_funcs_read_keys(funcs: List[Callable]) -> Optional[List[str]]:
+    read_keys = []
+    for func in funcs:
+        func_read_keys = get_read_keys(func)
+        if func_read_keys is None:
+            return None
+        read_keys += func_read_keys
+    return read_keys
+
+
 def create_get_item_func(func: CachedComputationFunc, index):
     def _f(state: ComputationState):
         output = func(state)
         return output[index]
 
+    reads = get_read_keys(func)
+    if reads is not None:
+        declare_reads(_f, reads)
     return _f
 
 
@@ -36,27 +66,74 @@ def create_batch_element_func(index: int) -> TensorCachedComputationFunc:
     def _f(state: ComputationState) -> Tensor:
         return state.batch[index]
 
-    return _f
+    return declare_reads(_f, [])
 
 
 class CachedComputationProtocol(ABC):
     def get_output(self, key: str, state: ComputationState) -> Any:
         if key in state.outputs:
-            return state.outputs[key]
+            output = state.outputs[key]
+        elif key in state.evicted_outputs:
+            output = state.evicted_outputs[key]()
+            if output is None:
+                # Computing the output again could give a different value, e.g. for random noise.
+                raise RuntimeError(
+                    "Output for key " + key + " was freed after its last planned read but is read again. Check the "
+                    "reads given to declare_reads or add_step, or compute every loss that reads it under the same "
+                    "LivenessPlannedLoss.")
         else:
             output = self.compute_output(key, state)
             state.outputs[key] = output
-            return state.outputs[key]
+        if state.remaining_reads is not None and state.remaining_reads.get(key, 0) > 0:
+            state.remaining_reads[key] -= 1
+            if state.remaining_reads[key] == 0 and key in state.outputs:
+                # Nothing else in the liveness plan reads this output, so the cache does not need to keep it alive.
+                try:
+                    state.evicted_outputs[key] = weakref.ref(output)
+                    del state.outputs[key]
+                except TypeError:
+                    # Outputs that cannot be weakly referenced, e.g. lists, stay cached.
+                    pass
+        return output
 
     @abstractmethod
     def compute_output(self, key: str, state: ComputationState) -> Any:
         pass
 
+    def get_output_read_keys(self, key: str) -> Optional[List[str]]:
+        # The keys that computing the output reads, or None if they are not known.
+        return None
+
+    def create_liveness_plan(self, root_read_keys: List[str]) -> Optional[Dict[str, int]]:
+        """
+        Count how many times each output will be read when the outputs in root_read_keys are requested.
+
+        The result is meant to be used as ComputationState.remaining_reads. Returns None if the reads of some output
+        are not declared, in which case every output must stay cached.
+        """
+        num_reads = {}
+        for key in root_read_keys:
+            num_reads[key] = num_reads.get(key, 0) + 1
+        visited = set()
+        to_visit = list(root_read_keys)
+        while len(to_visit) > 0:
+            key = to_visit.pop()
+            if key in visited:
+                continue
+            visited.add(key)
+            read_keys = self.get_output_read_keys(key)
+            if read_keys is None:
+                return None
+            for read_key in read_keys:
+                num_reads[read_key] = num_reads.get(read_key, 0) + 1
+                to_visit.append(read_key)
+        return num_reads
+
     def get_output_func(self, key: str) -> CachedComputationFunc:
         def func(state: ComputationState):
             return self.get_output(key, state)
 
-        return func
+        return declare_reads(func, [key])
 
 
 ComposableCachedComputationStep = Callable[[CachedComputationProtocol, ComputationState], Any]
@@ -74,30 +151,37 @@ class ComposableCachedComputationProtocol(CachedComputationProtocol):
         else:
             raise RuntimeError("Computing output for key " + key + " is not supported!")
 
+    def get_output_read_keys(self, key: str) -> Optional[List[str]]:
+        if key not in self.computation_steps:
+            return None
+        return get_read_keys(self.computation_steps[key])
+
 
 def batch_indexing_func(index: int):
     def _f(protocol: CachedComputationProtocol, state: ComputationState):
         return state.batch[index]
 
-    return _f
+    return declare_reads(_f, [])
 
 
 def proxy_func(key: str):
     def _f(protocol: CachedComputationProtocol, state: ComputationState):
         return protocol.get_output(key, state)
 
-    return _f
+    return declare_reads(_f, [key])
 
 
 def output_array_indexing_func(key: str, index: int):
     def _f(protocol: CachedComputationProtocol, state: ComputationState):
         return protocol.get_output(key, state)[index]
 
-    return _f
+    return declare_reads(_f, [key])
 
 
-def add_step(step_dict: Dict[str, ComposableCachedComputationStep], name: str):
+def add_step(step_dict: Dict[str, ComposableCachedComputationStep], name: str, reads: Optional[List[str]] = None):
     def _f(func):
+        if reads is not None:
+            declare_reads(func, reads)
         step_dict[name] = func
         return func
 
@@ -109,4 +193,4 @@ def zeros_like_func(key: str):
         prototype = protocol.get_output(key, state)
         return torch.zeros_like(prototype)
 
-    return _f
+    return declare_reads(_f, [key])
@@ -0,0 +1,41 @@
+from typing import Dict, List, Tuple
+
+import torch
+from torch import Tensor
+from torch.nn import Module
+
+try:
+    from torch.func import functional_call, vmap
+except ImportError:
+    # PyTorch 1.13 ships these as torch.nn.utils.stateless and the bundled functorch package.
+    from torch.nn.utils.stateless import functional_call
+    from functorch import vmap
+
+
+def stack_module_parameters(modules: List[Module]) -> Dict[str, Tensor]:
+    # Unlike torch.func.stack_module_state, the stacked tensors are not new leaves: gradients flow back to the
+    # parameters of each module, so every module can keep its own optimizer.
+    named_parameters = [dict(module.named_parameters()) for module in modules]
+    return {
+        name: torch.stack([parameters[name] for parameters in named_parameters])
+        for name in named_parameters[0]
+    }
+
+
+def stack_module_buffers(modules: List[Module]) -> Dict[str, Tensor]:
+    named_buffers = [dict(module.named_buffers()) for module in modules]
+    return {
+        name: torch.stack([buffers[name] for buffers in named_buffers])
+        for name in named_buffers[0]
+    }
+
+
+def stack_module_state(modules: List[Module]) -> Tuple[Dict[str, Tensor], Dict[str, Tensor]]:
+    return stack_module_parameters(modules), stack_module_buffers(modules)
+
+
+def call_stacked_module(base_module: Module, parameters: Dict[str, Tensor], buffers: Dict[str, Tensor], *args):
+    # Call base_module with the parameters and buffers of one member of a stack. Meant to be used inside vmap.
+    state = dict(parameters)
+    state.update(buffers)
+    return functional_call(base_module, state, args)
@@ -1,4 +1,5 @@
 import os
+from typing import Optional
 
 import torch
 
@@ -11,6 +12,11 @@ def torch_save(content, file_name):
         torch.save(content, f)
 
 
-def torch_load(file_name):
+def torch_load(file_name, device: Optional[torch.device] = None):
+    # With a device, tensors are created directly on it instead of being loaded on the CPU and copied over.
+    if device is None:
+        map_location = lambda storage, loc: storage
+    else:
+        map_location = device
     with open(file_name, 'rb') as f:
-        return torch.load(f, map_location=lambda storage, loc: storage)
+        return torch.load(f, map_location=map_location)
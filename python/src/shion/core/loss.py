@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
-from typing import Callable, Optional
+from typing import Callable, Optional, List, Tuple
 
+import torch
 from torch import Tensor
 
 from shion.core.cached_computation import ComputationState
@@ -13,3 +14,30 @@ class Loss(ABC):
             state: ComputationState,
             log_func: Optional[Callable[[str, float], None]] = None) -> Tensor:
         pass
+
+    def get_read_keys(self) -> Optional[List[str]]:
+        # The keys of every protocol output that compute() reads, with repetition, or None if they are not known.
+        return None
+
+    def compute_with_terms(self, state: ComputationState) -> Tuple[Tensor, List[str], Tensor]:
+        """
+        Compute the loss together with its named components.
+
+        Returns the loss, the names of the components, and a detached 1D tensor holding the value of each component in
+        the same order. Keeping the components in one tensor lets them be logged later without a device sync per term.
+        The names are the tags that compute() would pass to its log_func. The default implementation collects them by
+        calling compute() with a log_func of its own.
+        """
+        names = []
+        values = []
+
+        def log_func(name: str, value):
+            names.append(name)
+            values.append(value)
+
+        loss = self.compute(state, log_func)
+        if len(names) == 0:
+            return loss, ["loss"], loss.detach().reshape(1)
+        component_values = [
+            torch.as_tensor(value, dtype=loss.dtype, device=loss.device).detach().reshape(1) for value in values]
+        return loss, names, torch.cat(component_values)
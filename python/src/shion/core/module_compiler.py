@@ -0,0 +1,103 @@
+import copy
+import logging
+import math
+import time
+from typing import Optional, List, Dict, Callable
+
+import torch
+from torch.nn import Module
+
+from shion.core.module_factory import ModuleFactory
+
+
+def is_torch_compile_available() -> bool:
+    return hasattr(torch, "compile")
+
+
+class ModuleCompiler:
+    def __init__(self,
+                 mode: Optional[str] = None,
+                 dynamic: Optional[bool] = None,
+                 fullgraph: bool = False,
+                 module_names: Optional[List[str]] = None,
+                 compile_accumulated_modules: bool = True):
+        if not is_torch_compile_available():
+            raise RuntimeError(f"torch.compile is not available in PyTorch {torch.__version__}. "
+                               f"PyTorch 2.0 or later is required.")
+        self.compile_accumulated_modules = compile_accumulated_modules
+        self.module_names = module_names
+        self.fullgraph = fullgraph
+        self.dynamic = dynamic
+        self.mode = mode
+
+    def should_compile(self, module_name: str) -> bool:
+        return self.module_names is None or module_name in self.module_names
+
+    def compile(self, module: Module) -> Module:
+        kwargs = {"fullgraph": self.fullgraph}
+        if self.mode is not None:
+            kwargs["mode"] = self.mode
+        if self.dynamic is not None:
+            kwargs["dynamic"] = self.dynamic
+        return torch.compile(module, **kwargs)
+
+    def compile_modules(self, modules: Dict[str, Module], accumulated_modules: Dict[str, Module]):
+        # torch.compile wraps the module without copying its parameters, so optimizers that were created from the
+        # original parameters keep working. Compilation itself happens lazily at the first forward pass.
+        for module_name in modules:
+            if self.should_compile(module_name):
+                modules[module_name] = self.compile(modules[module_name])
+                logging.info(f"Compiled module '{module_name}' (mode={self.mode}, dynamic={self.dynamic})")
+        if self.compile_accumulated_modules:
+            for module_name in accumulated_modules:
+                if self.should_compile(module_name):
+                    accumulated_modules[module_name] = self.compile(accumulated_modules[module_name])
+                    logging.info(f"Compiled accumulated module '{module_name}'")
+
+
+def benchmark_module_compilation(module_factory: ModuleFactory,
+                                 run_iteration: Callable[[Module], None],
+                                 module_compiler: ModuleCompiler,
+                                 device: torch.device,
+                                 num_warmup_iterations: int = 3,
+                                 num_iterations: int = 20) -> Dict[str, float]:
+    def synchronize():
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    def time_iterations(module: Module, count: int) -> float:
+        synchronize()
+        start_time = time.perf_counter()
+        for _ in range(count):
+            run_iteration(module)
+        synchronize()
+        return time.perf_counter() - start_time
+
+    eager_module = module_factory.create().to(device)
+    compiled_module = module_compiler.compile(copy.deepcopy(eager_module))
+
+    eager_first_seconds = time_iterations(eager_module, 1)
+    compiled_first_seconds = time_iterations(compiled_module, 1)
+    time_iterations(eager_module, num_warmup_iterations)
+    time_iterations(compiled_module, num_warmup_iterations)
+    eager_seconds = time_iterations(eager_module, num_iterations) / num_iterations
+    compiled_seconds = time_iterations(compiled_module, num_iterations) / num_iterations
+
+    compile_seconds = max(compiled_first_seconds - eager_first_seconds, 0.0)
+    saved_seconds_per_iteration = eager_seconds - compiled_seconds
+    if saved_seconds_per_iteration > 0:
+        break_even_iterations = compile_seconds / saved_seconds_per_iteration
+    else:
+        break_even_iterations = math.inf
+    result = {
+        "compile_seconds": compile_seconds,
+        "eager_seconds_per_iteration": eager_seconds,
+        "compiled_seconds_per_iteration": compiled_seconds,
+        "speedup": eager_seconds / compiled_seconds,
+        "break_even_iterations": break_even_iterations,
+    }
+    logging.info(f"Compilation took {compile_seconds:.2f}s. "
+                 f"Steady state: eager = {eager_seconds * 1000:.3f}ms/iter, "
+                 f"compiled = {compiled_seconds * 1000:.3f}ms/iter, speedup = {result['speedup']:.2f}x. "
+                 f"Compilation pays for itself after {break_even_iterations:.0f} iterations.")
+    return result
@@ -0,0 +1,184 @@
+import contextlib
+import copy
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, Any, Callable, List, Tuple, Optional
+
+import torch
+from torch.nn import Module
+
+from shion.core.loss import Loss
+from shion.core.training.metric_logger import MetricLogger, MetricValue
+from shion.core.training.sample_output_protocol import SampleOutputProtocol
+from shion.core.training.util import unwrap_module
+from shion.core.training.validation_protocol import ValidationProtocol
+
+MetricRecord = Tuple[str, MetricValue, int]
+
+
+class AsyncEvaluator:
+    """
+    Runs validation iterations and sample-output generation in a worker thread, so that the training loop does not
+    wait for them.
+
+    Each job works on frozen copies of the modules made when the job is submitted, so it sees the weights as of that
+    step while training keeps updating the originals. The losses and the protocols are copied in the same way. Metrics
+    logged by a job are recorded with the examples_seen_so_far of the step that submitted it and are written to the
+    metric logger from the training thread. At most max_pending_jobs jobs are in flight; submitting more waits for the
+    oldest one to finish. On CUDA, jobs run on their own stream.
+
+    The global RNG is shared by all threads. A job therefore holds rng_lock while it runs, with the RNG forked and
+    seeded from random_seed and the examples_seen_so_far of its step. The training thread holds the same lock through
+    guard_training_rng while it runs a training iteration, so training draws the same random numbers as it would
+    without this, and so does every job.
+    """
+
+    def __init__(self, max_pending_jobs: int = 1, random_seed: int = 0):
+        assert max_pending_jobs >= 1
+        self.random_seed = random_seed
+        self.rng_lock = threading.Lock()
+        self.max_pending_jobs = max_pending_jobs
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.pending_jobs: List[Future] = []
+        self.streams: Dict[torch.device, Any] = {}
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="async_evaluator")
+        return self.executor
+
+    def get_stream(self, device: torch.device):
+        if device not in self.streams:
+            self.streams[device] = torch.cuda.Stream(device)
+        return self.streams[device]
+
+    @staticmethod
+    def freeze_modules(modules: Dict[str, Module]) -> Dict[str, Module]:
+        frozen_modules = {}
+        for module_name in modules:
+            module = copy.deepcopy(unwrap_module(modules[module_name]))
+            module.train(False)
+            module.requires_grad_(False)
+            frozen_modules[module_name] = module
+        return frozen_modules
+
+    def run_seeded_job(self, job: Callable[[], None], device: torch.device, seed: int):
+        rng_devices = [device] if device.type == "cuda" else []
+        with self.rng_lock, torch.random.fork_rng(devices=rng_devices):
+            torch.random.default_generator.manual_seed(seed)
+            if device.type == "cuda":
+                torch.cuda.manual_seed(seed)
+            job()
+
+    def run_job(self, job: Callable[[], None], device: torch.device, ready_event, seed: int):
+        with torch.no_grad():
+            if device.type == "cuda":
+                with torch.cuda.device(device):
+                    stream = self.get_stream(device)
+                    stream.wait_event(ready_event)
+                    with torch.cuda.stream(stream):
+                        self.run_seeded_job(job, device, seed)
+                    stream.synchronize()
+            else:
+                self.run_seeded_job(job, device, seed)
+
+    def submit(self, job: Callable[[List[MetricRecord]], None], device: torch.device, examples_seen_so_far: int):
+        running_jobs = [pending_job for pending_job in self.pending_jobs if not pending_job.done()]
+        if len(running_jobs) >= self.max_pending_jobs:
+            # The single worker runs jobs in order, so waiting for this one leaves max_pending_jobs - 1 running.
+            running_jobs[len(running_jobs) - self.max_pending_jobs].result()
+        ready_event = None
+        if device.type == "cuda":
+            # The frozen copies and the inputs were produced on the training stream.
+            ready_event = torch.cuda.Event()
+            ready_event.record(torch.cuda.current_stream(device))
+        records = []
+
+        def run():
+            self.run_job(lambda: job(records), device, ready_event, self.random_seed + examples_seen_so_far)
+            return records
+
+        self.pending_jobs.append(self.get_executor().submit(run))
+
+    def submit_validation(self,
+                          validation_protocol: ValidationProtocol,
+                          batch: Any,
+                          examples_seen_so_far: int,
+                          modules: Dict[str, Module],
+                          accumulated_modules: Dict[str, Module],
+                          losses: Dict[str, Loss],
+                          device: torch.device):
+        frozen_modules = AsyncEvaluator.freeze_modules(modules)
+        frozen_accumulated_modules = AsyncEvaluator.freeze_modules(accumulated_modules)
+        validation_protocol = copy.deepcopy(validation_protocol)
+        losses = copy.deepcopy(losses)
+
+        def job(records: List[MetricRecord]):
+            def create_log_func(prefix: str, log_examples_seen_so_far: int):
+                def log_func(tag: str, value: MetricValue):
+                    records.append((prefix + "_" + tag, value, log_examples_seen_so_far))
+
+                return log_func
+
+            validation_protocol.run_validation_iteration(
+                batch,
+                examples_seen_so_far,
+                frozen_modules,
+                frozen_accumulated_modules,
+                losses,
+                create_log_func,
+                device)
+
+        self.submit(job, device, examples_seen_so_far)
+
+    def submit_sample_output(self,
+                             sample_output_protocol: SampleOutputProtocol,
+                             modules: Dict[str, Module],
+                             accumulated_modules: Dict[str, Module],
+                             sample_output_data: Any,
+                             prefix: str,
+                             examples_seen_so_far: int,
+                             device: torch.device):
+        frozen_modules = AsyncEvaluator.freeze_modules(modules)
+        frozen_accumulated_modules = AsyncEvaluator.freeze_modules(accumulated_modules)
+        sample_output_protocol = copy.deepcopy(sample_output_protocol)
+
+        def job(records: List[MetricRecord]):
+            sample_output_protocol.save_sample_output_data(
+                frozen_modules,
+                frozen_accumulated_modules,
+                sample_output_data,
+                prefix,
+                examples_seen_so_far,
+                device)
+
+        self.submit(job, device, examples_seen_so_far)
+
+    def write_finished_logs(self, metric_logger: Optional[MetricLogger]):
+        # Jobs finish in submission order because there is a single worker.
+        while len(self.pending_jobs) > 0 and self.pending_jobs[0].done():
+            records = self.pending_jobs.pop(0).result()
+            if metric_logger is not None:
+                for tag, value, examples_seen_so_far in records:
+                    metric_logger.log(tag, value, examples_seen_so_far)
+
+    def drain(self, metric_logger: Optional[MetricLogger]):
+        if len(self.pending_jobs) > 0:
+            logging.info(f"Waiting for {len(self.pending_jobs)} asynchronous evaluation job(s) to finish.")
+        for job in self.pending_jobs:
+            job.result()
+        self.write_finished_logs(metric_logger)
+
+    def close(self):
+        self.drain(None)
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def guard_training_rng(async_evaluator: Optional[AsyncEvaluator]):
+    # Keeps asynchronous jobs from drawing from the global RNG while the training thread does.
+    if async_evaluator is None:
+        return contextlib.nullcontext()
+    return async_evaluator.rng_lock
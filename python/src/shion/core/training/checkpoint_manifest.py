@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import time
+from typing import Dict, Any, List, Optional, Callable, Tuple
+
+from pytasuku.workspace import FuncFileTask
+
+ManifestEntry = Dict[str, Any]
+
+
+class CheckpointManifest:
+    """
+    An index, kept in <prefix>/checkpoint_manifest.jsonl, of the training states saved under a training prefix.
+
+    A save appends an entry marked incomplete before it writes the state. After the state is written, the manifest is
+    rewritten with a complete entry in its place, so it holds one entry per state. The state to resume from and the
+    freshness of checkpoint files can then be found with one read instead of probing every state directory. The last
+    entry of a state wins.
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.cached_entries: Optional[Dict[str, ManifestEntry]] = None
+        self.cached_stat: Optional[Tuple[int, int]] = None
+
+    def get_file_name(self) -> str:
+        return self.prefix + "/checkpoint_manifest.jsonl"
+
+    def get_state_key(self, state_prefix: str) -> str:
+        # Relative to the training prefix, so the manifest survives moving the whole directory.
+        return os.path.relpath(state_prefix, self.prefix).replace(os.sep, "/")
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.get_file_name())
+
+    def read(self) -> Optional[Dict[str, ManifestEntry]]:
+        try:
+            stat = os.stat(self.get_file_name())
+        except FileNotFoundError:
+            return None
+        if self.cached_stat == (stat.st_mtime_ns, stat.st_size):
+            return self.cached_entries
+        entries = {}
+        with open(self.get_file_name(), "rt") as fin:
+            for line in fin:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by a crash during an append.
+                    continue
+                entries[entry["state"]] = entry
+        self.cached_entries = entries
+        self.cached_stat = (stat.st_mtime_ns, stat.st_size)
+        return entries
+
+    def get_entry(self, state_prefix: str) -> Optional[ManifestEntry]:
+        entries = self.read()
+        if entries is None:
+            return None
+        return entries.get(self.get_state_key(state_prefix))
+
+    def create_entry(self,
+                     state_prefix: str,
+                     examples_seen_so_far: int,
+                     complete: bool,
+                     timestamp: Optional[float]) -> ManifestEntry:
+        return {
+            "state": self.get_state_key(state_prefix),
+            "examples_seen_so_far": examples_seen_so_far,
+            "complete": complete,
+            "time": timestamp,
+        }
+
+    def append(self, state_prefix: str, examples_seen_so_far: int, complete: bool):
+        entry = self.create_entry(state_prefix, examples_seen_so_far, complete, time.time())
+        if complete:
+            # Rewrite the manifest with only the latest entry of each state, so that it does not grow with every save.
+            entries = self.read()
+            if entries is None:
+                entries = {}
+            entries[entry["state"]] = entry
+            self.write(list(entries.values()))
+            return
+        os.makedirs(self.prefix, exist_ok=True)
+        # One write to a file opened with O_APPEND lands at the end in one piece.
+        fd = os.open(self.get_file_name(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(entry) + "\n").encode("utf-8"))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def write(self, entries: List[ManifestEntry]):
+        os.makedirs(self.prefix, exist_ok=True)
+        temp_file_name = self.get_file_name() + ".tmp"
+        with open(temp_file_name, "wt") as fout:
+            for entry in entries:
+                fout.write(json.dumps(entry) + "\n")
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(temp_file_name, self.get_file_name())
+
+    def probe(self,
+              state_prefixes: List[str],
+              can_load_func: Callable[[str], bool],
+              get_examples_seen_so_far_func: Callable[[str], int]) -> List[ManifestEntry]:
+        # The entries carry no time, so freshness checks fall back to the modification times of the files.
+        entries = []
+        for state_prefix in state_prefixes:
+            if can_load_func(state_prefix):
+                entries.append(self.create_entry(state_prefix, get_examples_seen_so_far_func(state_prefix), True, None))
+        return entries
+
+    def find_state_to_resume(self,
+                             state_prefixes: List[str],
+                             target_checkpoint_examples: int,
+                             batch_size: int,
+                             can_load_func: Callable[[str], bool],
+                             get_examples_seen_so_far_func: Callable[[str], int],
+                             can_write: bool = True) -> Optional[str]:
+        """
+        Return the first of state_prefixes whose state is complete and has not gone past target_checkpoint_examples by
+        a full batch, or None.
+
+        If there is no manifest yet, e.g. for a run started before manifests existed, every state is probed once and,
+        if can_write, the result is written as the manifest.
+        """
+        entries = self.read()
+        if entries is None:
+            logging.info(f"No checkpoint manifest at {self.get_file_name()}. Probing the saved training states.")
+            probed_entries = self.probe(state_prefixes, can_load_func, get_examples_seen_so_far_func)
+            if can_write:
+                self.write(probed_entries)
+            entries = {entry["state"]: entry for entry in probed_entries}
+        for state_prefix in state_prefixes:
+            entry = entries.get(self.get_state_key(state_prefix))
+            if entry is None or not entry["complete"]:
+                continue
+            if entry["examples_seen_so_far"] - target_checkpoint_examples >= batch_size:
+                continue
+            # Still check the one state that is picked, in case its files were removed by hand.
+            if can_load_func(state_prefix):
+                return state_prefix
+        return None
+
+
+class CheckpointFileTask(FuncFileTask):
+    """
+    A file task for a file of a saved training state that takes its timestamp from the checkpoint manifest, falling
+    back to the file system for states the manifest does not know about. The file exists if the manifest marks its
+    state complete and the file is on disk, so files removed by hand are rebuilt.
+    """
+
+    def __init__(self, workspace, name, dependencies, func, manifest: CheckpointManifest, state_prefix: str):
+        self.state_prefix = state_prefix
+        self.manifest = manifest
+        super().__init__(workspace, name, dependencies, func)
+
+    @property
+    def exists(self) -> bool:
+        entry = self.manifest.get_entry(self.state_prefix)
+        if entry is None:
+            return super().exists
+        return entry["complete"] and super().exists
+
+    @property
+    def timestamp(self) -> float:
+        entry = self.manifest.get_entry(self.state_prefix)
+        if entry is None or entry["time"] is None:
+            return super().timestamp
+        return entry["time"]
@@ -0,0 +1,71 @@
+import time
+from typing import Optional, Callable, Dict, Any
+
+import numpy
+import torch
+from torch.utils.data import DataLoader
+
+
+class DataLoaderOptions:
+    """
+    Worker settings for the DataLoaders that a trainer creates.
+
+    With persistent_workers, the worker processes, and the copies of the dataset they unpickled, live for the whole
+    run instead of being spawned again at every epoch and every time the validation data wraps around. Workers are then
+    seeded once, from the generator of the epoch in which they started, so random numbers drawn inside the workers of
+    a resumed run differ from those of a run that went straight through. It is off by default so that resuming
+    reproduces a straight-through run; turn it on when worker startup is costly and the dataset draws no random
+    numbers.
+    """
+
+    def __init__(self,
+                 persistent_workers: bool = False,
+                 prefetch_factor: Optional[int] = None,
+                 worker_init_func: Optional[Callable[[int], None]] = None):
+        self.worker_init_func = worker_init_func
+        self.prefetch_factor = prefetch_factor
+        self.persistent_workers = persistent_workers
+
+    def init_worker(self, worker_id: int):
+        # PyTorch seeds its own RNG and the random module in each worker, but not NumPy.
+        numpy.random.seed(torch.initial_seed() % (2 ** 32))
+        if self.worker_init_func is not None:
+            self.worker_init_func(worker_id)
+
+    def get_data_loader_kwargs(self, num_workers: int) -> Dict[str, Any]:
+        kwargs = {"num_workers": num_workers}
+        if num_workers == 0:
+            return kwargs
+        kwargs["persistent_workers"] = self.persistent_workers
+        kwargs["worker_init_fn"] = self.init_worker
+        if self.prefetch_factor is not None:
+            kwargs["prefetch_factor"] = self.prefetch_factor
+        return kwargs
+
+
+class TimedDataLoaderIterator:
+    """
+    An iterator over a DataLoader that measures the time from its creation to the arrival of its first batch. This is
+    where starting the worker processes shows up.
+    """
+
+    def __init__(self, data_loader: DataLoader):
+        self.start_time = time.time()
+        self.iterator = iter(data_loader)
+        self.startup_seconds = None
+        self.startup_seconds_reported = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = next(self.iterator)
+        if self.startup_seconds is None:
+            self.startup_seconds = time.time() - self.start_time
+        return batch
+
+    def pop_startup_seconds(self) -> Optional[float]:
+        if self.startup_seconds is None or self.startup_seconds_reported:
+            return None
+        self.startup_seconds_reported = True
+        return self.startup_seconds
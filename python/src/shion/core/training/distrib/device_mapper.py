@@ -15,3 +15,8 @@ class UserSpecifiedLocalRankToDeviceMapper:
     def __call__(self, rank, local_rank):
         assert local_rank in self.device_map
         return self.device_map[local_rank]
+
+
+class CpuDeviceMapper:
+    def __call__(self, rank, local_rank):
+        return torch.device("cpu")
@@ -3,23 +3,33 @@ import logging
 import os.path
 import time
 from datetime import datetime
-from typing import Dict, Optional, Callable
+from typing import Any, Dict, Optional, Callable, List
 
 import torch
 import torch.distributed
-from torch.nn.parallel import DistributedDataParallel
-from torch.utils.data import Dataset, DataLoader, DistributedSampler
+from torch.utils.data import Dataset, DataLoader
 from torch.utils.tensorboard import SummaryWriter
 
 from shion.core.load_save import torch_save, torch_load
 from shion.core.loss import Loss
 from shion.core.module_accumulator import ModuleAccumulator
+from shion.core.module_compiler import ModuleCompiler
 from shion.core.module_factory import ModuleFactory
+from shion.core.training.async_evaluator import AsyncEvaluator, guard_training_rng
+from shion.core.training.checkpoint_manifest import CheckpointManifest
+from shion.core.training.data_loader_options import DataLoaderOptions, TimedDataLoaderIterator
 from shion.core.training.distrib.device_mapper import SimpleCudaDeviceMapper
 from shion.core.training.distrib.distributed_training_states import DistributedTrainingState
+from shion.core.training.metric_logger import MetricLogger, SummaryWriterMetricLogger, DeferredMetricLogger
+from shion.core.training.resumable_batch_sampler import ResumableBatchSampler, KEY_VALIDATION_DATA_SAMPLER_STATE
 from shion.core.training.sample_output_protocol import SampleOutputProtocol
+from shion.core.training.scheduled_profiler import ScheduledProfiler
+from shion.core.training.step_timer import StepTimer, STEP_SECTION_DATA_WAIT, STEP_SECTION_TRAINING_ITERATION, \
+    STEP_SECTION_ACCUMULATION, STEP_SECTION_VALIDATION, STEP_SECTION_SAMPLE_OUTPUT, STEP_SECTION_CHECKPOINT, \
+    STEP_SECTION_LOGGING
 from shion.core.training.training_protocol import TrainingProtocol
-from shion.core.training.util import set_learning_rate, create_log_func, get_least_greater_multiple
+from shion.core.training.util import set_learning_rate, get_least_greater_multiple, unwrap_module, \
+    apply_batch_xform
 from shion.core.training.validation_protocol import ValidationProtocol
 
 KEY_CHECKPOINT = 'checkpoint'
@@ -42,7 +52,27 @@ class DistributedTrainer:
                  pretrained_module_file_names: Dict[str, str],
                  example_per_snapshot: int,
                  num_data_loader_workers: int = 8,
-                 distrib_backend: str = 'gloo'):
+                 distrib_backend: str = 'gloo',
+                 metric_flush_interval_steps: Optional[int] = None,
+                 metric_flush_interval_seconds: Optional[float] = None,
+                 module_compiler: Optional[ModuleCompiler] = None,
+                 step_timer: Optional[StepTimer] = None,
+                 scheduled_profiler: Optional[ScheduledProfiler] = None,
+                 async_evaluator: Optional[AsyncEvaluator] = None,
+                 data_loader_options: Optional[DataLoaderOptions] = None):
+        if scheduled_profiler is None:
+            scheduled_profiler = ScheduledProfiler([])
+        if data_loader_options is None:
+            data_loader_options = DataLoaderOptions()
+        self.data_loader_options = data_loader_options
+        self.async_evaluator = async_evaluator
+        self.scheduled_profiler = scheduled_profiler
+        if step_timer is None:
+            step_timer = StepTimer(enabled=False)
+        self.step_timer = step_timer
+        self.module_compiler = module_compiler
+        self.metric_flush_interval_seconds = metric_flush_interval_seconds
+        self.metric_flush_interval_steps = metric_flush_interval_steps
         self.distrib_backend = distrib_backend
         self.num_data_loader_workers = num_data_loader_workers
         self.accumulators = accumulators
@@ -71,13 +101,17 @@ class DistributedTrainer:
         self.training_data_sampler = None
 
         self.validation_data_loader = None
+        self.validation_data_sampler = None
         self.validation_data_loader_iter = None
         self.validation_data_loader_batch_size = None
 
         self.sample_output_data = None
         self.summary_writer = None
+        self.metric_logger = None
         self.log_dir = None
         self.training_state = None
+        self.training_loop_start_time = None
+        self.checkpoint_manifest = CheckpointManifest(prefix)
 
     def get_sample_output_data_file_name(self):
         return self.prefix + "/sample_output_data.pt"
@@ -122,7 +156,8 @@ class DistributedTrainer:
             rank,
             local_rank,
             device,
-            self.pretrained_module_file_names)
+            self.pretrained_module_file_names,
+            module_compiler=self.module_compiler)
 
     @staticmethod
     def checkpoint_prefix(prefix: str, checkpoint_index: int) -> str:
@@ -140,10 +175,30 @@ class DistributedTrainer:
             rank,
             local_rank,
             device,
-            self.pretrained_module_file_names)
+            self.pretrained_module_file_names,
+            module_compiler=self.module_compiler)
         logging.info("Created a new initial training state.")
         return training_state
 
+    def get_state_prefixes_to_resume_from(self) -> List[str]:
+        num_checkpoints = len(self.checkpoint_examples)
+        return [self.get_snapshot_prefix()] + [
+            self.get_checkpoint_prefix(checkpoint_index) for checkpoint_index in range(num_checkpoints - 1, -1, -1)
+        ]
+
+    def save_training_state(self,
+                            training_state: DistributedTrainingState,
+                            prefix: str,
+                            world_size: int,
+                            rank: int,
+                            local_rank: int):
+        # Only rank 0 writes the manifest, and save() returns on every rank only after all of them are done.
+        if rank == 0:
+            self.checkpoint_manifest.append(prefix, training_state.examples_seen_so_far, False)
+        training_state.save(prefix, rank, lambda: self.barrier(local_rank), world_size)
+        if rank == 0:
+            self.checkpoint_manifest.append(prefix, training_state.examples_seen_so_far, True)
+
     def load_previous_training_state(self,
                                      target_checkpoint_examples: int,
                                      world_size: int,
@@ -151,23 +206,18 @@ class DistributedTrainer:
                                      local_rank: int,
                                      device: torch.device) -> DistributedTrainingState:
         total_batch_size = self.training_protocol.get_batch_size() * world_size
-        if self.can_load_training_state(self.get_snapshot_prefix(), world_size):
-            examples_seen_so_far = DistributedTrainingState.get_examples_seen_so_far(self.get_snapshot_prefix())
-            diff = examples_seen_so_far - target_checkpoint_examples
-            if diff < total_batch_size:
-                return self.load_training_state(self.get_snapshot_prefix(), rank, local_rank, device)
-        num_checkpoints = len(self.checkpoint_examples)
-        for checkpoint_index in range(num_checkpoints - 1, -1, -1):
-            if self.can_load_training_state(self.get_checkpoint_prefix(checkpoint_index), world_size):
-                examples_seen_so_far = DistributedTrainingState.get_examples_seen_so_far(
-                    self.get_checkpoint_prefix(checkpoint_index))
-                diff = examples_seen_so_far - target_checkpoint_examples
-                if diff < total_batch_size:
-                    return self.load_training_state(
-                        self.get_checkpoint_prefix(checkpoint_index), rank, local_rank, device)
+        prefix = self.checkpoint_manifest.find_state_to_resume(
+            self.get_state_prefixes_to_resume_from(),
+            target_checkpoint_examples,
+            total_batch_size,
+            lambda state_prefix: self.can_load_training_state(state_prefix, world_size),
+            DistributedTrainingState.get_examples_seen_so_far,
+            can_write=rank == 0)
+        if prefix is not None:
+            return self.load_training_state(prefix, rank, local_rank, device)
 
         training_state = self.get_initial_training_state(rank, local_rank, device)
-        training_state.save(self.get_checkpoint_prefix(0), rank, lambda: self.barrier(local_rank))
+        self.save_training_state(training_state, self.get_checkpoint_prefix(0), world_size, rank, local_rank)
         training_state = self.load_training_state(self.get_checkpoint_prefix(0), rank, local_rank, device)
         return training_state
 
@@ -177,6 +227,9 @@ class DistributedTrainer:
             self.log_dir = self.prefix + "/log/" + now.strftime("%Y_%m_%d__%H_%M_%S")
         return self.log_dir
 
+    def get_profile_dir(self):
+        return self.prefix + "/profiles"
+
     def get_summary_writer(self, rank: int) -> Optional[SummaryWriter]:
         if rank != 0:
             return None
@@ -184,47 +237,93 @@ class DistributedTrainer:
             self.summary_writer = SummaryWriter(log_dir=self.get_log_dir())
         return self.summary_writer
 
-    def get_effective_training_epoch_size(self, world_size: int):
-        batch_size = self.training_protocol.get_batch_size()
-        N = len(self.training_dataset)
-        N = (N // world_size) * world_size
-        N = (N // batch_size) * batch_size
-        return N
-
-    def get_training_epoch_index(self, examples_seen_so_far: int, world_size: int):
-        epoch_size = self.get_effective_training_epoch_size(world_size)
-        batch_size = self.training_protocol.get_batch_size()
-        return (examples_seen_so_far + batch_size * world_size) // epoch_size
-
-    def get_next_training_batch(self, examples_seen_so_far: int, world_size: int, device: torch.device):
-        batch_size = self.training_protocol.get_batch_size()
-        dataset = self.training_dataset
+    def get_metric_logger(self, rank: int) -> Optional[MetricLogger]:
+        if rank != 0:
+            return None
+        if self.metric_logger is None:
+            if self.metric_flush_interval_steps is None and self.metric_flush_interval_seconds is None:
+                self.metric_logger = SummaryWriterMetricLogger(self.get_summary_writer(rank))
+            else:
+                self.metric_logger = DeferredMetricLogger(
+                    self.get_summary_writer(rank),
+                    self.metric_flush_interval_steps,
+                    self.metric_flush_interval_seconds)
+        return self.metric_logger
+
+    def get_training_data_sampler(self, world_size: int, rank: int) -> ResumableBatchSampler:
+        if self.training_data_sampler is None:
+            self.training_data_sampler = ResumableBatchSampler(
+                len(self.training_dataset),
+                self.training_protocol.get_batch_size(),
+                self.training_protocol.get_random_seed(),
+                num_replicas=world_size,
+                rank=rank)
+        return self.training_data_sampler
+
+    def restore_training_data_position(self, training_state: DistributedTrainingState, world_size: int, rank: int):
+        sampler = self.get_training_data_sampler(world_size, rank)
+        if training_state.data_sampler_state is not None:
+            sampler.load_state_dict(training_state.data_sampler_state)
+        else:
+            sampler.set_position_from_examples_seen_so_far(training_state.examples_seen_so_far)
+        self.training_data_loader_iter = None
+        if self.validation_dataset is not None and self.validation_protocol is not None:
+            validation_sampler = self.get_validation_data_sampler()
+            if training_state.data_sampler_state is not None \
+                    and KEY_VALIDATION_DATA_SAMPLER_STATE in training_state.data_sampler_state:
+                validation_sampler.load_state_dict(training_state.data_sampler_state[KEY_VALIDATION_DATA_SAMPLER_STATE])
+            self.validation_data_loader_iter = None
+
+    def get_validation_data_sampler(self) -> ResumableBatchSampler:
+        # Validation batches are drawn with their own generators, so that they do not consume the global RNG, and
+        # their position is saved with the training state.
+        if self.validation_data_sampler is None:
+            self.validation_data_sampler = ResumableBatchSampler(
+                len(self.validation_dataset),
+                self.validation_protocol.get_batch_size(),
+                self.training_protocol.get_random_seed())
+        return self.validation_data_sampler
+
+    def get_data_sampler_state(self) -> Dict[str, Any]:
+        data_sampler_state = self.training_data_sampler.state_dict()
+        if self.validation_data_sampler is not None:
+            data_sampler_state[KEY_VALIDATION_DATA_SAMPLER_STATE] = self.validation_data_sampler.state_dict()
+        return data_sampler_state
+
+    def start_training_data_iteration(self, sampler: ResumableBatchSampler):
+        logging.info(f"Started iterating over epoch: index = {sampler.epoch}, offset = {sampler.offset}")
+        self.training_data_loader.generator = sampler.create_data_loader_generator()
+        self.training_data_loader_iter = TimedDataLoaderIterator(self.training_data_loader)
+
+    def get_next_training_batch(self, world_size: int, rank: int, device: torch.device):
+        sampler = self.get_training_data_sampler(world_size, rank)
         if self.training_data_loader is None:
-            self.training_data_sampler = DistributedSampler(
-                dataset,
-                shuffle=True,
-                drop_last=True)
             self.training_data_loader = DataLoader(
-                dataset,
-                batch_size=batch_size,
-                sampler=self.training_data_sampler,
-                shuffle=False,
-                num_workers=self.num_data_loader_workers,
-                drop_last=True)
+                self.training_dataset,
+                batch_sampler=sampler,
+                **self.data_loader_options.get_data_loader_kwargs(self.num_data_loader_workers))
         if self.training_data_loader_iter is None:
-            epoch_index = self.get_training_epoch_index(examples_seen_so_far, world_size)
-            logging.info(f"Started a new epoch: index = {epoch_index}, examples_seen_so_far = {examples_seen_so_far}")
-            self.training_data_sampler.set_epoch(epoch_index)
-            self.training_data_loader_iter = iter(self.training_data_loader)
+            self.start_training_data_iteration(sampler)
         try:
             batch = next(self.training_data_loader_iter)
         except StopIteration:
-            epoch_index = self.get_training_epoch_index(examples_seen_so_far, world_size)
-            logging.info(f"Started a new epoch: index = {epoch_index}, examples_seen_so_far = {examples_seen_so_far}")
-            self.training_data_sampler.set_epoch(epoch_index)
-            self.training_data_loader_iter = iter(self.training_data_loader)
+            self.start_training_data_iteration(sampler)
             batch = next(self.training_data_loader_iter)
-        return [x.to(device) for x in batch]
+        epoch = sampler.epoch
+        sampler.advance()
+        return apply_batch_xform(self.training_dataset, [x.to(device) for x in batch], epoch)
+
+    def log_data_loader_startup_seconds(self, metric_logger: MetricLogger, examples_seen_so_far: int):
+        data_loader_iters = {
+            "training": self.training_data_loader_iter,
+            "validation": self.validation_data_loader_iter,
+        }
+        for name, data_loader_iter in data_loader_iters.items():
+            if data_loader_iter is None:
+                continue
+            startup_seconds = data_loader_iter.pop_startup_seconds()
+            if startup_seconds is not None:
+                metric_logger.log(name + "_data_loader_startup_seconds", startup_seconds, examples_seen_so_far)
 
     def get_next_checkpoint_num_examples(self, examples_seen_so_far) -> int:
         next_index = next(
@@ -258,21 +357,23 @@ class DistributedTrainer:
     def get_next_validation_batch(self, device: torch.device):
         if self.validation_dataset is None:
             return None
+        sampler = self.get_validation_data_sampler()
         if self.validation_data_loader is None:
             self.validation_data_loader = DataLoader(
                 self.validation_dataset,
-                batch_size=self.validation_protocol.get_batch_size(),
-                shuffle=True,
-                num_workers=1,
-                drop_last=True)
+                batch_sampler=sampler,
+                **self.data_loader_options.get_data_loader_kwargs(1))
         if self.validation_data_loader_iter is None:
-            self.validation_data_loader_iter = iter(self.validation_data_loader)
+            self.validation_data_loader.generator = sampler.create_data_loader_generator()
+            self.validation_data_loader_iter = TimedDataLoaderIterator(self.validation_data_loader)
         try:
             batch = next(self.validation_data_loader_iter)
         except StopIteration:
-            self.validation_data_loader_iter = iter(self.validation_data_loader)
+            self.validation_data_loader.generator = sampler.create_data_loader_generator()
+            self.validation_data_loader_iter = TimedDataLoaderIterator(self.validation_data_loader)
             batch = next(self.validation_data_loader_iter)
-        return [x.to(device) for x in batch]
+        sampler.advance()
+        return apply_batch_xform(self.validation_dataset, [x.to(device) for x in batch], 0)
 
     def get_checkpoint_index_to_save(self, examples_seen_so_far: int) -> int:
         checkpoint_index = 0
@@ -293,6 +394,7 @@ class DistributedTrainer:
               local_rank: int,
               target_checkpoint_examples: Optional[int] = None,
               device_mapper: Optional[Callable[[int, int], torch.device]] = None):
+        train_start_time = time.time()
         if target_checkpoint_examples is None:
             target_checkpoint_examples = self.checkpoint_examples[-1]
 
@@ -303,93 +405,162 @@ class DistributedTrainer:
         sample_output_data = self.load_sample_output_data(rank, device)
         training_state = self.load_previous_training_state(
             target_checkpoint_examples, world_size, rank, local_rank, device)
-        summary_writer = self.get_summary_writer(rank)
-        if summary_writer is not None:
-            log_func_factory = lambda name, num: create_log_func(summary_writer, name, num)
+        self.restore_training_data_position(training_state, world_size, rank)
+        if training_state.training_protocol_state is not None:
+            self.training_protocol.load_state_dict(training_state.training_protocol_state)
+        metric_logger = self.get_metric_logger(rank)
+        if metric_logger is not None:
+            log_func_factory = metric_logger.create_log_func
         else:
             log_func_factory = None
+        step_timer = self.step_timer
+        scheduled_profiler = self.scheduled_profiler
+        summary_writer = self.get_summary_writer(rank)
         last_time = time.time()
+        self.training_loop_start_time = last_time
+        logging.info(f"[Rank {rank}] Time to first training step: {last_time - train_start_time:.3f} seconds")
 
-        while training_state.examples_seen_so_far < target_checkpoint_examples:
-            # Set the learning rate
-            learning_rate_by_module_name = self.training_protocol.get_learning_rate(training_state.examples_seen_so_far)
-            for module_name in self.module_factories.keys():
-                if module_name not in learning_rate_by_module_name or module_name not in training_state.optimizers:
-                    continue
-                lr = learning_rate_by_module_name[module_name]
-                set_learning_rate(training_state.optimizers[module_name], lr)
-                if summary_writer is not None:
-                    summary_writer.add_scalar(
-                        module_name + "_learning_rate", lr, training_state.examples_seen_so_far)
-
-            # One training iteration
-            training_batch = self.get_next_training_batch(training_state.examples_seen_so_far, world_size, device)
-            self.training_protocol.run_training_iteration(
-                training_batch,
-                training_state.examples_seen_so_far,
-                training_state.modules,
-                training_state.accumulated_modules,
-                training_state.optimizers,
-                self.losses,
-                log_func_factory,
-                device)
-
-            # Accumulate model data
-            for module_name in self.accumulators:
-                new_module = training_state.modules[module_name]
-                if isinstance(new_module, DistributedDataParallel):
-                    new_module = new_module.module
-                buffer_module = training_state.accumulated_modules[module_name]
-                self.accumulators[module_name].accumulate(
-                    new_module, buffer_module, examples_seen_so_far=training_state.examples_seen_so_far)
-
-            # Advance the number of examples seen so far
-            next_num_examples = self.get_next_num_examples(training_state.examples_seen_so_far)
-            training_state.examples_seen_so_far += self.training_protocol.get_batch_size() * world_size
-
-            # Validation iteration
-            if self.validation_protocol is not None \
-                    and training_state.examples_seen_so_far >= next_num_examples[KEY_VALIDATION] \
-                    and rank == 0:
-                validation_batch = self.get_next_validation_batch(device)
-                self.validation_protocol.run_validation_iteration(
-                    validation_batch,
-                    training_state.examples_seen_so_far,
-                    training_state.modules,
-                    training_state.accumulated_modules,
-                    self.losses,
-                    log_func_factory,
-                    device)
-
-            # Save sample output
-            if self.sample_output_protocol is not None \
-                    and training_state.examples_seen_so_far >= next_num_examples[KEY_SAMPLE_OUTPUT]:
-                if rank == 0:
-                    self.sample_output_protocol.save_sample_output_data(
+        try:
+            while training_state.examples_seen_so_far < target_checkpoint_examples:
+                scheduled_profiler.begin_step(
+                    training_state.examples_seen_so_far, self.training_protocol.get_batch_size() * world_size)
+
+                # Set the learning rate
+                learning_rate_by_module_name = self.training_protocol.get_learning_rate(
+                    training_state.examples_seen_so_far)
+                for module_name in self.module_factories.keys():
+                    if module_name not in learning_rate_by_module_name or module_name not in training_state.optimizers:
+                        continue
+                    lr = learning_rate_by_module_name[module_name]
+                    set_learning_rate(training_state.optimizers[module_name], lr)
+                    if metric_logger is not None:
+                        metric_logger.log(module_name + "_learning_rate", lr, training_state.examples_seen_so_far)
+
+                # One training iteration
+                with step_timer.section(STEP_SECTION_DATA_WAIT):
+                    training_batch = self.get_next_training_batch(world_size, rank, device)
+                with step_timer.section(STEP_SECTION_TRAINING_ITERATION), guard_training_rng(self.async_evaluator):
+                    self.training_protocol.run_training_iteration(
+                        training_batch,
+                        training_state.examples_seen_so_far,
                         training_state.modules,
                         training_state.accumulated_modules,
-                        sample_output_data,
-                        self.prefix + "/sample_outputs",
-                        training_state.examples_seen_so_far,
+                        training_state.optimizers,
+                        self.losses,
+                        log_func_factory,
                         device)
-                self.barrier(local_rank)
-
-            # Save checkpoint
-            if training_state.examples_seen_so_far >= next_num_examples[KEY_CHECKPOINT]:
-                checkpoint_index = self.get_checkpoint_index_to_save(training_state.examples_seen_so_far)
-                training_state.save(
-                    self.get_checkpoint_prefix(checkpoint_index), rank, lambda: self.barrier(local_rank))
-                if next_num_examples[KEY_CHECKPOINT] != next_num_examples[KEY_SNAPSHOT]:
-                    training_state.save(self.get_snapshot_prefix(), rank, lambda: self.barrier(local_rank))
-
-            # Save snapshot
-            if training_state.examples_seen_so_far >= next_num_examples[KEY_SNAPSHOT]:
-                training_state.save(self.get_snapshot_prefix(), rank, lambda: self.barrier(local_rank))
-
-            now = time.time()
-            if now - last_time > 10:
-                logging.info("Showed %d training examples." % training_state.examples_seen_so_far)
-                last_time = now
+
+                # Accumulate model data
+                with step_timer.section(STEP_SECTION_ACCUMULATION):
+                    for module_name in self.accumulators:
+                        new_module = unwrap_module(training_state.modules[module_name])
+                        buffer_module = unwrap_module(training_state.accumulated_modules[module_name])
+                        self.accumulators[module_name].accumulate(
+                            new_module, buffer_module, examples_seen_so_far=training_state.examples_seen_so_far)
+
+                # Advance the number of examples seen so far
+                next_num_examples = self.get_next_num_examples(training_state.examples_seen_so_far)
+                training_state.examples_seen_so_far += self.training_protocol.get_batch_size() * world_size
+
+                # Validation iteration
+                with step_timer.section(STEP_SECTION_VALIDATION):
+                    if self.validation_protocol is not None \
+                            and training_state.examples_seen_so_far >= next_num_examples[KEY_VALIDATION] \
+                            and rank == 0:
+                        validation_batch = self.get_next_validation_batch(device)
+                        if self.async_evaluator is not None:
+                            self.async_evaluator.submit_validation(
+                                self.validation_protocol,
+                                validation_batch,
+                                training_state.examples_seen_so_far,
+                                training_state.modules,
+                                training_state.accumulated_modules,
+                                self.losses,
+                                device)
+                        else:
+                            self.validation_protocol.run_validation_iteration(
+                                validation_batch,
+                                training_state.examples_seen_so_far,
+                                training_state.modules,
+                                training_state.accumulated_modules,
+                                self.losses,
+                                log_func_factory,
+                                device)
+
+                training_state.data_sampler_state = self.get_data_sampler_state()
+
+                # Save sample output
+                with step_timer.section(STEP_SECTION_SAMPLE_OUTPUT):
+                    if self.sample_output_protocol is not None \
+                            and training_state.examples_seen_so_far >= next_num_examples[KEY_SAMPLE_OUTPUT]:
+                        if rank == 0:
+                            if self.async_evaluator is not None:
+                                self.async_evaluator.submit_sample_output(
+                                    self.sample_output_protocol,
+                                    training_state.modules,
+                                    training_state.accumulated_modules,
+                                    sample_output_data,
+                                    self.prefix + "/sample_outputs",
+                                    training_state.examples_seen_so_far,
+                                    device)
+                            else:
+                                self.sample_output_protocol.save_sample_output_data(
+                                    training_state.modules,
+                                    training_state.accumulated_modules,
+                                    sample_output_data,
+                                    self.prefix + "/sample_outputs",
+                                    training_state.examples_seen_so_far,
+                                    device)
+                        if self.async_evaluator is None:
+                            # Only rank 0 renders the sample outputs; with asynchronous evaluation the other ranks do
+                            # not need to wait for it.
+                            self.barrier(local_rank)
+
+                # Save checkpoint
+                with step_timer.section(STEP_SECTION_CHECKPOINT):
+                    if training_state.examples_seen_so_far >= next_num_examples[KEY_CHECKPOINT]:
+                        training_state.training_protocol_state = self.training_protocol.state_dict()
+                        checkpoint_index = self.get_checkpoint_index_to_save(training_state.examples_seen_so_far)
+                        self.save_training_state(
+                            training_state,
+                            self.get_checkpoint_prefix(checkpoint_index),
+                            world_size,
+                            rank,
+                            local_rank)
+                        if next_num_examples[KEY_CHECKPOINT] != next_num_examples[KEY_SNAPSHOT]:
+                            self.save_training_state(
+                                training_state, self.get_snapshot_prefix(), world_size, rank, local_rank)
+
+                # Save snapshot
+                with step_timer.section(STEP_SECTION_CHECKPOINT):
+                    if training_state.examples_seen_so_far >= next_num_examples[KEY_SNAPSHOT]:
+                        training_state.training_protocol_state = self.training_protocol.state_dict()
+                        self.save_training_state(
+                            training_state, self.get_snapshot_prefix(), world_size, rank, local_rank)
+
+                with step_timer.section(STEP_SECTION_LOGGING):
+                    if self.async_evaluator is not None:
+                        self.async_evaluator.write_finished_logs(metric_logger)
+                    if metric_logger is not None:
+                        self.log_data_loader_startup_seconds(metric_logger, training_state.examples_seen_so_far)
+                        metric_logger.step()
+                scheduled_profiler.end_step(self.get_profile_dir(), summary_writer, rank)
+                step_timer.step()
+
+                now = time.time()
+                if now - last_time > 10:
+                    logging.info("Showed %d training examples." % training_state.examples_seen_so_far)
+                    if metric_logger is not None:
+                        logging.info("Metric logging overhead: %f seconds per step."
+                                     % metric_logger.get_overhead_seconds_per_step())
+                    last_time = now
+
+            if self.async_evaluator is not None:
+                self.async_evaluator.drain(metric_logger)
+            scheduled_profiler.finish(self.get_profile_dir(), summary_writer, rank)
+        finally:
+            if metric_logger is not None:
+                metric_logger.close()
 
     @staticmethod
     def run(trainer_factory: Callable[[int, str], 'DistributedTrainer'],
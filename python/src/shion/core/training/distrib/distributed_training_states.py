@@ -1,21 +1,28 @@
 import copy
 import logging
 import os
-from typing import Dict, Optional, Callable
+import time
+from typing import Dict, Optional, Callable, Any
 
 import torch
 from torch.nn import Module
-from torch.nn.parallel import DistributedDataParallel
 from torch.optim.optimizer import Optimizer
 
 from shion.core.load_save import torch_save, torch_load
 from shion.core.module_accumulator import ModuleAccumulator
+from shion.core.module_compiler import ModuleCompiler
 from shion.core.module_factory import ModuleFactory
 from shion.core.optimizer_factory import OptimizerFactory
-from shion.core.training.util import optimizer_to_device
+from shion.core.training.distrib.elastic_resume import save_world_size, get_saved_world_size, restore_rng_state
+from shion.core.training.distrib.sharded_checkpoint import get_default_world_size, save_files_round_robin, \
+    load_files_round_robin
+from shion.core.training.util import optimizer_to_device, unwrap_module, create_distributed_data_parallel, \
+    create_module_from_state_dict
 
 
 def print_peak_memory(prefix, device):
+    if not torch.cuda.is_available():
+        return
     print(f"{prefix}: {torch.cuda.max_memory_allocated(device) // 1e6}MB ")
 
 
@@ -24,7 +31,11 @@ class DistributedTrainingState:
                  examples_seen_so_far: int,
                  modules: Dict[str, Module],
                  accumulated_modules: Dict[str, Module],
-                 optimizers: Dict[str, Optimizer]):
+                 optimizers: Dict[str, Optimizer],
+                 data_sampler_state: Optional[Dict[str, Any]] = None,
+                 training_protocol_state: Optional[Dict[str, Any]] = None):
+        self.training_protocol_state = training_protocol_state
+        self.data_sampler_state = data_sampler_state
         self.accumulated_modules = accumulated_modules
         self.optimizers = optimizers
         self.modules = modules
@@ -46,6 +57,14 @@ class DistributedTrainingState:
     def get_optimizer_file_name(prefix, module_name) -> str:
         return "%s/optimizer_%s.pt" % (prefix, module_name)
 
+    @staticmethod
+    def get_data_sampler_state_file_name(prefix) -> str:
+        return "%s/data_sampler_state.pt" % prefix
+
+    @staticmethod
+    def get_training_protocol_state_file_name(prefix) -> str:
+        return "%s/training_protocol_state.pt" % prefix
+
     @staticmethod
     def get_rng_state_file_name(prefix, rank: int):
         return "%s/rng_state_%08d.pt" % (prefix, rank)
@@ -53,45 +72,61 @@ class DistributedTrainingState:
     def mkdir(self, prefix: str):
         os.makedirs(prefix, exist_ok=True)
 
-    def save_data(self, prefix: str, rank: int):
+    def save_data(self, prefix: str, rank: int, world_size: Optional[int] = None):
         assert os.path.exists(prefix)
+        if world_size is None:
+            world_size = get_default_world_size()
 
         torch_save(torch.get_rng_state(), DistributedTrainingState.get_rng_state_file_name(prefix, rank))
         logging.info("Saved %s" % DistributedTrainingState.get_rng_state_file_name(prefix, rank))
 
         if rank == 0:
             logging.info("Saving training state to %s" % prefix)
+            save_world_size(prefix, world_size)
             with open(DistributedTrainingState.get_examples_seen_so_far_file_name(prefix), "wt") as fout:
                 fout.write("%d\n" % self.examples_seen_so_far)
                 logging.info("Saved %s" % DistributedTrainingState.get_examples_seen_so_far_file_name(prefix))
-            for module_name in self.modules:                
-                if module_name not in self.optimizers:
-                    continue
-                file_name = DistributedTrainingState.get_module_file_name(prefix, module_name)
-                module = self.modules[module_name]
-                if isinstance(module, DistributedDataParallel):
-                    state_dict = module.module.state_dict()
-                else:
-                    state_dict = module.state_dict()
-                torch_save(state_dict, file_name)
-                logging.info("Saved %s" % file_name)
-            for module_name in self.accumulated_modules:
-                file_name = DistributedTrainingState.get_accumulated_module_file_name(prefix, module_name)
-                torch_save(self.accumulated_modules[module_name].state_dict(), file_name)
+            if self.data_sampler_state is not None:
+                file_name = DistributedTrainingState.get_data_sampler_state_file_name(prefix)
+                torch_save(self.data_sampler_state, file_name)
                 logging.info("Saved %s" % file_name)
-            for module_name in self.optimizers:
-                file_name = DistributedTrainingState.get_optimizer_file_name(prefix, module_name)
-                torch_save(self.optimizers[module_name].state_dict(), file_name)
+            if self.training_protocol_state is not None:
+                file_name = DistributedTrainingState.get_training_protocol_state_file_name(prefix)
+                torch_save(self.training_protocol_state, file_name)
                 logging.info("Saved %s" % file_name)
 
+        # The modules are replicated on all ranks, so any rank can write any of them.
+        items = []
+        for module_name in self.modules:
+            if module_name not in self.optimizers:
+                continue
+            module = unwrap_module(self.modules[module_name])
+            items.append((
+                DistributedTrainingState.get_module_file_name(prefix, module_name),
+                lambda module=module: module.state_dict()))
+        for module_name in self.accumulated_modules:
+            module = unwrap_module(self.accumulated_modules[module_name])
+            items.append((
+                DistributedTrainingState.get_accumulated_module_file_name(prefix, module_name),
+                lambda module=module: module.state_dict()))
+        for module_name in self.optimizers:
+            optimizer = self.optimizers[module_name]
+            items.append((
+                DistributedTrainingState.get_optimizer_file_name(prefix, module_name),
+                lambda optimizer=optimizer: optimizer.state_dict()))
+        save_files_round_robin(items, rank, world_size)
+
         logging.info("Done saving training state to %s" % prefix)
 
-    def save(self, prefix: str, rank: int, barrier_func: Callable[[], None]):
+    def save(self, prefix: str, rank: int, barrier_func: Callable[[], None], world_size: Optional[int] = None):
+        start_time = time.time()
         if rank == 0:
             self.mkdir(prefix)
         barrier_func()
-        self.save_data(prefix, rank)
+        self.save_data(prefix, rank, world_size)
         barrier_func()
+        if rank == 0:
+            logging.info(f"Saving training state to {prefix} took {time.time() - start_time:.3f} seconds.")
 
     @staticmethod
     def get_examples_seen_so_far(prefix: str) -> int:
@@ -108,75 +143,94 @@ class DistributedTrainingState:
             rank: int,
             local_rank: int,
             device: torch.device,
-            pretrained_module_file_names: Optional[Dict[str, str]] = None) -> 'DistributedTrainingState':
+            pretrained_module_file_names: Optional[Dict[str, str]] = None,
+            module_compiler: Optional[ModuleCompiler] = None) -> 'DistributedTrainingState':
         if pretrained_module_file_names is None:
             pretrained_module_file_names = {}
 
         logging.info(f"[Rank {rank}] Loading training state from {prefix}")
+        start_time = time.time()
 
         with open(DistributedTrainingState.get_examples_seen_so_far_file_name(prefix)) as fin:
             lines = fin.readlines()
             examples_seen_so_far = int(lines[0])
             logging.info(f"[Rank {rank}] Loaded {DistributedTrainingState.get_examples_seen_so_far_file_name(prefix)}")
 
-        modules = {
-            module_name: factory.create()
-            for (module_name, factory) in module_factories.items()
-        }
-        for module_name in modules:
+        module_file_names = {}
+        for module_name in module_factories:
             if module_name in optimizer_factories:
-                file_name = DistributedTrainingState.get_module_file_name(prefix, module_name)
+                module_file_names[module_name] = DistributedTrainingState.get_module_file_name(prefix, module_name)
             else:
                 assert module_name in pretrained_module_file_names
-                file_name = pretrained_module_file_names[module_name]
-            module = modules[module_name]
-            state_dict = torch_load(file_name)
-            module.load_state_dict(state_dict)
-            module.to(device)
-            modules[module_name] = DistributedDataParallel(
-                module,
-                device_ids=[device.index],
-                output_device=device.index)
-            logging.info(f"[Rank {rank}] Loaded module '{module_name}' from {file_name}")
+                module_file_names[module_name] = pretrained_module_file_names[module_name]
+        accumulated_module_file_names = {
+            module_name: DistributedTrainingState.get_accumulated_module_file_name(prefix, module_name)
+            for module_name in accumulators
+        }
+        optimizer_file_names = {
+            module_name: DistributedTrainingState.get_optimizer_file_name(prefix, module_name)
+            for module_name in optimizer_factories
+        }
+        file_names = list(module_file_names.values()) \
+                     + list(accumulated_module_file_names.values()) \
+                     + list(optimizer_file_names.values())
+        world_size = get_default_world_size()
+        contents = dict(zip(file_names, load_files_round_robin(file_names, rank, world_size, device)))
+
+        modules = {}
+        for module_name in module_factories:
+            module = create_module_from_state_dict(
+                module_factories[module_name], contents[module_file_names[module_name]], device)
+            modules[module_name] = create_distributed_data_parallel(module, device)
+            logging.info(f"[Rank {rank}] Loaded module '{module_name}' from {module_file_names[module_name]}")
 
         print_peak_memory(f"[rank={rank}] Max memory allocated after loading models", rank)
 
         accumulated_modules = {}
         for module_name in accumulators:
-            module_factory = module_factories[module_name]
-            module = module_factory.create()
-            file_name = DistributedTrainingState.get_accumulated_module_file_name(prefix, module_name)
-            module.load_state_dict(torch_load(file_name))
-            module.to(device)
-            accumulated_modules[module_name] = module
-            logging.info(f"[Rank {rank}] Loaded {file_name}")
+            accumulated_modules[module_name] = create_module_from_state_dict(
+                module_factories[module_name], contents[accumulated_module_file_names[module_name]], device)
 
         print_peak_memory(f"[rank={rank}] Max memory allocated after loading accumulated models", rank)
 
         optimizers = {}
         for module_name in optimizer_factories:
             optimizer = optimizer_factories[module_name].create(modules[module_name].parameters())
-            file_name = DistributedTrainingState.get_optimizer_file_name(prefix, module_name)
-            optimizer.load_state_dict(torch_load(file_name))
-            optimizer_to_device(optimizer, device)
+            # load_state_dict moves the state to the devices of the parameters.
+            optimizer.load_state_dict(contents[optimizer_file_names[module_name]])
             optimizers[module_name] = optimizer
-            logging.info(f"[Rank {rank}] Loaded {file_name}")
-
-            #print(len(optimizer.param_groups))
-            #print(optimizer.param_groups[0].keys())
-            #print(len(optimizer.param_groups[0]['params']))
-            #count = 1
-            #for param in optimizer.param_groups[0]['params']:
-            #    print(param.data.shape)
+        contents = None
 
         print_peak_memory(f"[rank={rank}] Max memory allocated after loading optimizers", rank)
 
-        torch.set_rng_state(torch_load(DistributedTrainingState.get_rng_state_file_name(prefix, rank)))
+        data_sampler_state = None
+        if os.path.isfile(DistributedTrainingState.get_data_sampler_state_file_name(prefix)):
+            data_sampler_state = torch_load(DistributedTrainingState.get_data_sampler_state_file_name(prefix))
+            logging.info(f"[Rank {rank}] Loaded {DistributedTrainingState.get_data_sampler_state_file_name(prefix)}")
+
+        training_protocol_state = None
+        if os.path.isfile(DistributedTrainingState.get_training_protocol_state_file_name(prefix)):
+            training_protocol_state = torch_load(DistributedTrainingState.get_training_protocol_state_file_name(prefix))
+            logging.info(f"[Rank {rank}] Loaded {DistributedTrainingState.get_training_protocol_state_file_name(prefix)}")
+
+        saved_world_size = get_saved_world_size(prefix)
+        if saved_world_size is None:
+            saved_world_size = get_default_world_size()
+        if saved_world_size != get_default_world_size():
+            logging.info(f"[Rank {rank}] Resuming a checkpoint written by {saved_world_size} processes "
+                         f"with {get_default_world_size()} processes")
+        restore_rng_state(lambda r: DistributedTrainingState.get_rng_state_file_name(prefix, r), rank, saved_world_size)
         logging.info(f"[Rank {rank}] Loaded {DistributedTrainingState.get_examples_seen_so_far_file_name(prefix)}")
 
-        logging.info(f"[Rank {rank}] Done loading training state from {prefix}")
+        logging.info(f"[Rank {rank}] Done loading training state from {prefix} "
+                     f"in {time.time() - start_time:.3f} seconds.")
 
-        return DistributedTrainingState(examples_seen_so_far, modules, accumulated_modules, optimizers)
+        if module_compiler is not None:
+            module_compiler.compile_modules(modules, accumulated_modules)
+
+        return DistributedTrainingState(
+            examples_seen_so_far, modules, accumulated_modules, optimizers, data_sampler_state,
+            training_protocol_state)
 
     @staticmethod
     def new(module_factories: Dict[str, ModuleFactory],
@@ -186,7 +240,8 @@ class DistributedTrainingState:
             rank: int,
             local_rank: int,
             device: torch.device,
-            pretrained_module_file_names: Optional[Dict[str, str]] = None) -> 'DistributedTrainingState':
+            pretrained_module_file_names: Optional[Dict[str, str]] = None,
+            module_compiler: Optional[ModuleCompiler] = None) -> 'DistributedTrainingState':
         examples_seen_so_far = 0
 
         modules = {
@@ -208,10 +263,7 @@ class DistributedTrainingState:
 
         for module_name in modules:
             module = modules[module_name]
-            modules[module_name] = DistributedDataParallel(
-                module,
-                device_ids=[device.index],
-                output_device=device.index)
+            modules[module_name] = create_distributed_data_parallel(module, device)
 
         optimizers = {}
         for module_name in optimizer_factories:
@@ -222,6 +274,9 @@ class DistributedTrainingState:
 
         torch.manual_seed(random_seed + rank)
 
+        if module_compiler is not None:
+            module_compiler.compile_modules(modules, accumulated_modules)
+
         return DistributedTrainingState(examples_seen_so_far, modules, accumulated_modules, optimizers)
 
     @staticmethod
@@ -260,7 +315,11 @@ class DistributedTrainingState:
             if not os.path.isfile(file_name):
                 logging.info(f"Cannot load files in {prefix} because {file_name} is not a file.")
                 return False
-        for rank in range(world_size):
+        # The RNG states of the ranks that wrote the checkpoint are enough to resume at any world size.
+        saved_world_size = get_saved_world_size(prefix)
+        if saved_world_size is None:
+            saved_world_size = world_size
+        for rank in range(saved_world_size):
             file_name = DistributedTrainingState.get_rng_state_file_name(prefix, rank)
             if not os.path.isfile(file_name):
                 logging.info(f"Cannot load files in {prefix} because {file_name} is not a file.")
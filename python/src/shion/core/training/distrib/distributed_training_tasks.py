@@ -3,6 +3,7 @@ import sys
 from typing import Callable, List, Optional
 
 from pytasuku import Workspace
+from shion.core.training.checkpoint_manifest import CheckpointFileTask
 from shion.core.training.distrib.distributed_trainer import DistributedTrainer
 from shion.core.training.distrib.distributed_training_script_util import run_distributed_training_script, RdzvConfig, \
     run_standalone_distributed_training_script
@@ -64,18 +65,24 @@ def define_standalone_distributed_training_tasks(
             module_file_name = DistributedTrainingState.get_module_file_name(
                 trainer.get_checkpoint_prefix(checkpoint_index),
                 module_name)
-            workspace.create_file_task(
+            CheckpointFileTask(
+                workspace,
                 module_file_name,
                 module_file_dependencies,
-                create_train_func(trainer.checkpoint_examples[checkpoint_index]))
+                create_train_func(trainer.checkpoint_examples[checkpoint_index]),
+                trainer.checkpoint_manifest,
+                trainer.get_checkpoint_prefix(checkpoint_index))
         for module_name in trainer.accumulators:
             accumulated_module_file_name = DistributedTrainingState.get_accumulated_module_file_name(
                 trainer.get_checkpoint_prefix(checkpoint_index),
                 module_name)
-            workspace.create_file_task(
+            CheckpointFileTask(
+                workspace,
                 accumulated_module_file_name,
                 module_file_dependencies,
-                create_train_func(checkpoint_examples[checkpoint_index]))
+                create_train_func(checkpoint_examples[checkpoint_index]),
+                trainer.checkpoint_manifest,
+                trainer.get_checkpoint_prefix(checkpoint_index))
         workspace.create_command_task(
             trainer.get_checkpoint_prefix(checkpoint_index) + "/train_standalone",
             module_file_dependencies,
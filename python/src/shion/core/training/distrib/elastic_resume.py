@@ -0,0 +1,51 @@
+import logging
+import os
+from typing import Optional, Callable
+
+import torch
+
+from shion.core.load_save import torch_load
+
+
+def get_world_size_file_name(prefix: str) -> str:
+    return prefix + "/world_size.txt"
+
+
+def save_world_size(prefix: str, world_size: int):
+    file_name = get_world_size_file_name(prefix)
+    with open(file_name, "wt") as fout:
+        fout.write("%d\n" % world_size)
+    logging.info("Saved %s" % file_name)
+
+
+def get_saved_world_size(prefix: str) -> Optional[int]:
+    # Checkpoints written before the world size was recorded return None.
+    file_name = get_world_size_file_name(prefix)
+    if not os.path.isfile(file_name):
+        return None
+    with open(file_name) as fin:
+        lines = fin.readlines()
+        return int(lines[0])
+
+
+def get_rng_source_rank(rank: int, saved_world_size: int) -> int:
+    return rank % saved_world_size
+
+
+def restore_rng_state(get_rng_state_file_name: Callable[[int], str], rank: int, saved_world_size: int):
+    """
+    Restore the global RNG state of this rank from a checkpoint written with saved_world_size processes.
+
+    A rank that existed when the checkpoint was written gets its own stream back. A new rank takes over the stream of
+    rank (rank % saved_world_size) and then reseeds from it, so that its stream is deterministic but different from
+    that of every other rank.
+    """
+    source_rank = get_rng_source_rank(rank, saved_world_size)
+    file_name = get_rng_state_file_name(source_rank)
+    torch.set_rng_state(torch_load(file_name))
+    if source_rank != rank:
+        seed = int(torch.randint(0, 2 ** 31, (1,)).item()) + rank
+        torch.manual_seed(seed)
+        logging.info(f"[Rank {rank}] Derived the RNG state from {file_name} (seed = {seed})")
+    else:
+        logging.info(f"[Rank {rank}] Loaded {file_name}")
@@ -0,0 +1,142 @@
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import time
+from typing import Callable, Optional, Any, Dict
+
+import torch
+import torch.distributed
+import torch.multiprocessing
+
+from shion.core.training.distrib.device_mapper import CpuDeviceMapper, SimpleCudaDeviceMapper
+
+RENDEZVOUS_FILE = "file"
+RENDEZVOUS_TCP = "tcp"
+
+
+def get_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_training_process(
+        local_rank: int,
+        world_size: int,
+        backend: str,
+        init_method: str,
+        trainer_factory: Callable[[int, str], Any],
+        target_checkpoint_examples: Optional[int],
+        device_mapper: Callable[[int, int], torch.device],
+        num_threads: Optional[int],
+        launch_time: float,
+        result_file_name: str):
+    process_start_time = time.time()
+    rank = local_rank
+    # Code that reads the torchrun environment variables keeps working.
+    os.environ["RANK"] = str(rank)
+    os.environ["LOCAL_RANK"] = str(local_rank)
+    os.environ["WORLD_SIZE"] = str(world_size)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    torch.distributed.init_process_group(backend, init_method=init_method, rank=rank, world_size=world_size)
+    process_group_ready_time = time.time()
+
+    trainer = trainer_factory(world_size, backend)
+    trainer.train(world_size, rank, local_rank, target_checkpoint_examples, device_mapper)
+
+    training_loop_start_time = getattr(trainer, "training_loop_start_time", None)
+    latency = {
+        "rank": rank,
+        "process_start_seconds": process_start_time - launch_time,
+        "process_group_ready_seconds": process_group_ready_time - launch_time,
+        "first_step_seconds": None if training_loop_start_time is None else training_loop_start_time - launch_time,
+    }
+    latencies = [None for _ in range(world_size)]
+    if backend == "nccl":
+        # all_gather_object goes through tensors on the current device with NCCL.
+        torch.cuda.set_device(device_mapper(rank, local_rank))
+    torch.distributed.all_gather_object(latencies, latency)
+    if rank == 0:
+        with open(result_file_name, "wt") as fout:
+            json.dump(latencies, fout)
+    torch.distributed.destroy_process_group()
+
+
+def launch_training_processes(
+        trainer_factory: Callable[[int, str], Any],
+        world_size: int,
+        backend: str = "gloo",
+        target_checkpoint_examples: Optional[int] = None,
+        device_mapper: Optional[Callable[[int, int], torch.device]] = None,
+        rendezvous: str = RENDEZVOUS_FILE,
+        master_port: Optional[int] = None,
+        num_threads_per_process: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Run training on world_size ranks on this machine, without torchrun.
+
+    The ranks are spawned with torch.multiprocessing, meet through a file store or a TCP store on localhost, and call
+    trainer_factory(world_size, backend).train(...) directly, like DistributedTrainer.run does under torchrun.
+    trainer_factory and device_mapper must be picklable, e.g. module-level functions.
+
+    Returns the time from the launch to when each rank started, joined the process group, and entered its training
+    loop.
+    """
+    if device_mapper is None:
+        if backend == "nccl":
+            device_mapper = SimpleCudaDeviceMapper()
+        else:
+            device_mapper = CpuDeviceMapper()
+    if num_threads_per_process is None and backend != "nccl":
+        # Otherwise every rank uses all the cores and they compete for them.
+        num_threads_per_process = max(1, torch.get_num_threads() // world_size)
+
+    work_dir = tempfile.mkdtemp(prefix="shion_launcher_")
+    try:
+        if rendezvous == RENDEZVOUS_FILE:
+            init_method = "file://" + os.path.join(work_dir, "rendezvous")
+        elif rendezvous == RENDEZVOUS_TCP:
+            if master_port is None:
+                master_port = get_free_port()
+            init_method = f"tcp://127.0.0.1:{master_port}"
+        else:
+            raise RuntimeError(f"Unknown rendezvous: {rendezvous}")
+        result_file_name = os.path.join(work_dir, "latencies.json")
+
+        launch_time = time.time()
+        logging.info(f"Launching {world_size} ranks with backend {backend} ({init_method})")
+        torch.multiprocessing.spawn(
+            run_training_process,
+            args=(
+                world_size,
+                backend,
+                init_method,
+                trainer_factory,
+                target_checkpoint_examples,
+                device_mapper,
+                num_threads_per_process,
+                launch_time,
+                result_file_name),
+            nprocs=world_size,
+            join=True)
+        total_seconds = time.time() - launch_time
+
+        with open(result_file_name, "rt") as fin:
+            latencies = json.load(fin)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    first_step_seconds = [x["first_step_seconds"] for x in latencies if x["first_step_seconds"] is not None]
+    if len(first_step_seconds) > 0:
+        logging.info(f"Launch to first training step: {max(first_step_seconds):.3f} seconds (slowest rank)")
+    return {
+        "world_size": world_size,
+        "backend": backend,
+        "rendezvous": rendezvous,
+        "total_seconds": total_seconds,
+        "ranks": latencies,
+    }
@@ -0,0 +1,143 @@
+import io
+import logging
+import math
+import pickle
+from typing import List, Tuple, Callable, Any, Optional
+
+import torch
+import torch.distributed
+
+from shion.core.load_save import torch_save, torch_load
+
+
+def get_default_world_size() -> int:
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_world_size()
+    else:
+        return 1
+
+
+def get_file_owner_rank(file_index: int, world_size: int) -> int:
+    return file_index % world_size
+
+
+def save_files_round_robin(items: List[Tuple[str, Callable[[], Any]]], rank: int, world_size: int):
+    # Every rank writes its share of the files, so writing is spread over all ranks instead of being serialized on
+    # rank 0. The file layout is the same as when a single process writes everything.
+    for file_index, (file_name, get_content) in enumerate(items):
+        if get_file_owner_rank(file_index, world_size) != rank:
+            continue
+        torch_save(get_content(), file_name)
+        logging.info(f"[Rank {rank}] Saved {file_name}")
+
+
+def pack_tensors(content: Any) -> Tuple[bytes, List[torch.Tensor]]:
+    # Pickles content with every tensor in it replaced by its index in the returned list, so that the pickle only
+    # holds the structure and the small values.
+    tensors = []
+
+    def persistent_id(obj):
+        if isinstance(obj, torch.Tensor):
+            tensors.append(obj)
+            return len(tensors) - 1
+        return None
+
+    buffer = io.BytesIO()
+    pickler = pickle.Pickler(buffer)
+    pickler.persistent_id = persistent_id
+    pickler.dump(content)
+    return buffer.getvalue(), tensors
+
+
+def unpack_tensors(skeleton: bytes, tensors: List[torch.Tensor]) -> Any:
+    unpickler = pickle.Unpickler(io.BytesIO(skeleton))
+    unpickler.persistent_load = lambda index: tensors[index]
+    return unpickler.load()
+
+
+def broadcast_tensors(
+        tensors: Optional[List[torch.Tensor]],
+        specs: List[Tuple[torch.dtype, List[int]]],
+        src: int,
+        device: torch.device) -> List[torch.Tensor]:
+    # Sends the tensors of src to every rank with one broadcast per dtype, through a flat buffer on device. specs gives
+    # the dtype and shape of each tensor, and tensors is only used on src.
+    received = [None] * len(specs)
+    dtypes = []
+    for dtype, _ in specs:
+        if dtype not in dtypes:
+            dtypes.append(dtype)
+    for dtype in dtypes:
+        indices = [i for i, (tensor_dtype, _) in enumerate(specs) if tensor_dtype == dtype]
+        numels = [math.prod(specs[i][1]) for i in indices]
+        if tensors is not None:
+            buffer = torch.cat([tensors[i].detach().reshape(-1) for i in indices]).to(device)
+        else:
+            buffer = torch.empty(sum(numels), dtype=dtype, device=device)
+        torch.distributed.broadcast(buffer, src=src)
+        for i, piece in zip(indices, torch.split(buffer, numels)):
+            piece = piece.view(specs[i][1])
+            if piece.dim() == 0:
+                # Scalars such as optimizer step counts are kept on the CPU, as torch_load gives them.
+                piece = piece.cpu()
+            received[i] = piece
+    return received
+
+
+def load_files_round_robin(
+        file_names: List[str],
+        rank: int,
+        world_size: int,
+        device: Optional[torch.device] = None) -> List[Any]:
+    # Each rank reads a disjoint subset of the files from the (shared) file system, so each file is read once instead
+    # of once per rank. Every rank needs all the contents, so each file is then sent from the rank that read it: only
+    # its structure is pickled, and its tensors go through torch.distributed.broadcast in one flat buffer per dtype.
+    owned_contents = {}
+    for file_index, file_name in enumerate(file_names):
+        if get_file_owner_rank(file_index, world_size) == rank:
+            owned_contents[file_index] = torch_load(file_name)
+            logging.info(f"[Rank {rank}] Loaded {file_name}")
+    if world_size == 1:
+        return [owned_contents[file_index] for file_index in range(len(file_names))]
+
+    if torch.distributed.get_backend() == "nccl":
+        broadcast_device = device
+    else:
+        broadcast_device = torch.device("cpu")
+
+    packed = {}
+    for file_index, content in owned_contents.items():
+        skeleton, tensors = pack_tensors(content)
+        packed[file_index] = (skeleton, tensors)
+    # One object broadcast per rank carries the structures and tensor shapes of all the files that the rank read.
+    skeletons = {}
+    for src in range(world_size):
+        objects = [None]
+        if src == rank:
+            objects[0] = {
+                file_index: (skeleton, [(tensor.dtype, list(tensor.shape)) for tensor in tensors])
+                for file_index, (skeleton, tensors) in packed.items()
+            }
+        torch.distributed.broadcast_object_list(
+            objects, src=src, device=None if broadcast_device.type == "cpu" else broadcast_device)
+        skeletons.update(objects[0])
+
+    contents = []
+    for file_index in range(len(file_names)):
+        src = get_file_owner_rank(file_index, world_size)
+        skeleton, specs = skeletons[file_index]
+        if src == rank:
+            broadcast_tensors(packed.pop(file_index)[1], specs, src, broadcast_device)
+            contents.append(owned_contents.pop(file_index))
+        else:
+            contents.append(unpack_tensors(skeleton, broadcast_tensors(None, specs, src, broadcast_device)))
+    return contents
+
+
+def load_files_on_every_rank(file_names: List[str], rank: int) -> List[Any]:
+    # The alternative to load_files_round_robin, where every rank reads every file. Kept for comparison in benchmarks.
+    contents = []
+    for file_name in file_names:
+        contents.append(torch_load(file_name))
+        logging.info(f"[Rank {rank}] Loaded {file_name}")
+    return contents
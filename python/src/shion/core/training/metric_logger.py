@@ -0,0 +1,141 @@
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Union, Optional, List, Tuple
+
+import torch
+from torch import Tensor
+
+MetricValue = Union[float, Tensor]
+
+
+class MetricLogger(ABC):
+    def __init__(self):
+        self.num_steps = 0
+        self.overhead_seconds = 0.0
+
+    @abstractmethod
+    def log(self, tag: str, value: MetricValue, examples_seen_so_far: int):
+        pass
+
+    def create_log_func(self, prefix: str, examples_seen_so_far: int) -> Callable[[str, MetricValue], None]:
+        def log_func(tag: str, value: MetricValue):
+            self.log(prefix + "_" + tag, value, examples_seen_so_far)
+
+        return log_func
+
+    def step(self):
+        self.num_steps += 1
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def get_overhead_seconds_per_step(self) -> float:
+        if self.num_steps == 0:
+            return 0.0
+        return self.overhead_seconds / self.num_steps
+
+
+class SummaryWriterMetricLogger(MetricLogger):
+    def __init__(self, summary_writer):
+        super().__init__()
+        self.summary_writer = summary_writer
+
+    def log(self, tag: str, value: MetricValue, examples_seen_so_far: int):
+        start_time = time.perf_counter()
+        if isinstance(value, Tensor):
+            value = value.item()
+        self.summary_writer.add_scalar(tag, value, examples_seen_so_far)
+        self.overhead_seconds += time.perf_counter() - start_time
+
+    def close(self):
+        self.summary_writer.flush()
+
+
+class DeferredMetricLogger(MetricLogger):
+    def __init__(self,
+                 summary_writer,
+                 flush_interval_steps: Optional[int] = 100,
+                 flush_interval_seconds: Optional[float] = None):
+        super().__init__()
+        assert flush_interval_steps is not None or flush_interval_seconds is not None
+        self.flush_interval_seconds = flush_interval_seconds
+        self.flush_interval_steps = flush_interval_steps
+        self.summary_writer = summary_writer
+        self.pending: List[Tuple[str, MetricValue, int]] = []
+        self.num_steps_since_flush = 0
+        self.last_flush_time = time.perf_counter()
+        self.write_queue = queue.Queue()
+        self.write_thread = None
+
+    def log(self, tag: str, value: MetricValue, examples_seen_so_far: int):
+        start_time = time.perf_counter()
+        if isinstance(value, Tensor):
+            value = value.detach()
+        self.pending.append((tag, value, examples_seen_so_far))
+        self.overhead_seconds += time.perf_counter() - start_time
+
+    def step(self):
+        start_time = time.perf_counter()
+        super().step()
+        self.num_steps_since_flush += 1
+        if self.should_flush(start_time):
+            self.flush()
+        self.overhead_seconds += time.perf_counter() - start_time
+
+    def should_flush(self, now: float) -> bool:
+        if self.flush_interval_steps is not None and self.num_steps_since_flush >= self.flush_interval_steps:
+            return True
+        if self.flush_interval_seconds is not None and now - self.last_flush_time >= self.flush_interval_seconds:
+            return True
+        return False
+
+    def get_pending_values(self) -> List[float]:
+        # Move all pending tensors to the CPU with one copy per device, i.e., with one synchronization per device
+        # instead of one per value.
+        values = [value for (_, value, _) in self.pending]
+        indices_by_device = {}
+        for index, value in enumerate(values):
+            if isinstance(value, Tensor):
+                indices_by_device.setdefault(value.device, []).append(index)
+        for device, indices in indices_by_device.items():
+            stacked = torch.stack([values[index].reshape([]).float() for index in indices])
+            for index, value in zip(indices, stacked.cpu().tolist()):
+                values[index] = value
+        return values
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        values = self.get_pending_values()
+        records = [(tag, value, step) for ((tag, _, step), value) in zip(self.pending, values)]
+        records.append(("metric_logging_overhead_seconds_per_step",
+                        self.get_overhead_seconds_per_step(),
+                        self.pending[-1][2]))
+        self.pending = []
+        self.num_steps_since_flush = 0
+        self.last_flush_time = time.perf_counter()
+        if self.write_thread is None:
+            self.write_thread = threading.Thread(target=self.write_records, daemon=True)
+            self.write_thread.start()
+        self.write_queue.put(records)
+
+    def write_records(self):
+        while True:
+            records = self.write_queue.get()
+            if records is None:
+                break
+            for tag, value, step in records:
+                self.summary_writer.add_scalar(tag, value, step)
+
+    def close(self):
+        self.flush()
+        if self.write_thread is not None:
+            self.write_queue.put(None)
+            self.write_thread.join()
+            self.write_thread = None
+        self.summary_writer.flush()
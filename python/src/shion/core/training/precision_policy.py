@@ -0,0 +1,53 @@
+from typing import Optional, Dict, Any
+
+import torch
+from torch.cuda.amp import GradScaler
+
+
+class PrecisionPolicy:
+    """
+    Decides the precision in which losses are computed.
+
+    With dtype=None, everything runs in fp32 and the grad scaler is a disabled pass-through. Otherwise, loss
+    computation runs under autocast with the given dtype. Parameters, gradients, optimizer states, and accumulated
+    modules stay in fp32. A grad scaler is used by default for fp16 only, and only on CUDA devices.
+    """
+
+    def __init__(self, dtype: Optional[torch.dtype] = None, use_grad_scaler: Optional[bool] = None):
+        assert dtype is None or dtype == torch.float16 or dtype == torch.bfloat16
+        if use_grad_scaler is None:
+            use_grad_scaler = dtype == torch.float16
+        self.use_grad_scaler = use_grad_scaler
+        self.dtype = dtype
+        self.grad_scaler = None
+        self.pending_grad_scaler_state = None
+
+    def is_enabled(self) -> bool:
+        return self.dtype is not None
+
+    def autocast(self, device: torch.device):
+        return torch.autocast(device_type=device.type, dtype=self.dtype, enabled=self.is_enabled())
+
+    def get_grad_scaler(self, device: torch.device) -> GradScaler:
+        if self.grad_scaler is None:
+            self.grad_scaler = GradScaler(enabled=self.use_grad_scaler and device.type == "cuda")
+            if self.pending_grad_scaler_state is not None:
+                self.grad_scaler.load_state_dict(self.pending_grad_scaler_state)
+                self.pending_grad_scaler_state = None
+        return self.grad_scaler
+
+    def state_dict(self) -> Dict[str, Any]:
+        if self.grad_scaler is not None and self.grad_scaler.is_enabled():
+            return {"grad_scaler": self.grad_scaler.state_dict()}
+        elif self.pending_grad_scaler_state is not None:
+            return {"grad_scaler": self.pending_grad_scaler_state}
+        else:
+            return {}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]):
+        if "grad_scaler" not in state_dict or len(state_dict["grad_scaler"]) == 0:
+            return
+        if self.grad_scaler is None:
+            self.pending_grad_scaler_state = state_dict["grad_scaler"]
+        else:
+            self.grad_scaler.load_state_dict(state_dict["grad_scaler"])
@@ -0,0 +1,98 @@
+from typing import Dict, List, Iterator
+
+import torch
+from torch.utils.data import Sampler
+
+# The key under which trainers store the position of their validation data in the data sampler state.
+KEY_VALIDATION_DATA_SAMPLER_STATE = "validation"
+
+
+class ResumableBatchSampler(Sampler[List[int]]):
+    """
+    A shuffling batch sampler whose position is fully described by (seed, epoch, offset).
+
+    All replicas walk through the same per-epoch permutation of the dataset. Each step consumes a global batch of
+    batch_size * num_replicas consecutive entries of the permutation, and replica r takes the r-th chunk of it. The
+    offset counts the entries of the current epoch's permutation that have already been consumed by all replicas
+    together, so the position does not depend on the number of replicas.
+    """
+
+    def __init__(self, dataset_size: int, batch_size: int, seed: int, num_replicas: int = 1, rank: int = 0):
+        super().__init__(None)
+        assert 0 <= rank < num_replicas
+        self.rank = rank
+        self.num_replicas = num_replicas
+        self.seed = seed
+        self.batch_size = batch_size
+        self.dataset_size = dataset_size
+        self.epoch = 0
+        self.offset = 0
+        assert self.get_epoch_size() > 0
+
+    def get_global_batch_size(self) -> int:
+        return self.batch_size * self.num_replicas
+
+    def get_epoch_size(self) -> int:
+        global_batch_size = self.get_global_batch_size()
+        return (self.dataset_size // global_batch_size) * global_batch_size
+
+    def get_permutation(self, epoch: int) -> torch.Tensor:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        return torch.randperm(self.dataset_size, generator=generator)
+
+    def get_num_remaining_batches(self) -> int:
+        return (self.get_epoch_size() - self.offset) // self.get_global_batch_size()
+
+    def __len__(self) -> int:
+        return self.get_num_remaining_batches()
+
+    def __iter__(self) -> Iterator[List[int]]:
+        # Materialize the batches eagerly so that advance() calls made while the DataLoader prefetches do not affect
+        # the iteration that is already in progress.
+        num_batches = self.get_num_remaining_batches()
+        permutation = self.get_permutation(self.epoch)
+        end = self.offset + num_batches * self.get_global_batch_size()
+        batches = permutation[self.offset:end] \
+            .view(num_batches, self.num_replicas, self.batch_size)[:, self.rank, :] \
+            .tolist()
+        return iter(batches)
+
+    def normalize_position(self):
+        if self.offset + self.get_global_batch_size() > self.get_epoch_size():
+            self.epoch += 1
+            self.offset = 0
+
+    def advance(self):
+        self.offset += self.get_global_batch_size()
+        self.normalize_position()
+
+    def set_position(self, epoch: int, offset: int):
+        assert epoch >= 0
+        assert offset >= 0
+        self.epoch = epoch
+        self.offset = offset
+        self.normalize_position()
+
+    def set_position_from_examples_seen_so_far(self, examples_seen_so_far: int):
+        epoch_size = self.get_epoch_size()
+        self.set_position(examples_seen_so_far // epoch_size, examples_seen_so_far % epoch_size)
+
+    def create_data_loader_generator(self) -> torch.Generator:
+        # DataLoader draws the base seed of its workers when an iterator is created. Drawing it from a dedicated
+        # generator keeps the global RNG stream untouched, so a resumed run consumes the same random numbers as a
+        # straight-through run.
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return generator
+
+    def state_dict(self) -> Dict[str, int]:
+        return {
+            "seed": self.seed,
+            "epoch": self.epoch,
+            "offset": self.offset,
+        }
+
+    def load_state_dict(self, state_dict: Dict[str, int]):
+        self.seed = state_dict["seed"]
+        self.set_position(state_dict["epoch"], state_dict["offset"])
@@ -0,0 +1,102 @@
+import logging
+import os
+from typing import List, Tuple, Optional
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+
+class ScheduledProfiler:
+    """
+    Runs torch.profiler over windows of training iterations.
+
+    Each window is a pair (start_examples, num_batches). Profiling starts at the first iteration that begins with
+    examples_seen_so_far >= start_examples and lasts num_batches iterations. A window that has already been passed
+    entirely when training resumes is skipped.
+    """
+
+    def __init__(self,
+                 windows: List[Tuple[int, int]],
+                 record_shapes: bool = True,
+                 profile_memory: bool = True,
+                 with_stack: bool = True,
+                 row_limit: int = 50):
+        for start_examples, num_batches in windows:
+            assert start_examples >= 0
+            assert num_batches > 0
+        self.row_limit = row_limit
+        self.with_stack = with_stack
+        self.profile_memory = profile_memory
+        self.record_shapes = record_shapes
+        self.windows = sorted(windows)
+        self.finished_window_indices = set()
+
+        self.profiler = None
+        self.window_index = None
+        self.window_start_examples = None
+        self.num_profiled_batches = 0
+
+    def find_due_window(self, examples_seen_so_far: int, examples_per_step: int) -> Optional[int]:
+        for index, (start_examples, num_batches) in enumerate(self.windows):
+            if index in self.finished_window_indices:
+                continue
+            if start_examples <= examples_seen_so_far < start_examples + num_batches * examples_per_step:
+                return index
+        return None
+
+    def begin_step(self, examples_seen_so_far: int, examples_per_step: int):
+        if self.profiler is not None or len(self.windows) == 0:
+            return
+        window_index = self.find_due_window(examples_seen_so_far, examples_per_step)
+        if window_index is None:
+            return
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        self.profiler = profile(
+            activities=activities,
+            record_shapes=self.record_shapes,
+            profile_memory=self.profile_memory,
+            with_stack=self.with_stack)
+        self.profiler.start()
+        self.window_index = window_index
+        self.window_start_examples = examples_seen_so_far
+        self.num_profiled_batches = 0
+        logging.info(f"Started profiling at {examples_seen_so_far} examples "
+                     f"for {self.windows[window_index][1]} batches.")
+
+    def end_step(self, trace_dir: str, summary_writer=None, rank: int = 0):
+        if self.profiler is None:
+            return
+        self.profiler.step()
+        self.num_profiled_batches += 1
+        if self.num_profiled_batches >= self.windows[self.window_index][1]:
+            self.finish(trace_dir, summary_writer, rank)
+
+    def finish(self, trace_dir: str, summary_writer=None, rank: int = 0):
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+
+        os.makedirs(trace_dir, exist_ok=True)
+        trace_file_name = "%s/trace_%012d_rank_%04d.json" % (trace_dir, self.window_start_examples, rank)
+        self.profiler.export_chrome_trace(trace_file_name)
+        logging.info(f"Saved profiler trace of {self.num_profiled_batches} batches to {trace_file_name}")
+
+        if torch.cuda.is_available():
+            sort_by = "self_cuda_time_total"
+        else:
+            sort_by = "self_cpu_time_total"
+        table = self.profiler.key_averages().table(sort_by=sort_by, row_limit=self.row_limit)
+        logging.info(f"Profile of {self.num_profiled_batches} batches starting at {self.window_start_examples} "
+                     f"examples:\n{table}")
+        if summary_writer is not None:
+            # Indent the table so that TensorBoard renders it as a code block.
+            text = "\n".join("    " + line for line in table.split("\n"))
+            summary_writer.add_text("profile_operator_summary", text, self.window_start_examples)
+
+        self.finished_window_indices.add(self.window_index)
+        self.profiler = None
+        self.window_index = None
+        self.window_start_examples = None
+        self.num_profiled_batches = 0
@@ -1,7 +1,8 @@
 import copy
 import logging
 import os
-from typing import Dict, Optional
+import time
+from typing import Dict, Optional, Any
 
 import torch
 from torch.nn import Module
@@ -9,9 +10,10 @@ from torch.optim import Optimizer
 
 from shion.core.load_save import torch_save, torch_load
 from shion.core.module_accumulator import ModuleAccumulator
+from shion.core.module_compiler import ModuleCompiler
 from shion.core.module_factory import ModuleFactory
 from shion.core.optimizer_factory import OptimizerFactory
-from shion.core.training.util import optimizer_to_device
+from shion.core.training.util import optimizer_to_device, unwrap_module, create_module_from_state_dict
 
 
 class TrainingState:
@@ -19,7 +21,11 @@ class TrainingState:
                  examples_seen_so_far: int,
                  modules: Dict[str, Module],
                  accumulated_modules: Dict[str, Module],
-                 optimizers: Dict[str, Optimizer]):
+                 optimizers: Dict[str, Optimizer],
+                 data_sampler_state: Optional[Dict[str, Any]] = None,
+                 training_protocol_state: Optional[Dict[str, Any]] = None):
+        self.training_protocol_state = training_protocol_state
+        self.data_sampler_state = data_sampler_state
         self.accumulated_modules = accumulated_modules
         self.optimizers = optimizers
         self.modules = modules
@@ -41,6 +47,14 @@ class TrainingState:
     def get_optimizer_file_name(prefix, module_name) -> str:
         return "%s/optimizer_%s.pt" % (prefix, module_name)
 
+    @staticmethod
+    def get_data_sampler_state_file_name(prefix) -> str:
+        return "%s/data_sampler_state.pt" % prefix
+
+    @staticmethod
+    def get_training_protocol_state_file_name(prefix) -> str:
+        return "%s/training_protocol_state.pt" % prefix
+
     @staticmethod
     def get_rng_state_file_name(prefix):
         return "%s/rng_state.pt" % prefix
@@ -55,16 +69,22 @@ class TrainingState:
             if module_name not in self.optimizers:
                 continue
             file_name = TrainingState.get_module_file_name(prefix, module_name)
-            torch_save(self.modules[module_name].state_dict(), file_name)
+            torch_save(unwrap_module(self.modules[module_name]).state_dict(), file_name)
             logging.info("Saved %s" % file_name)
         for module_name in self.accumulated_modules:
             file_name = TrainingState.get_accumulated_module_file_name(prefix, module_name)
-            torch_save(self.accumulated_modules[module_name].state_dict(), file_name)
+            torch_save(unwrap_module(self.accumulated_modules[module_name]).state_dict(), file_name)
             logging.info("Saved %s" % file_name)
         for module_name in self.optimizers:
             file_name = TrainingState.get_optimizer_file_name(prefix, module_name)
             torch_save(self.optimizers[module_name].state_dict(), file_name)
             logging.info("Saved %s" % file_name)
+        if self.data_sampler_state is not None:
+            torch_save(self.data_sampler_state, TrainingState.get_data_sampler_state_file_name(prefix))
+            logging.info("Saved %s" % TrainingState.get_data_sampler_state_file_name(prefix))
+        if self.training_protocol_state is not None:
+            torch_save(self.training_protocol_state, TrainingState.get_training_protocol_state_file_name(prefix))
+            logging.info("Saved %s" % TrainingState.get_training_protocol_state_file_name(prefix))
         torch_save(torch.get_rng_state(), TrainingState.get_rng_state_file_name(prefix))
         logging.info("Saved %s" % TrainingState.get_rng_state_file_name(prefix))
         logging.info("Done saving training state to %s" % prefix)
@@ -81,56 +101,67 @@ class TrainingState:
              accumulators: Dict[str, ModuleAccumulator],
              optimizer_factories: Dict[str, OptimizerFactory],
              device: torch.device,
-             pretrained_module_file_names: Optional[Dict[str, str]] = None) -> 'TrainingState':
+             pretrained_module_file_names: Optional[Dict[str, str]] = None,
+             module_compiler: Optional[ModuleCompiler] = None) -> 'TrainingState':
         if pretrained_module_file_names is None:
             pretrained_module_file_names = {}
 
         logging.info("Loading training state from %s" % prefix)
+        start_time = time.time()
 
         with open(TrainingState.get_examples_seen_so_far_file_name(prefix)) as fin:
             lines = fin.readlines()
             examples_seen_so_far = int(lines[0])
             logging.info("Loaded %s" % TrainingState.get_examples_seen_so_far_file_name(prefix))
 
-        modules = {
-            module_name: factory.create()
-            for (module_name, factory) in module_factories.items()
-        }
-        for module_name in modules:
+        modules = {}
+        for module_name in module_factories:
             if module_name in optimizer_factories:
                 file_name = TrainingState.get_module_file_name(prefix, module_name)
             else:
                 assert module_name in pretrained_module_file_names
                 file_name = pretrained_module_file_names[module_name]
-            modules[module_name].load_state_dict(torch_load(file_name))
-            modules[module_name].to(device)
+            modules[module_name] = create_module_from_state_dict(
+                module_factories[module_name], torch_load(file_name, device), device)
             logging.info(f"Loaded module '{module_name}' from {file_name}")
 
         accumulated_modules = {}
         for module_name in accumulators:
-            module_factory = module_factories[module_name]
-            module = module_factory.create()
             file_name = TrainingState.get_accumulated_module_file_name(prefix, module_name)
-            module.load_state_dict(torch_load(file_name))
-            module.to(device)
-            accumulated_modules[module_name] = module
+            accumulated_modules[module_name] = create_module_from_state_dict(
+                module_factories[module_name], torch_load(file_name, device), device)
             logging.info("Loaded %s" % file_name)
 
         optimizers = {}
         for module_name in optimizer_factories:
             optimizer = optimizer_factories[module_name].create(modules[module_name].parameters())
             file_name = TrainingState.get_optimizer_file_name(prefix, module_name)
-            optimizer.load_state_dict(torch_load(file_name))
-            optimizer_to_device(optimizer, device)
+            # The state is loaded directly on the device, so it does not need to be moved afterwards.
+            optimizer.load_state_dict(torch_load(file_name, device))
             optimizers[module_name] = optimizer
             logging.info("Loaded %s" % file_name)
 
+        data_sampler_state = None
+        if os.path.isfile(TrainingState.get_data_sampler_state_file_name(prefix)):
+            data_sampler_state = torch_load(TrainingState.get_data_sampler_state_file_name(prefix))
+            logging.info("Loaded %s" % TrainingState.get_data_sampler_state_file_name(prefix))
+
+        training_protocol_state = None
+        if os.path.isfile(TrainingState.get_training_protocol_state_file_name(prefix)):
+            training_protocol_state = torch_load(TrainingState.get_training_protocol_state_file_name(prefix))
+            logging.info("Loaded %s" % TrainingState.get_training_protocol_state_file_name(prefix))
+
         torch.set_rng_state(torch_load(TrainingState.get_rng_state_file_name(prefix)))
         logging.info("Loaded %s" % TrainingState.get_rng_state_file_name(prefix))
 
-        logging.info("Done loading training state from %s" % prefix)
+        logging.info("Done loading training state from %s in %.3f seconds." % (prefix, time.time() - start_time))
 
-        return TrainingState(examples_seen_so_far, modules, accumulated_modules, optimizers)
+        if module_compiler is not None:
+            module_compiler.compile_modules(modules, accumulated_modules)
+
+        return TrainingState(
+            examples_seen_so_far, modules, accumulated_modules, optimizers, data_sampler_state,
+            training_protocol_state)
 
     @staticmethod
     def new(module_factories: Dict[str, ModuleFactory],
@@ -138,7 +169,8 @@ class TrainingState:
             optimizer_factories: Dict[str, OptimizerFactory],
             random_seed: int,
             device: torch.device,
-            pretrained_module_file_names: Optional[Dict[str, str]] = None) -> 'TrainingState':
+            pretrained_module_file_names: Optional[Dict[str, str]] = None,
+            module_compiler: Optional[ModuleCompiler] = None) -> 'TrainingState':
         examples_seen_so_far = 0
 
         modules = {
@@ -167,6 +199,9 @@ class TrainingState:
 
         torch.manual_seed(random_seed)
 
+        if module_compiler is not None:
+            module_compiler.compile_modules(modules, accumulated_modules)
+
         return TrainingState(examples_seen_so_far, modules, accumulated_modules, optimizers)
 
     @staticmethod
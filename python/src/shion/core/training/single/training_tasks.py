@@ -1,7 +1,7 @@
 import logging
 import time
 from datetime import datetime
-from typing import Optional, Dict, List
+from typing import Any, Optional, Dict, List
 
 import torch
 from torch.utils.data import Dataset, DataLoader
@@ -11,11 +11,22 @@ from pytasuku import Workspace
 from shion.core.load_save import torch_save, torch_load
 from shion.core.loss import Loss
 from shion.core.module_accumulator import ModuleAccumulator
+from shion.core.module_compiler import ModuleCompiler
 from shion.core.module_factory import ModuleFactory
+from shion.core.training.async_evaluator import AsyncEvaluator, guard_training_rng
+from shion.core.training.checkpoint_manifest import CheckpointManifest, CheckpointFileTask
+from shion.core.training.data_loader_options import DataLoaderOptions, TimedDataLoaderIterator
+from shion.core.training.metric_logger import MetricLogger, SummaryWriterMetricLogger, DeferredMetricLogger
+from shion.core.training.resumable_batch_sampler import ResumableBatchSampler, KEY_VALIDATION_DATA_SAMPLER_STATE
 from shion.core.training.sample_output_protocol import SampleOutputProtocol
+from shion.core.training.scheduled_profiler import ScheduledProfiler
 from shion.core.training.single.training_states import TrainingState
+from shion.core.training.step_timer import StepTimer, STEP_SECTION_DATA_WAIT, STEP_SECTION_TRAINING_ITERATION, \
+    STEP_SECTION_ACCUMULATION, STEP_SECTION_VALIDATION, STEP_SECTION_SAMPLE_OUTPUT, STEP_SECTION_CHECKPOINT, \
+    STEP_SECTION_LOGGING
 from shion.core.training.training_protocol import TrainingProtocol
-from shion.core.training.util import get_least_greater_multiple, create_log_func, set_learning_rate
+from shion.core.training.util import get_least_greater_multiple, set_learning_rate, unwrap_module, \
+    apply_batch_xform
 from shion.core.training.validation_protocol import ValidationProtocol
 
 KEY_CHECKPOINT = 'checkpoint'
@@ -41,8 +52,28 @@ class TrainingTasks:
             example_per_snapshot: int,
             device: torch.device,
             num_data_loader_workers: int = 8,
-            dependencies: Optional[List[str]] = None):
+            dependencies: Optional[List[str]] = None,
+            metric_flush_interval_steps: Optional[int] = None,
+            metric_flush_interval_seconds: Optional[float] = None,
+            module_compiler: Optional[ModuleCompiler] = None,
+            step_timer: Optional[StepTimer] = None,
+            scheduled_profiler: Optional[ScheduledProfiler] = None,
+            async_evaluator: Optional[AsyncEvaluator] = None,
+            data_loader_options: Optional[DataLoaderOptions] = None):
         super().__init__()
+        if scheduled_profiler is None:
+            scheduled_profiler = ScheduledProfiler([])
+        if data_loader_options is None:
+            data_loader_options = DataLoaderOptions()
+        self.data_loader_options = data_loader_options
+        self.async_evaluator = async_evaluator
+        self.scheduled_profiler = scheduled_profiler
+        if step_timer is None:
+            step_timer = StepTimer(enabled=False)
+        self.step_timer = step_timer
+        self.module_compiler = module_compiler
+        self.metric_flush_interval_seconds = metric_flush_interval_seconds
+        self.metric_flush_interval_steps = metric_flush_interval_steps
         self.num_data_loader_workers = num_data_loader_workers
         self.accumulators = accumulators
         self.device = device
@@ -68,13 +99,18 @@ class TrainingTasks:
         self.training_data_loader = None
         self.training_data_loader_iter = None
         self.training_data_loader_batch_size = None
+        self.training_data_sampler = None
         self.validation_data_loader = None
+        self.validation_data_sampler = None
         self.validation_data_loader_iter = None
         self.validation_data_loader_batch_size = None
         self.sample_output_data = None
         self.summary_writer = None
+        self.metric_logger = None
         self.log_dir = None
         self.training_state = None
+        self.training_loop_start_time = None
+        self.checkpoint_manifest = CheckpointManifest(prefix)
 
         if dependencies is None:
             dependencies = []
@@ -94,18 +130,24 @@ class TrainingTasks:
                 module_file_name = TrainingState.get_module_file_name(
                     self.get_checkpoint_prefix(checkpoint_index),
                     module_name)
-                workspace.create_file_task(
+                CheckpointFileTask(
+                    workspace,
                     module_file_name,
                     module_file_dependencies,
-                    create_train_func(self.checkpoint_examples[checkpoint_index]))
+                    create_train_func(self.checkpoint_examples[checkpoint_index]),
+                    self.checkpoint_manifest,
+                    self.get_checkpoint_prefix(checkpoint_index))
             for module_name in self.accumulators:
                 accumulated_module_file_name = TrainingState.get_accumulated_module_file_name(
                     self.get_checkpoint_prefix(checkpoint_index),
                     module_name)
-                workspace.create_file_task(
+                CheckpointFileTask(
+                    workspace,
                     accumulated_module_file_name,
                     module_file_dependencies,
-                    create_train_func(self.checkpoint_examples[checkpoint_index]))
+                    create_train_func(self.checkpoint_examples[checkpoint_index]),
+                    self.checkpoint_manifest,
+                    self.get_checkpoint_prefix(checkpoint_index))
             workspace.create_command_task(
                 self.get_checkpoint_prefix(checkpoint_index) + "/train",
                 module_file_dependencies,
@@ -141,11 +183,25 @@ class TrainingTasks:
             self.log_dir = self.prefix + "/log/" + now.strftime("%Y_%m_%d__%H_%M_%S")
         return self.log_dir
 
+    def get_profile_dir(self):
+        return self.prefix + "/profiles"
+
     def get_summary_writer(self) -> SummaryWriter:
         if self.summary_writer is None:
             self.summary_writer = SummaryWriter(log_dir=self.get_log_dir())
         return self.summary_writer
 
+    def get_metric_logger(self) -> MetricLogger:
+        if self.metric_logger is None:
+            if self.metric_flush_interval_steps is None and self.metric_flush_interval_seconds is None:
+                self.metric_logger = SummaryWriterMetricLogger(self.get_summary_writer())
+            else:
+                self.metric_logger = DeferredMetricLogger(
+                    self.get_summary_writer(),
+                    self.metric_flush_interval_steps,
+                    self.metric_flush_interval_seconds)
+        return self.metric_logger
+
     def get_train_command_name(self) -> str:
         return self.prefix + "/train"
 
@@ -170,7 +226,8 @@ class TrainingTasks:
             self.accumulators,
             self.training_protocol.get_optimizer_factories(),
             self.device,
-            self.pretrained_module_file_names)
+            self.pretrained_module_file_names,
+            module_compiler=self.module_compiler)
 
     def get_initial_training_state(self) -> TrainingState:
         training_state = TrainingState.new(
@@ -179,26 +236,45 @@ class TrainingTasks:
             self.training_protocol.get_optimizer_factories(),
             self.training_protocol.get_random_seed(),
             self.device,
-            self.pretrained_module_file_names)
+            self.pretrained_module_file_names,
+            module_compiler=self.module_compiler)
         logging.info("Created a new initial training state.")
         return training_state
 
-    def load_previous_training_state(self, target_checkpoint_examples: int) -> TrainingState:
-        if self.can_load_training_state(self.get_snapshot_prefix()):
-            examples_seen_so_far = TrainingState.get_examples_seen_so_far(self.get_snapshot_prefix())
-            diff = examples_seen_so_far - target_checkpoint_examples
-            if diff < self.training_protocol.get_batch_size():
-                return self.load_training_state(self.get_snapshot_prefix())
+    def get_state_prefixes_to_resume_from(self) -> List[str]:
         num_checkpoints = len(self.checkpoint_examples)
-        for checkpoint_index in range(num_checkpoints - 1, -1, -1):
-            if self.can_load_training_state(self.get_checkpoint_prefix(checkpoint_index)):
-                examples_seen_so_far = TrainingState.get_examples_seen_so_far(
-                    self.get_checkpoint_prefix(checkpoint_index))
-                diff = examples_seen_so_far - target_checkpoint_examples
-                if diff < self.training_protocol.get_batch_size():
-                    return self.load_training_state(self.get_checkpoint_prefix(checkpoint_index))
+        return [self.get_snapshot_prefix()] + [
+            self.get_checkpoint_prefix(checkpoint_index) for checkpoint_index in range(num_checkpoints - 1, -1, -1)
+        ]
+
+    def load_previous_training_state(self, target_checkpoint_examples: int) -> TrainingState:
+        prefix = self.checkpoint_manifest.find_state_to_resume(
+            self.get_state_prefixes_to_resume_from(),
+            target_checkpoint_examples,
+            self.training_protocol.get_batch_size(),
+            self.can_load_training_state,
+            TrainingState.get_examples_seen_so_far)
+        if prefix is not None:
+            return self.load_training_state(prefix)
         return self.get_initial_training_state()
 
+    def save_training_state(self, training_state: TrainingState, prefix: str):
+        self.checkpoint_manifest.append(prefix, training_state.examples_seen_so_far, False)
+        training_state.save(prefix)
+        self.checkpoint_manifest.append(prefix, training_state.examples_seen_so_far, True)
+
+    def log_data_loader_startup_seconds(self, metric_logger: MetricLogger, examples_seen_so_far: int):
+        data_loader_iters = {
+            "training": self.training_data_loader_iter,
+            "validation": self.validation_data_loader_iter,
+        }
+        for name, data_loader_iter in data_loader_iters.items():
+            if data_loader_iter is None:
+                continue
+            startup_seconds = data_loader_iter.pop_startup_seconds()
+            if startup_seconds is not None:
+                metric_logger.log(name + "_data_loader_startup_seconds", startup_seconds, examples_seen_so_far)
+
     def get_next_checkpoint_num_examples(self, examples_seen_so_far) -> int:
         next_index = next(
             (i for i in range(len(self.checkpoint_examples)) if self.checkpoint_examples[i] > examples_seen_so_far),
@@ -235,125 +311,227 @@ class TrainingTasks:
                 checkpoint_index = i
         return checkpoint_index
 
+    def get_training_data_sampler(self) -> ResumableBatchSampler:
+        if self.training_data_sampler is None:
+            self.training_data_sampler = ResumableBatchSampler(
+                len(self.training_dataset),
+                self.training_protocol.get_batch_size(),
+                self.training_protocol.get_random_seed())
+        return self.training_data_sampler
+
+    def restore_training_data_position(self, training_state: TrainingState):
+        sampler = self.get_training_data_sampler()
+        if training_state.data_sampler_state is not None:
+            sampler.load_state_dict(training_state.data_sampler_state)
+        else:
+            sampler.set_position_from_examples_seen_so_far(training_state.examples_seen_so_far)
+        self.training_data_loader_iter = None
+        if self.validation_dataset is not None and self.validation_protocol is not None:
+            validation_sampler = self.get_validation_data_sampler()
+            if training_state.data_sampler_state is not None \
+                    and KEY_VALIDATION_DATA_SAMPLER_STATE in training_state.data_sampler_state:
+                validation_sampler.load_state_dict(training_state.data_sampler_state[KEY_VALIDATION_DATA_SAMPLER_STATE])
+            self.validation_data_loader_iter = None
+
+    def get_validation_data_sampler(self) -> ResumableBatchSampler:
+        # Validation batches are drawn with their own generators, so that they do not consume the global RNG, and
+        # their position is saved with the training state.
+        if self.validation_data_sampler is None:
+            self.validation_data_sampler = ResumableBatchSampler(
+                len(self.validation_dataset),
+                self.validation_protocol.get_batch_size(),
+                self.training_protocol.get_random_seed())
+        return self.validation_data_sampler
+
+    def get_data_sampler_state(self) -> Dict[str, Any]:
+        data_sampler_state = self.get_training_data_sampler().state_dict()
+        if self.validation_data_sampler is not None:
+            data_sampler_state[KEY_VALIDATION_DATA_SAMPLER_STATE] = self.validation_data_sampler.state_dict()
+        return data_sampler_state
+
     def get_next_training_batch(self):
+        sampler = self.get_training_data_sampler()
         if self.training_data_loader is None:
             self.training_data_loader = DataLoader(
                 self.training_dataset,
-                batch_size=self.training_protocol.get_batch_size(),
-                shuffle=True,
-                num_workers=self.num_data_loader_workers,
-                drop_last=True)
+                batch_sampler=sampler,
+                **self.data_loader_options.get_data_loader_kwargs(self.num_data_loader_workers))
         if self.training_data_loader_iter is None:
-            self.training_data_loader_iter = iter(self.training_data_loader)
+            self.training_data_loader.generator = sampler.create_data_loader_generator()
+            self.training_data_loader_iter = TimedDataLoaderIterator(self.training_data_loader)
         try:
             batch = next(self.training_data_loader_iter)
         except StopIteration:
-            self.training_data_loader_iter = iter(self.training_data_loader)
+            self.training_data_loader.generator = sampler.create_data_loader_generator()
+            self.training_data_loader_iter = TimedDataLoaderIterator(self.training_data_loader)
             batch = next(self.training_data_loader_iter)
-        return [x.to(self.device) for x in batch]
+        epoch = sampler.epoch
+        sampler.advance()
+        return apply_batch_xform(self.training_dataset, [x.to(self.device) for x in batch], epoch)
 
     def get_next_validation_batch(self):
         if self.validation_dataset is None:
             return None
+        sampler = self.get_validation_data_sampler()
         if self.validation_data_loader is None:
             self.validation_data_loader = DataLoader(
                 self.validation_dataset,
-                batch_size=self.validation_protocol.get_batch_size(),
-                shuffle=True,
-                num_workers=self.num_data_loader_workers,
-                drop_last=True)
+                batch_sampler=sampler,
+                **self.data_loader_options.get_data_loader_kwargs(self.num_data_loader_workers))
         if self.validation_data_loader_iter is None:
-            self.validation_data_loader_iter = iter(self.validation_data_loader)
+            self.validation_data_loader.generator = sampler.create_data_loader_generator()
+            self.validation_data_loader_iter = TimedDataLoaderIterator(self.validation_data_loader)
         try:
             batch = next(self.validation_data_loader_iter)
         except StopIteration:
-            self.validation_data_loader_iter = iter(self.validation_data_loader)
+            self.validation_data_loader.generator = sampler.create_data_loader_generator()
+            self.validation_data_loader_iter = TimedDataLoaderIterator(self.validation_data_loader)
             batch = next(self.validation_data_loader_iter)
-        return [x.to(self.device) for x in batch]
+        sampler.advance()
+        return apply_batch_xform(self.validation_dataset, [x.to(self.device) for x in batch], 0)
 
     def get_checkpoint_index(self, target_checkpoint_examples: int):
         return self.checkpoint_examples.index(target_checkpoint_examples)
 
     def train(self, target_checkpoint_examples: Optional[int] = None):
+        train_start_time = time.time()
         if target_checkpoint_examples is None:
             target_checkpoint_examples = self.checkpoint_examples[-1]
 
         sample_output_data = torch_load(self.get_sample_output_data_file_name())
         logging.info("Loaded sampled output data from %s", self.get_sample_output_data_file_name())
         training_state = self.load_previous_training_state(target_checkpoint_examples)
+        self.restore_training_data_position(training_state)
+        if training_state.training_protocol_state is not None:
+            self.training_protocol.load_state_dict(training_state.training_protocol_state)
+        metric_logger = self.get_metric_logger()
+        step_timer = self.step_timer
+        scheduled_profiler = self.scheduled_profiler
         summary_writer = self.get_summary_writer()
         last_time = time.time()
+        self.training_loop_start_time = last_time
+        logging.info(f"Time to first training step: {last_time - train_start_time:.3f} seconds")
 
-        while training_state.examples_seen_so_far < target_checkpoint_examples:
-            # One training iteration
-            learning_rate = self.training_protocol.get_learning_rate(training_state.examples_seen_so_far)
-            for module_name in self.module_factories.keys():
-                if module_name not in learning_rate or module_name not in training_state.optimizers:
-                    continue
-                lr = learning_rate[module_name]
-                set_learning_rate(training_state.optimizers[module_name], lr)
-                self.get_summary_writer().add_scalar(
-                    module_name + "_learning_rate", lr, training_state.examples_seen_so_far)
-            training_batch = self.get_next_training_batch()
-            self.training_protocol.run_training_iteration(
-                training_batch,
-                training_state.examples_seen_so_far,
-                training_state.modules,
-                training_state.accumulated_modules,
-                training_state.optimizers,
-                self.losses,
-                lambda name, num: create_log_func(summary_writer, name, num),
-                self.device)
-
-            # Accumulate model data
-            for module_name in self.accumulators:
-                new_module = training_state.modules[module_name]
-                buffer_module = training_state.accumulated_modules[module_name]
-                self.accumulators[module_name].accumulate(
-                    new_module,
-                    buffer_module,
-                    training_state.examples_seen_so_far)
-
-            # Advance the number of examples seen so far
-            next_num_examples = self.get_next_num_examples(training_state.examples_seen_so_far)
-            training_state.examples_seen_so_far += self.training_protocol.get_batch_size()
-
-            # Validation iteration
-            if self.validation_protocol is not None \
-                    and training_state.examples_seen_so_far >= next_num_examples[KEY_VALIDATION]:
-                validation_batch = self.get_next_validation_batch()
-                self.validation_protocol.run_validation_iteration(
-                    validation_batch,
-                    training_state.examples_seen_so_far,
-                    training_state.modules,
-                    training_state.accumulated_modules,
-                    self.losses,
-                    lambda name, num: create_log_func(summary_writer, name, num),
-                    self.device)
-
-            # Save sample output
-            if self.sample_output_protocol is not None \
-                    and training_state.examples_seen_so_far >= next_num_examples[KEY_SAMPLE_OUTPUT]:
-                self.sample_output_protocol.save_sample_output_data(
-                    training_state.modules,
-                    training_state.accumulated_modules,
-                    sample_output_data,
-                    self.prefix + "/sample_outputs",
-                    training_state.examples_seen_so_far,
-                    self.device)
-
-            # Save checkpoint
-            if training_state.examples_seen_so_far >= next_num_examples[KEY_CHECKPOINT]:
-                checkpoint_index = self.get_checkpoint_index_to_save(training_state.examples_seen_so_far)
-                training_state.save(self.get_checkpoint_prefix(checkpoint_index))
-                if next_num_examples[KEY_CHECKPOINT] != next_num_examples[KEY_SNAPSHOT]:
-                    training_state.save(self.get_snapshot_prefix())
-
-            # Save snapshot
-            if training_state.examples_seen_so_far >= next_num_examples[KEY_SNAPSHOT]:
-                training_state.save(self.get_snapshot_prefix())
-
-            now = time.time()
-            if now - last_time > 10:
-                logging.info("Showed %d training examples." % training_state.examples_seen_so_far)
-                last_time = now
+        try:
+            while training_state.examples_seen_so_far < target_checkpoint_examples:
+                scheduled_profiler.begin_step(
+                    training_state.examples_seen_so_far, self.training_protocol.get_batch_size())
+
+                # One training iteration
+                learning_rate = self.training_protocol.get_learning_rate(training_state.examples_seen_so_far)
+                for module_name in self.module_factories.keys():
+                    if module_name not in learning_rate or module_name not in training_state.optimizers:
+                        continue
+                    lr = learning_rate[module_name]
+                    set_learning_rate(training_state.optimizers[module_name], lr)
+                    metric_logger.log(module_name + "_learning_rate", lr, training_state.examples_seen_so_far)
+                with step_timer.section(STEP_SECTION_DATA_WAIT):
+                    training_batch = self.get_next_training_batch()
+                with step_timer.section(STEP_SECTION_TRAINING_ITERATION), guard_training_rng(self.async_evaluator):
+                    self.training_protocol.run_training_iteration(
+                        training_batch,
+                        training_state.examples_seen_so_far,
+                        training_state.modules,
+                        training_state.accumulated_modules,
+                        training_state.optimizers,
+                        self.losses,
+                        metric_logger.create_log_func,
+                        self.device)
+
+                # Accumulate model data
+                with step_timer.section(STEP_SECTION_ACCUMULATION):
+                    for module_name in self.accumulators:
+                        new_module = unwrap_module(training_state.modules[module_name])
+                        buffer_module = unwrap_module(training_state.accumulated_modules[module_name])
+                        self.accumulators[module_name].accumulate(
+                            new_module,
+                            buffer_module,
+                            training_state.examples_seen_so_far)
+
+                # Advance the number of examples seen so far
+                next_num_examples = self.get_next_num_examples(training_state.examples_seen_so_far)
+                training_state.examples_seen_so_far += self.training_protocol.get_batch_size()
+
+                # Validation iteration
+                with step_timer.section(STEP_SECTION_VALIDATION):
+                    if self.validation_protocol is not None \
+                            and training_state.examples_seen_so_far >= next_num_examples[KEY_VALIDATION]:
+                        validation_batch = self.get_next_validation_batch()
+                        if self.async_evaluator is not None:
+                            self.async_evaluator.submit_validation(
+                                self.validation_protocol,
+                                validation_batch,
+                                training_state.examples_seen_so_far,
+                                training_state.modules,
+                                training_state.accumulated_modules,
+                                self.losses,
+                                self.device)
+                        else:
+                            self.validation_protocol.run_validation_iteration(
+                                validation_batch,
+                                training_state.examples_seen_so_far,
+                                training_state.modules,
+                                training_state.accumulated_modules,
+                                self.losses,
+                                metric_logger.create_log_func,
+                                self.device)
+
+                training_state.data_sampler_state = self.get_data_sampler_state()
+
+                # Save sample output
+                with step_timer.section(STEP_SECTION_SAMPLE_OUTPUT):
+                    if self.sample_output_protocol is not None \
+                            and training_state.examples_seen_so_far >= next_num_examples[KEY_SAMPLE_OUTPUT]:
+                        if self.async_evaluator is not None:
+                            self.async_evaluator.submit_sample_output(
+                                self.sample_output_protocol,
+                                training_state.modules,
+                                training_state.accumulated_modules,
+                                sample_output_data,
+                                self.prefix + "/sample_outputs",
+                                training_state.examples_seen_so_far,
+                                self.device)
+                        else:
+                            self.sample_output_protocol.save_sample_output_data(
+                                training_state.modules,
+                                training_state.accumulated_modules,
+                                sample_output_data,
+                                self.prefix + "/sample_outputs",
+                                training_state.examples_seen_so_far,
+                                self.device)
+
+                # Save checkpoint
+                with step_timer.section(STEP_SECTION_CHECKPOINT):
+                    if training_state.examples_seen_so_far >= next_num_examples[KEY_CHECKPOINT]:
+                        training_state.training_protocol_state = self.training_protocol.state_dict()
+                        checkpoint_index = self.get_checkpoint_index_to_save(training_state.examples_seen_so_far)
+                        self.save_training_state(training_state, self.get_checkpoint_prefix(checkpoint_index))
+                        if next_num_examples[KEY_CHECKPOINT] != next_num_examples[KEY_SNAPSHOT]:
+                            self.save_training_state(training_state, self.get_snapshot_prefix())
+
+                # Save snapshot
+                with step_timer.section(STEP_SECTION_CHECKPOINT):
+                    if training_state.examples_seen_so_far >= next_num_examples[KEY_SNAPSHOT]:
+                        training_state.training_protocol_state = self.training_protocol.state_dict()
+                        self.save_training_state(training_state, self.get_snapshot_prefix())
+
+                with step_timer.section(STEP_SECTION_LOGGING):
+                    if self.async_evaluator is not None:
+                        self.async_evaluator.write_finished_logs(metric_logger)
+                    self.log_data_loader_startup_seconds(metric_logger, training_state.examples_seen_so_far)
+                    metric_logger.step()
+                scheduled_profiler.end_step(self.get_profile_dir(), summary_writer)
+                step_timer.step()
+
+                now = time.time()
+                if now - last_time > 10:
+                    logging.info("Showed %d training examples." % training_state.examples_seen_so_far)
+                    logging.info("Metric logging overhead: %f seconds per step."
+                                 % metric_logger.get_overhead_seconds_per_step())
+                    last_time = now
+
+            if self.async_evaluator is not None:
+                self.async_evaluator.drain(metric_logger)
+            scheduled_profiler.finish(self.get_profile_dir(), summary_writer)
+        finally:
+            metric_logger.close()
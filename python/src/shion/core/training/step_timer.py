@@ -0,0 +1,53 @@
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+import torch
+
+STEP_SECTION_DATA_WAIT = "data_wait"
+STEP_SECTION_TRAINING_ITERATION = "training_iteration"
+STEP_SECTION_OPTIMIZER = "optimizer"
+STEP_SECTION_ACCUMULATION = "accumulation"
+STEP_SECTION_VALIDATION = "validation"
+STEP_SECTION_SAMPLE_OUTPUT = "sample_output"
+STEP_SECTION_CHECKPOINT = "checkpoint"
+STEP_SECTION_LOGGING = "logging"
+
+
+class StepTimer:
+    def __init__(self, enabled: bool = True, synchronize_cuda: bool = False):
+        self.synchronize_cuda = synchronize_cuda
+        self.enabled = enabled
+        self.total_seconds: Dict[str, float] = {}
+        self.num_steps = 0
+
+    def synchronize(self):
+        # Without synchronization, GPU work is attributed to whichever section happens to wait for it.
+        if self.synchronize_cuda and torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    @contextmanager
+    def section(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        self.synchronize()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.synchronize()
+            self.total_seconds[name] = self.total_seconds.get(name, 0.0) + time.perf_counter() - start_time
+
+    def step(self):
+        if self.enabled:
+            self.num_steps += 1
+
+    def reset(self):
+        self.total_seconds = {}
+        self.num_steps = 0
+
+    def get_seconds_per_step(self) -> Dict[str, float]:
+        if self.num_steps == 0:
+            return {}
+        return {name: seconds / self.num_steps for (name, seconds) in self.total_seconds.items()}
@@ -0,0 +1,355 @@
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Optional, Callable, List, Any
+
+import torch
+from torch import Tensor
+from torch.utils.data import Dataset, DataLoader
+from torch.utils.tensorboard import SummaryWriter
+
+from shion.core.functorch_util import vmap, stack_module_parameters, stack_module_buffers, call_stacked_module
+from shion.core.module_accumulator import ModuleAccumulator
+from shion.core.module_factory import ModuleFactory
+from shion.core.optimizer_factory import OptimizerFactory
+from shion.core.training.data_loader_options import DataLoaderOptions, TimedDataLoaderIterator
+from shion.core.training.metric_logger import MetricLogger, SummaryWriterMetricLogger, DeferredMetricLogger
+from shion.core.training.resumable_batch_sampler import ResumableBatchSampler
+from shion.core.training.single.training_states import TrainingState
+from shion.core.training.step_timer import StepTimer, STEP_SECTION_DATA_WAIT, STEP_SECTION_TRAINING_ITERATION, \
+    STEP_SECTION_ACCUMULATION, STEP_SECTION_CHECKPOINT, STEP_SECTION_LOGGING
+from shion.core.training.util import get_least_greater_multiple, set_learning_rate, apply_batch_xform
+
+KEY_MODULE = "module"
+
+# Computes the loss of one member from a function that runs the member's module and the shared batch.
+VmapSwarmLossFunc = Callable[[Callable[..., Any], List[Tensor]], Tensor]
+
+
+class VmapSwarmMember:
+    def __init__(self,
+                 prefix: str,
+                 random_seed: int,
+                 optimizer_factory: OptimizerFactory,
+                 learning_rate: Callable[[int], float]):
+        self.learning_rate = learning_rate
+        self.optimizer_factory = optimizer_factory
+        self.random_seed = random_seed
+        self.prefix = prefix
+
+
+class VmapSwarmTrainer:
+    """
+    Trains a swarm of models with the same architecture in one process, in lockstep on shared batches.
+
+    The forward and backward passes of all members run as one vmapped computation over their stacked parameters.
+    Each member still has its own parameters, optimizer and accumulated module, and is checkpointed as a TrainingState
+    under its own prefix, with the same layout that SwarmUnitTrainer writes. Buffers are read but not updated, so the
+    architecture should not rely on running statistics.
+    """
+
+    def __init__(self,
+                 members: List[VmapSwarmMember],
+                 module_factory: ModuleFactory,
+                 compute_loss: VmapSwarmLossFunc,
+                 training_dataset: Dataset,
+                 batch_size: int,
+                 checkpoint_examples: List[int],
+                 example_per_snapshot: int,
+                 random_seed: int,
+                 accumulator: Optional[ModuleAccumulator] = None,
+                 num_data_loader_workers: int = 0,
+                 randomness: str = "different",
+                 metric_flush_interval_steps: Optional[int] = None,
+                 metric_flush_interval_seconds: Optional[float] = None,
+                 step_timer: Optional[StepTimer] = None,
+                 data_loader_options: Optional[DataLoaderOptions] = None):
+        assert len(members) > 0
+        assert len(checkpoint_examples) >= 1
+        assert checkpoint_examples[0] > 0
+        if data_loader_options is None:
+            data_loader_options = DataLoaderOptions()
+        self.data_loader_options = data_loader_options
+        if step_timer is None:
+            step_timer = StepTimer(enabled=False)
+        self.step_timer = step_timer
+        self.metric_flush_interval_seconds = metric_flush_interval_seconds
+        self.metric_flush_interval_steps = metric_flush_interval_steps
+        self.randomness = randomness
+        self.num_data_loader_workers = num_data_loader_workers
+        self.accumulator = accumulator
+        self.random_seed = random_seed
+        self.example_per_snapshot = example_per_snapshot
+        self.checkpoint_examples = [0] + checkpoint_examples
+        self.batch_size = batch_size
+        self.training_dataset = training_dataset
+        self.compute_loss = compute_loss
+        self.module_factory = module_factory
+        self.members = members
+
+        self.training_data_loader = None
+        self.training_data_loader_iter = None
+        self.training_data_sampler = None
+        self.metric_loggers = None
+        self.base_module = None
+
+    @staticmethod
+    def get_checkpoint_prefix(member: VmapSwarmMember, checkpoint_index: int) -> str:
+        return "%s/checkpoint/%04d" % (member.prefix, checkpoint_index)
+
+    @staticmethod
+    def get_snapshot_prefix(member: VmapSwarmMember) -> str:
+        return member.prefix + "/snapshot"
+
+    def get_accumulators(self) -> Dict[str, ModuleAccumulator]:
+        if self.accumulator is None:
+            return {}
+        return {KEY_MODULE: self.accumulator}
+
+    def can_load_training_states(self, prefixes: List[str]) -> bool:
+        examples_seen_so_far = set()
+        for member, prefix in zip(self.members, prefixes):
+            if not TrainingState.can_load(
+                    prefix,
+                    {KEY_MODULE: self.module_factory},
+                    self.get_accumulators(),
+                    {KEY_MODULE: member.optimizer_factory},
+                    {}):
+                return False
+            examples_seen_so_far.add(TrainingState.get_examples_seen_so_far(prefix))
+        # All members must have been saved at the same point in training.
+        return len(examples_seen_so_far) == 1
+
+    def load_training_states(self, prefixes: List[str], device: torch.device) -> List[TrainingState]:
+        return [
+            TrainingState.load(
+                prefix,
+                {KEY_MODULE: self.module_factory},
+                self.get_accumulators(),
+                {KEY_MODULE: member.optimizer_factory},
+                device)
+            for (member, prefix) in zip(self.members, prefixes)
+        ]
+
+    def get_initial_training_states(self, device: torch.device) -> List[TrainingState]:
+        training_states = []
+        for member in self.members:
+            # Seed before the module is created, so that each member's initialization depends only on its own seed.
+            torch.manual_seed(member.random_seed)
+            training_states.append(TrainingState.new(
+                {KEY_MODULE: self.module_factory},
+                self.get_accumulators(),
+                {KEY_MODULE: member.optimizer_factory},
+                member.random_seed,
+                device))
+        torch.manual_seed(self.random_seed)
+        logging.info(f"Created new initial training states for {len(self.members)} swarm members.")
+        return training_states
+
+    def save_training_states(self, training_states: List[TrainingState], prefixes: List[str]):
+        for training_state, prefix in zip(training_states, prefixes):
+            training_state.save(prefix)
+
+    def load_previous_training_states(self,
+                                      target_checkpoint_examples: int,
+                                      device: torch.device) -> List[TrainingState]:
+        snapshot_prefixes = [VmapSwarmTrainer.get_snapshot_prefix(member) for member in self.members]
+        if self.can_load_training_states(snapshot_prefixes):
+            examples_seen_so_far = TrainingState.get_examples_seen_so_far(snapshot_prefixes[0])
+            if examples_seen_so_far - target_checkpoint_examples < self.batch_size:
+                return self.load_training_states(snapshot_prefixes, device)
+        for checkpoint_index in range(len(self.checkpoint_examples) - 1, -1, -1):
+            checkpoint_prefixes = [
+                VmapSwarmTrainer.get_checkpoint_prefix(member, checkpoint_index) for member in self.members
+            ]
+            if self.can_load_training_states(checkpoint_prefixes):
+                examples_seen_so_far = TrainingState.get_examples_seen_so_far(checkpoint_prefixes[0])
+                if examples_seen_so_far - target_checkpoint_examples < self.batch_size:
+                    return self.load_training_states(checkpoint_prefixes, device)
+
+        checkpoint_prefixes = [VmapSwarmTrainer.get_checkpoint_prefix(member, 0) for member in self.members]
+        self.save_training_states(self.get_initial_training_states(device), checkpoint_prefixes)
+        return self.load_training_states(checkpoint_prefixes, device)
+
+    def get_metric_loggers(self) -> List[MetricLogger]:
+        if self.metric_loggers is None:
+            now = datetime.now().strftime("%Y_%m_%d__%H_%M_%S")
+            self.metric_loggers = []
+            for member in self.members:
+                summary_writer = SummaryWriter(log_dir=member.prefix + "/log/" + now)
+                if self.metric_flush_interval_steps is None and self.metric_flush_interval_seconds is None:
+                    self.metric_loggers.append(SummaryWriterMetricLogger(summary_writer))
+                else:
+                    self.metric_loggers.append(DeferredMetricLogger(
+                        summary_writer,
+                        self.metric_flush_interval_steps,
+                        self.metric_flush_interval_seconds))
+        return self.metric_loggers
+
+    def get_training_data_sampler(self) -> ResumableBatchSampler:
+        if self.training_data_sampler is None:
+            self.training_data_sampler = ResumableBatchSampler(
+                len(self.training_dataset), self.batch_size, self.random_seed)
+        return self.training_data_sampler
+
+    def restore_training_data_position(self, training_state: TrainingState):
+        sampler = self.get_training_data_sampler()
+        if training_state.data_sampler_state is not None:
+            sampler.load_state_dict(training_state.data_sampler_state)
+        else:
+            sampler.set_position_from_examples_seen_so_far(training_state.examples_seen_so_far)
+        self.training_data_loader_iter = None
+
+    def get_next_training_batch(self, device: torch.device) -> List[Tensor]:
+        sampler = self.get_training_data_sampler()
+        if self.training_data_loader is None:
+            self.training_data_loader = DataLoader(
+                self.training_dataset,
+                batch_sampler=sampler,
+                **self.data_loader_options.get_data_loader_kwargs(self.num_data_loader_workers))
+        if self.training_data_loader_iter is None:
+            self.training_data_loader.generator = sampler.create_data_loader_generator()
+            self.training_data_loader_iter = TimedDataLoaderIterator(self.training_data_loader)
+        try:
+            batch = next(self.training_data_loader_iter)
+        except StopIteration:
+            self.training_data_loader.generator = sampler.create_data_loader_generator()
+            self.training_data_loader_iter = TimedDataLoaderIterator(self.training_data_loader)
+            batch = next(self.training_data_loader_iter)
+        epoch = sampler.epoch
+        sampler.advance()
+        return apply_batch_xform(self.training_dataset, [x.to(device) for x in batch], epoch)
+
+    def log_data_loader_startup_seconds(self, metric_loggers: List[MetricLogger], examples_seen_so_far: int):
+        if self.training_data_loader_iter is None:
+            return
+        startup_seconds = self.training_data_loader_iter.pop_startup_seconds()
+        if startup_seconds is None:
+            return
+        for metric_logger in metric_loggers:
+            metric_logger.log("training_data_loader_startup_seconds", startup_seconds, examples_seen_so_far)
+
+    def get_next_checkpoint_num_examples(self, examples_seen_so_far: int) -> int:
+        next_index = next(
+            (i for i in range(len(self.checkpoint_examples)) if self.checkpoint_examples[i] > examples_seen_so_far),
+            -1)
+        return self.checkpoint_examples[next_index]
+
+    def get_checkpoint_index_to_save(self, examples_seen_so_far: int) -> int:
+        checkpoint_index = 0
+        for i in range(len(self.checkpoint_examples)):
+            if self.checkpoint_examples[i] <= examples_seen_so_far:
+                checkpoint_index = i
+        return checkpoint_index
+
+    def get_base_module(self, device: torch.device):
+        # Only the structure of this module is used. The parameters come from the members. The module is created after
+        # the training states have restored the RNG, so its random initialization must not draw from the global RNG.
+        if self.base_module is None:
+            with torch.random.fork_rng(devices=[]):
+                self.base_module = self.module_factory.create().to(device)
+        return self.base_module
+
+    def create_vmapped_loss_func(self, device: torch.device) -> Callable[[Dict, Dict, List[Tensor]], Tensor]:
+        base_module = self.get_base_module(device)
+        compute_loss = self.compute_loss
+
+        def member_loss(parameters: Dict[str, Tensor], buffers: Dict[str, Tensor], batch: List[Tensor]):
+            def module_func(*args):
+                return call_stacked_module(base_module, parameters, buffers, *args)
+
+            return compute_loss(module_func, batch)
+
+        # With randomness="different", random numbers drawn inside the loss (noise, time steps) differ per member.
+        return vmap(member_loss, in_dims=(0, 0, None), randomness=self.randomness)
+
+    def run_training_iteration(self,
+                               training_states: List[TrainingState],
+                               batch: List[Tensor],
+                               vmapped_loss_func: Callable[[Dict, Dict, List[Tensor]], Tensor]) -> Tensor:
+        modules = [training_state.modules[KEY_MODULE] for training_state in training_states]
+        optimizers = [training_state.optimizers[KEY_MODULE] for training_state in training_states]
+        for module in modules:
+            module.train(True)
+        for optimizer in optimizers:
+            optimizer.zero_grad(set_to_none=True)
+        losses = vmapped_loss_func(stack_module_parameters(modules), stack_module_buffers(modules), batch)
+        # The members do not interact, so the gradient of the sum is the gradient of each member's own loss.
+        losses.sum().backward()
+        for optimizer in optimizers:
+            optimizer.step()
+        return losses.detach()
+
+    def train(self,
+              target_checkpoint_examples: Optional[int] = None,
+              device: Optional[torch.device] = None):
+        if target_checkpoint_examples is None:
+            target_checkpoint_examples = self.checkpoint_examples[-1]
+        if device is None:
+            device = torch.device("cpu")
+
+        training_states = self.load_previous_training_states(target_checkpoint_examples, device)
+        self.restore_training_data_position(training_states[0])
+        metric_loggers = self.get_metric_loggers()
+        vmapped_loss_func = self.create_vmapped_loss_func(device)
+        step_timer = self.step_timer
+        examples_seen_so_far = training_states[0].examples_seen_so_far
+        last_time = time.time()
+
+        try:
+            while examples_seen_so_far < target_checkpoint_examples:
+                for member, training_state, metric_logger in zip(self.members, training_states, metric_loggers):
+                    lr = member.learning_rate(examples_seen_so_far)
+                    set_learning_rate(training_state.optimizers[KEY_MODULE], lr)
+                    metric_logger.log(KEY_MODULE + "_learning_rate", lr, examples_seen_so_far)
+
+                with step_timer.section(STEP_SECTION_DATA_WAIT):
+                    batch = self.get_next_training_batch(device)
+                with step_timer.section(STEP_SECTION_TRAINING_ITERATION):
+                    losses = self.run_training_iteration(training_states, batch, vmapped_loss_func)
+
+                with step_timer.section(STEP_SECTION_ACCUMULATION):
+                    if self.accumulator is not None:
+                        for training_state in training_states:
+                            self.accumulator.accumulate(
+                                training_state.modules[KEY_MODULE],
+                                training_state.accumulated_modules[KEY_MODULE],
+                                examples_seen_so_far=examples_seen_so_far)
+
+                next_checkpoint_examples = self.get_next_checkpoint_num_examples(examples_seen_so_far)
+                next_snapshot_examples = get_least_greater_multiple(examples_seen_so_far, self.example_per_snapshot)
+                loss_examples_seen_so_far = examples_seen_so_far
+                examples_seen_so_far += self.batch_size
+                data_sampler_state = self.training_data_sampler.state_dict()
+                for training_state in training_states:
+                    training_state.examples_seen_so_far = examples_seen_so_far
+                    training_state.data_sampler_state = data_sampler_state
+
+                with step_timer.section(STEP_SECTION_CHECKPOINT):
+                    if examples_seen_so_far >= next_checkpoint_examples:
+                        checkpoint_index = self.get_checkpoint_index_to_save(examples_seen_so_far)
+                        checkpoint_prefixes = [
+                            VmapSwarmTrainer.get_checkpoint_prefix(member, checkpoint_index) for member in self.members
+                        ]
+                        self.save_training_states(training_states, checkpoint_prefixes)
+                    if examples_seen_so_far >= next_snapshot_examples:
+                        self.save_training_states(
+                            training_states,
+                            [VmapSwarmTrainer.get_snapshot_prefix(member) for member in self.members])
+
+                with step_timer.section(STEP_SECTION_LOGGING):
+                    self.log_data_loader_startup_seconds(metric_loggers, loss_examples_seen_so_far)
+                    for member_index, metric_logger in enumerate(metric_loggers):
+                        metric_logger.log(
+                            "training_" + KEY_MODULE + "_loss", losses[member_index], loss_examples_seen_so_far)
+                        metric_logger.step()
+                step_timer.step()
+
+                now = time.time()
+                if now - last_time > 10:
+                    logging.info("Showed %d training examples to %d swarm members."
+                                 % (examples_seen_so_far, len(self.members)))
+                    last_time = now
+        finally:
+            for metric_logger in metric_loggers:
+                metric_logger.close()
@@ -43,6 +43,12 @@ class TrainingProtocol(ABC):
             device: torch.device):
         pass
 
+    def state_dict(self) -> Dict[str, Any]:
+        return {}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]):
+        pass
+
 
 class AbstractTrainingProtocol(TrainingProtocol, ABC):
     def __init__(self,
@@ -1,8 +1,16 @@
-from typing import Callable
+import inspect
+import itertools
+from contextlib import ExitStack
+from typing import Callable, Union, Iterable, Optional, Dict, Any, List
 
 import torch
+from torch import Tensor
 from torch.nn import Module
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import Optimizer
+from torch.utils.data import Dataset
+
+from shion.core.module_factory import ModuleFactory
 
 
 def optimizer_to_device(optim: Optimizer, device: torch.device):
@@ -12,6 +20,87 @@ def optimizer_to_device(optim: Optimizer, device: torch.device):
                 state[k] = v.to(device)
 
 
+def is_meta_device_construction_available() -> bool:
+    # Needs torch.device as a context manager (PyTorch 2.0) and load_state_dict(assign=True) (PyTorch 2.1).
+    return hasattr(torch.device, "__enter__") and "assign" in inspect.signature(Module.load_state_dict).parameters
+
+
+def create_module_from_state_dict(
+        module_factory: ModuleFactory, state_dict: Dict[str, Any], device: torch.device) -> Module:
+    # Creating the module on the meta device skips the random initialization that load_state_dict would overwrite
+    # anyway. The loaded tensors become the parameters, so no copy is made if they are already on the device.
+    if is_meta_device_construction_available():
+        with torch.device("meta"):
+            module = module_factory.create()
+        module.load_state_dict(state_dict, assign=True)
+        if not any(x.is_meta for x in itertools.chain(module.parameters(), module.buffers())):
+            return module.to(device)
+        # Non-persistent buffers are not in the state dict, so they are still on the meta device.
+    module = module_factory.create()
+    module.load_state_dict(state_dict)
+    return module.to(device)
+
+
+def apply_batch_xform(dataset: Dataset, batch: List[Tensor], epoch: int) -> List[Tensor]:
+    # Datasets with an xform_batch(batch, epoch) method, such as XformedDataset, transform whole batches once they are
+    # on the device.
+    xform_batch = getattr(dataset, "xform_batch", None)
+    if xform_batch is None:
+        return batch
+    return xform_batch(batch, epoch)
+
+
+def needs_batch_xform(dataset: Dataset) -> bool:
+    # Whether apply_batch_xform may change the batches of the dataset. Datasets whose xform_batch sometimes leaves
+    # batches as they are say when through a needs_batch_xform() method.
+    needs = getattr(dataset, "needs_batch_xform", None)
+    if needs is not None:
+        return needs()
+    return getattr(dataset, "xform_batch", None) is not None
+
+
+def unwrap_module(module: Module) -> Module:
+    # Strips the wrappers added by DistributedDataParallel and torch.compile, so that parameter names and state dicts
+    # are the same as those of the module created by the module factory.
+    while True:
+        if isinstance(module, DistributedDataParallel):
+            module = module.module
+        elif hasattr(module, "_orig_mod"):
+            module = module._orig_mod
+        else:
+            return module
+
+
+def get_distributed_data_parallel(module: Module) -> Optional[DistributedDataParallel]:
+    while True:
+        if isinstance(module, DistributedDataParallel):
+            return module
+        elif hasattr(module, "_orig_mod"):
+            module = module._orig_mod
+        else:
+            return None
+
+
+def create_gradient_sync_context(modules: Iterable[Module], sync: bool) -> ExitStack:
+    # Inside the returned context, backward passes through DDP modules only accumulate gradients locally when sync is
+    # False. The all-reduce then happens once, in the backward pass of the last micro-batch.
+    stack = ExitStack()
+    if not sync:
+        for module in modules:
+            ddp_module = get_distributed_data_parallel(module)
+            if ddp_module is not None:
+                stack.enter_context(ddp_module.no_sync())
+    return stack
+
+
+def create_distributed_data_parallel(module: Module, device: torch.device) -> DistributedDataParallel:
+    if device.type == "cuda":
+        return DistributedDataParallel(module, device_ids=[device.index], output_device=device.index)
+    else:
+        # device_ids must be left unset for CPU modules.
+        return DistributedDataParallel(module)
+
+
 def zero_module(module: Module):
     parameters = dict(module.named_parameters())
     for k in parameters.keys():
@@ -32,7 +121,9 @@ def get_least_greater_multiple(x: int, m: int) -> int:
 
 
 def create_log_func(summary_writer, prefix: str, examples_seen_so_far: int) -> Callable[[str, float], None]:
-    def log_func(tag: str, value: float):
+    def log_func(tag: str, value: Union[float, torch.Tensor]):
+        if isinstance(value, torch.Tensor):
+            value = value.item()
         summary_writer.add_scalar(prefix + "_" + tag, value, examples_seen_so_far)
 
     return log_func
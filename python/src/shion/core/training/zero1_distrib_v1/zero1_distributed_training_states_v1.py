@@ -1,29 +1,47 @@
 import copy
 import logging
 import os
-from typing import Dict, Optional, Callable
+import time
+from typing import Dict, Optional, Callable, Any
 
 import torch
 from torch.distributed.optim import ZeroRedundancyOptimizer
 from torch.nn import Module
-from torch.nn.parallel import DistributedDataParallel
 
 from shion.core.load_save import torch_save, torch_load
 from shion.core.module_accumulator import ModuleAccumulator
+from shion.core.module_compiler import ModuleCompiler
 from shion.core.module_factory import ModuleFactory
 from shion.core.optimizer_factory import OptimizerFactory
+from shion.core.training.distrib.elastic_resume import save_world_size, get_saved_world_size, restore_rng_state
+from shion.core.training.distrib.sharded_checkpoint import get_default_world_size
+from shion.core.training.util import unwrap_module, create_distributed_data_parallel, create_module_from_state_dict
+from shion.core.training.zero1_distrib_v1.zero_optimizer_shards import get_zero_optimizer_shard_state_dict, \
+    load_zero_optimizer_shards
 
 
 def print_peak_memory(prefix, device):
+    if not torch.cuda.is_available():
+        return
     print(f"{prefix}: {torch.cuda.max_memory_allocated(device) // 1e6}MB ")
 
 
+def reset_peak_memory(device):
+    if not torch.cuda.is_available():
+        return
+    torch.cuda.reset_peak_memory_stats(device)
+
+
 class Zero1DistributedTrainingStateV1:
     def __init__(self,
                  examples_seen_so_far: int,
                  modules: Dict[str, Module],
                  accumulated_modules: Dict[str, Module],
-                 optimizers: Dict[str, ZeroRedundancyOptimizer]):
+                 optimizers: Dict[str, ZeroRedundancyOptimizer],
+                 data_sampler_state: Optional[Dict[str, Any]] = None,
+                 training_protocol_state: Optional[Dict[str, Any]] = None):
+        self.training_protocol_state = training_protocol_state
+        self.data_sampler_state = data_sampler_state
         self.accumulated_modules = accumulated_modules
         self.optimizers = optimizers
         self.modules = modules
@@ -45,6 +63,31 @@ class Zero1DistributedTrainingStateV1:
     def get_optimizer_file_name(prefix, module_name) -> str:
         return "%s/optimizer_%s.pt" % (prefix, module_name)
 
+    @staticmethod
+    def get_optimizer_shard_file_name(prefix, module_name, rank: int) -> str:
+        return "%s/optimizer_%s_shard_%08d.pt" % (prefix, module_name, rank)
+
+    @staticmethod
+    def get_optimizer_num_shards_file_name(prefix, module_name) -> str:
+        return "%s/optimizer_%s_num_shards.txt" % (prefix, module_name)
+
+    @staticmethod
+    def get_optimizer_num_shards(prefix, module_name) -> Optional[int]:
+        file_name = Zero1DistributedTrainingStateV1.get_optimizer_num_shards_file_name(prefix, module_name)
+        if not os.path.isfile(file_name):
+            return None
+        with open(file_name) as fin:
+            lines = fin.readlines()
+            return int(lines[0])
+
+    @staticmethod
+    def get_data_sampler_state_file_name(prefix) -> str:
+        return "%s/data_sampler_state.pt" % prefix
+
+    @staticmethod
+    def get_training_protocol_state_file_name(prefix) -> str:
+        return "%s/training_protocol_state.pt" % prefix
+
     @staticmethod
     def get_rng_state_file_name(prefix, rank: int):
         return "%s/rng_state_%08d.pt" % (prefix, rank)
@@ -52,59 +95,65 @@ class Zero1DistributedTrainingStateV1:
     def mkdir(self, prefix: str):
         os.makedirs(prefix, exist_ok=True)
 
-    def save_data(self, prefix: str, rank: int):
+    def save_data(self, prefix: str, rank: int, world_size: Optional[int] = None):
         assert os.path.exists(prefix)
+        if world_size is None:
+            world_size = get_default_world_size()
 
         torch_save(torch.get_rng_state(), Zero1DistributedTrainingStateV1.get_rng_state_file_name(prefix, rank))
         logging.info("Saved %s" % Zero1DistributedTrainingStateV1.get_rng_state_file_name(prefix, rank))
 
         if rank == 0:
             logging.info("Saving training state to %s" % prefix)
+            save_world_size(prefix, world_size)
             with open(Zero1DistributedTrainingStateV1.get_examples_seen_so_far_file_name(prefix), "wt") as fout:
                 fout.write("%d\n" % self.examples_seen_so_far)
                 logging.info("Saved %s" % Zero1DistributedTrainingStateV1.get_examples_seen_so_far_file_name(prefix))
+            if self.data_sampler_state is not None:
+                file_name = Zero1DistributedTrainingStateV1.get_data_sampler_state_file_name(prefix)
+                torch_save(self.data_sampler_state, file_name)
+                logging.info("Saved %s" % file_name)
+            if self.training_protocol_state is not None:
+                file_name = Zero1DistributedTrainingStateV1.get_training_protocol_state_file_name(prefix)
+                torch_save(self.training_protocol_state, file_name)
+                logging.info("Saved %s" % file_name)
             for module_name in self.modules:
                 if module_name not in self.optimizers:
                     continue
                 file_name = Zero1DistributedTrainingStateV1.get_module_file_name(prefix, module_name)
-                module = self.modules[module_name]
-                if isinstance(module, DistributedDataParallel):
-                    state_dict = module.module.state_dict()
-                else:
-                    state_dict = module.state_dict()
-                torch_save(state_dict, file_name)
+                torch_save(unwrap_module(self.modules[module_name]).state_dict(), file_name)
                 logging.info("Saved %s" % file_name)
             for module_name in self.accumulated_modules:
                 file_name = Zero1DistributedTrainingStateV1.get_accumulated_module_file_name(prefix, module_name)
-                torch_save(self.accumulated_modules[module_name].state_dict(), file_name)
+                torch_save(unwrap_module(self.accumulated_modules[module_name]).state_dict(), file_name)
                 logging.info("Saved %s" % file_name)
             for module_name in self.optimizers:
-                file_name = Zero1DistributedTrainingStateV1.get_optimizer_file_name(prefix, module_name)
-                torch_save(self.optimizers[module_name].state_dict(), file_name)
+                file_name = Zero1DistributedTrainingStateV1.get_optimizer_num_shards_file_name(prefix, module_name)
+                with open(file_name, "wt") as fout:
+                    fout.write("%d\n" % self.optimizers[module_name].world_size)
                 logging.info("Saved %s" % file_name)
 
+        # Each rank writes the partition of the optimizer state it owns.
+        for module_name in self.optimizers:
+            file_name = Zero1DistributedTrainingStateV1.get_optimizer_shard_file_name(prefix, module_name, rank)
+            torch_save(get_zero_optimizer_shard_state_dict(self.optimizers[module_name]), file_name)
+            logging.info("Saved %s" % file_name)
+
         logging.info("Done saving training state to %s" % prefix)
 
-    def save(self, prefix: str, rank: int, barrier_func: Callable[[], None]):
+    def save(self, prefix: str, rank: int, barrier_func: Callable[[], None], world_size: Optional[int] = None):
+        start_time = time.time()
         if rank == 0:
             self.mkdir(prefix)
         barrier_func()
 
-        # Consolidate optimizer states
-        for module_name in self.optimizers:
-            optimizer = self.optimizers[module_name]
-            optimizer.consolidate_state_dict(0)
-
-        barrier_func()
-
-        self.save_data(prefix, rank)
+        reset_peak_memory(None)
+        self.save_data(prefix, rank, world_size)
+        print_peak_memory(f"[rank={rank}] Max memory allocated while saving training state", None)
 
         barrier_func()
-
-        # Clear optimizer consolidated states.
-        for module_name in self.optimizers:
-            optimizer = self.optimizers[module_name]
-            optimizer._all_state_dicts = []
+        if rank == 0:
+            logging.info(f"Saving training state to {prefix} took {time.time() - start_time:.3f} seconds.")
 
     @staticmethod
     def get_examples_seen_so_far(prefix: str) -> int:
@@ -121,11 +170,13 @@ class Zero1DistributedTrainingStateV1:
             rank: int,
             local_rank: int,
             device: torch.device,
-            pretrained_module_file_names: Optional[Dict[str, str]] = None) -> 'Zero1DistributedTrainingStateV1':
+            pretrained_module_file_names: Optional[Dict[str, str]] = None,
+            module_compiler: Optional[ModuleCompiler] = None) -> 'Zero1DistributedTrainingStateV1':
         if pretrained_module_file_names is None:
             pretrained_module_file_names = {}
 
         logging.info(f"[Rank {rank}] Loading training state from {prefix}")
+        start_time = time.time()
 
         with open(Zero1DistributedTrainingStateV1.get_examples_seen_so_far_file_name(prefix)) as fin:
             lines = fin.readlines()
@@ -133,64 +184,87 @@ class Zero1DistributedTrainingStateV1:
             logging.info(
                 f"[Rank {rank}] Loaded {Zero1DistributedTrainingStateV1.get_examples_seen_so_far_file_name(prefix)}")
 
-        modules = {
-            module_name: factory.create()
-            for (module_name, factory) in module_factories.items()
-        }
-        for module_name in modules:
+        modules = {}
+        for module_name in module_factories:
             if module_name in optimizer_factories:
                 file_name = Zero1DistributedTrainingStateV1.get_module_file_name(prefix, module_name)
             else:
                 assert module_name in pretrained_module_file_names
                 file_name = pretrained_module_file_names[module_name]
-            module = modules[module_name]
-            state_dict = torch_load(file_name)
-            module.load_state_dict(state_dict)
-            module.to(device)
-            modules[module_name] = DistributedDataParallel(
-                module,
-                device_ids=[device.index],
-                output_device=device.index)
+            module = create_module_from_state_dict(module_factories[module_name], torch_load(file_name, device), device)
+            modules[module_name] = create_distributed_data_parallel(module, device)
             logging.info(f"[Rank {rank}] Loaded module '{module_name}' from {file_name}")
 
         #print_peak_memory(f"[rank={rank}] Max memory allocated after loading models", rank)
 
         accumulated_modules = {}
         for module_name in accumulators:
-            module_factory = module_factories[module_name]
-            module = module_factory.create()
             file_name = Zero1DistributedTrainingStateV1.get_accumulated_module_file_name(prefix, module_name)
-            module.load_state_dict(torch_load(file_name))
-            module.to(device)
-            accumulated_modules[module_name] = module
+            accumulated_modules[module_name] = create_module_from_state_dict(
+                module_factories[module_name], torch_load(file_name, device), device)
             logging.info(f"[Rank {rank}] Loaded {file_name}")
 
         #print_peak_memory(f"[rank={rank}] Max memory allocated after loading accumulated model", rank)
 
         optimizers = {}
         for module_name in optimizer_factories:
-            file_name = Zero1DistributedTrainingStateV1.get_optimizer_file_name(prefix, module_name)
             module = modules[module_name]
             optimizer = ZeroRedundancyOptimizer(
                 module.parameters(),
                 optimizer_class=optimizer_factories[module_name].get_optimizer_class(),
                 **optimizer_factories[module_name].get_optimizer_hyperparameters())
-            optimizer.load_state_dict(torch_load(file_name))
+            num_shards = Zero1DistributedTrainingStateV1.get_optimizer_num_shards(prefix, module_name)
+            if num_shards is not None:
+                shard_file_names = [
+                    Zero1DistributedTrainingStateV1.get_optimizer_shard_file_name(prefix, module_name, shard_index)
+                    for shard_index in range(num_shards)
+                ]
+                load_zero_optimizer_shards(optimizer, shard_file_names, torch_load)
+                logging.info(f"[Rank {rank}] Loaded optimizer '{module_name}' from {num_shards} shard(s) "
+                             f"with world size {optimizer.world_size}")
+            else:
+                # Checkpoints written before the optimizer state was sharded hold the consolidated state.
+                file_name = Zero1DistributedTrainingStateV1.get_optimizer_file_name(prefix, module_name)
+                optimizer.load_state_dict(torch_load(file_name))
+                logging.info(f"[Rank {rank}] Loaded {file_name}")
             optimizers[module_name] = optimizer
-            logging.info(f"[Rank {rank}] Loaded {file_name}")
 
             #print(rank, len(optimizer.optim.param_groups[0]['params']))
             #print(rank, optimizer._partition_parameters_cache[0][0].keys())
 
         #print_peak_memory(f"[rank={rank}] Max memory allocated after loading optimizers", rank)
 
-        torch.set_rng_state(torch_load(Zero1DistributedTrainingStateV1.get_rng_state_file_name(prefix, rank)))
+        data_sampler_state = None
+        if os.path.isfile(Zero1DistributedTrainingStateV1.get_data_sampler_state_file_name(prefix)):
+            data_sampler_state = torch_load(Zero1DistributedTrainingStateV1.get_data_sampler_state_file_name(prefix))
+            logging.info(f"[Rank {rank}] Loaded {Zero1DistributedTrainingStateV1.get_data_sampler_state_file_name(prefix)}")
+
+        training_protocol_state = None
+        training_protocol_state_file_name = Zero1DistributedTrainingStateV1.get_training_protocol_state_file_name(prefix)
+        if os.path.isfile(training_protocol_state_file_name):
+            training_protocol_state = torch_load(training_protocol_state_file_name)
+            logging.info(f"[Rank {rank}] Loaded {training_protocol_state_file_name}")
+
+        saved_world_size = get_saved_world_size(prefix)
+        if saved_world_size is None:
+            saved_world_size = get_default_world_size()
+        if saved_world_size != get_default_world_size():
+            logging.info(f"[Rank {rank}] Resuming a checkpoint written by {saved_world_size} processes "
+                         f"with {get_default_world_size()} processes")
+        restore_rng_state(
+            lambda r: Zero1DistributedTrainingStateV1.get_rng_state_file_name(prefix, r), rank, saved_world_size)
         logging.info(
             f"[Rank {rank}] Loaded {Zero1DistributedTrainingStateV1.get_examples_seen_so_far_file_name(prefix)}")
 
-        logging.info(f"[Rank {rank}] Done loading training state from {prefix}")
+        logging.info(f"[Rank {rank}] Done loading training state from {prefix} "
+                     f"in {time.time() - start_time:.3f} seconds.")
 
-        return Zero1DistributedTrainingStateV1(examples_seen_so_far, modules, accumulated_modules, optimizers)
+        if module_compiler is not None:
+            module_compiler.compile_modules(modules, accumulated_modules)
+
+        return Zero1DistributedTrainingStateV1(
+            examples_seen_so_far, modules, accumulated_modules, optimizers, data_sampler_state,
+            training_protocol_state)
 
     @staticmethod
     def new(module_factories: Dict[str, ModuleFactory],
@@ -200,7 +274,8 @@ class Zero1DistributedTrainingStateV1:
             rank: int,
             local_rank: int,
             device: torch.device,
-            pretrained_module_file_names: Optional[Dict[str, str]] = None) -> 'Zero1DistributedTrainingStateV1':
+            pretrained_module_file_names: Optional[Dict[str, str]] = None,
+            module_compiler: Optional[ModuleCompiler] = None) -> 'Zero1DistributedTrainingStateV1':
         examples_seen_so_far = 0
 
         modules = {
@@ -222,10 +297,7 @@ class Zero1DistributedTrainingStateV1:
 
         for module_name in modules:
             module = modules[module_name]
-            modules[module_name] = DistributedDataParallel(
-                module,
-                device_ids=[device.index],
-                output_device=device.index)
+            modules[module_name] = create_distributed_data_parallel(module, device)
 
         optimizers = {}
         for module_name in optimizer_factories:
@@ -238,6 +310,9 @@ class Zero1DistributedTrainingStateV1:
 
         torch.manual_seed(random_seed + rank)
 
+        if module_compiler is not None:
+            module_compiler.compile_modules(modules, accumulated_modules)
+
         return Zero1DistributedTrainingStateV1(examples_seen_so_far, modules, accumulated_modules, optimizers)
 
     @staticmethod
@@ -272,11 +347,23 @@ class Zero1DistributedTrainingStateV1:
                 logging.info(f"Cannot load files in {prefix} because {file_name} is not a file.")
                 return False
         for module_name in optimizer_factories:
-            file_name = Zero1DistributedTrainingStateV1.get_optimizer_file_name(prefix, module_name)
-            if not os.path.isfile(file_name):
-                logging.info(f"Cannot load files in {prefix} because {file_name} is not a file.")
-                return False
-        for rank in range(world_size):
+            num_shards = Zero1DistributedTrainingStateV1.get_optimizer_num_shards(prefix, module_name)
+            if num_shards is None:
+                file_names = [Zero1DistributedTrainingStateV1.get_optimizer_file_name(prefix, module_name)]
+            else:
+                file_names = [
+                    Zero1DistributedTrainingStateV1.get_optimizer_shard_file_name(prefix, module_name, shard_index)
+                    for shard_index in range(num_shards)
+                ]
+            for file_name in file_names:
+                if not os.path.isfile(file_name):
+                    logging.info(f"Cannot load files in {prefix} because {file_name} is not a file.")
+                    return False
+        # The RNG states of the ranks that wrote the checkpoint are enough to resume at any world size.
+        saved_world_size = get_saved_world_size(prefix)
+        if saved_world_size is None:
+            saved_world_size = world_size
+        for rank in range(saved_world_size):
             file_name = Zero1DistributedTrainingStateV1.get_rng_state_file_name(prefix, rank)
             if not os.path.isfile(file_name):
                 logging.info(f"Cannot load files in {prefix} because {file_name} is not a file.")
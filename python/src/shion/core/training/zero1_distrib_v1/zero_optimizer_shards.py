@@ -0,0 +1,63 @@
+from typing import Dict, Any, List, Callable
+
+from torch.distributed.optim import ZeroRedundancyOptimizer
+
+
+def get_zero_optimizer_param_groups(optimizer: ZeroRedundancyOptimizer) -> List[Dict[str, Any]]:
+    # The same layout as the "param_groups" of a consolidated ZeroRedundancyOptimizer state dict: the hyperparameters
+    # of each group, with the parameters replaced by their global indices.
+    param_to_index = optimizer._param_to_index
+    param_groups = []
+    for param_group in optimizer.param_groups:
+        packed = {key: value for (key, value) in param_group.items() if key != "params"}
+        packed["params"] = [param_to_index[param] for param in param_group["params"]]
+        param_groups.append(packed)
+    return param_groups
+
+
+def get_zero_optimizer_shard_state_dict(optimizer: ZeroRedundancyOptimizer) -> Dict[str, Any]:
+    # Only the state of the parameters in this rank's partition, keyed by global parameter index. Nothing is gathered
+    # from the other ranks.
+    param_to_index = optimizer._param_to_index
+    state = {}
+    for param, param_state in optimizer.optim.state.items():
+        state[param_to_index[param]] = param_state
+    return {
+        "state": dict(sorted(state.items())),
+        "param_groups": get_zero_optimizer_param_groups(optimizer),
+    }
+
+
+def load_zero_optimizer_shards(
+        optimizer: ZeroRedundancyOptimizer,
+        shard_file_names: List[str],
+        load_func: Callable[[str], Dict[str, Any]]):
+    """
+    Load the optimizer state from shard files written by get_zero_optimizer_shard_state_dict.
+
+    If the number of shards is equal to the optimizer's world size, the partition of the parameters is the same as
+    when the shards were written, so each rank only reads its own shard. Otherwise, each rank reads all the shards and
+    keeps the state of the parameters that fall in its new partition.
+    """
+    if len(shard_file_names) == optimizer.world_size:
+        file_names_to_read = [shard_file_names[optimizer.rank]]
+    else:
+        file_names_to_read = shard_file_names
+
+    index_to_param = optimizer._index_to_param
+    param_to_rank = optimizer._param_to_rank
+    state = {}
+    param_groups = None
+    for file_name in file_names_to_read:
+        shard = load_func(file_name)
+        if param_groups is None:
+            param_groups = shard["param_groups"]
+        for index, param_state in shard["state"].items():
+            if param_to_rank[index_to_param[index]] == optimizer.rank:
+                state[index] = param_state
+        shard = None
+
+    optimizer.load_state_dict({
+        "state": state,
+        "param_groups": param_groups,
+    })